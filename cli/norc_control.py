@@ -11,11 +11,12 @@ import time
 from optparse import OptionParser
 
 from norc.core.constants import Status, Request
-from norc.core.models import Executor, Scheduler
+from norc.core.models import Executor, Scheduler, Supervisor
 from norc.norc_utils.django_extras import update_obj, MultiQuerySet
 
 EXECUTOR_KEYWORDS = ["e", "executor"]
 SCHEDULER_KEYWORDS = ["s", "scheduler"]
+SUPERVISOR_KEYWORDS = ["v", "supervisor"]
 HOST_KEYWORDS = ["h", "host"]
 
 REQ_TO_STAT = {
@@ -36,7 +37,8 @@ def _wait(ds, req):
         time.sleep(0.5)
 
 def main():
-    usage = "norc_control [executor | scheduler | host] <id | host> " + \
+    usage = "norc_control [executor | scheduler | supervisor | host] " + \
+        "<id | host> " + \
         "--[stop | kill | pause | resume | reload] [--wait]"
     
     def bad_args(message):
@@ -54,7 +56,7 @@ def main():
     parser.add_option("-u", "--resume", action="store_true", default=False,
         help="Send an resume request.")
     parser.add_option("-r", "--reload", action="store_true", default=False,
-        help="Send an reload request to a Scheduler.")
+        help="Send a reload request.")
     parser.add_option("-f", "--force", action="store_true", default=False,
         help="Force the request to be made..")
     parser.add_option("-w", "--wait", action="store_true", default=False,
@@ -78,8 +80,10 @@ def main():
         cls = Executor
     elif args[0] in SCHEDULER_KEYWORDS:
         cls = Scheduler
+    elif args[0] in SUPERVISOR_KEYWORDS:
+        cls = Supervisor
     elif args[0] in HOST_KEYWORDS:
-        daemons = MultiQuerySet(Executor, Scheduler).objects.all()
+        daemons = MultiQuerySet(Executor, Scheduler, Supervisor).objects.all()
         daemons = daemons.filter(host=args[1]).status_in("active")
         if not options.force:
             daemons = daemons.filter(request=None)
@@ -5,11 +5,13 @@
 import sys
 from optparse import OptionParser
 
-from norc.core.models import Executor, Queue
+from norc.core.models import Executor, Queue, Supervisor
 from norc.norc_utils.log import make_log
 
 def main():
-    usage = "norc_executor <queue_name> -c <n> [-e] [-d]"
+    usage = "norc_executor <queue_name>[:<weight>] ... -c <n> [-p] " + \
+        "[--min <n> --max <n>] [--cpu <n>] [--memory <mb>] " + \
+        "[--prefetch <n>] [-e] [-d]"
     
     def bad_args(message):
         print message
@@ -19,6 +21,20 @@ def main():
     parser = OptionParser(usage)
     parser.add_option("-c", "--concurrent", type='int',
         help="How many instances can be run concurrently.")
+    parser.add_option("-p", "--priority", action="store_true", default=False,
+        help="Drain queues in strict priority order instead of by weight.")
+    parser.add_option("--min", type='int', dest="min_concurrent",
+        help="Minimum concurrency when adapting to host load.")
+    parser.add_option("--max", type='int', dest="max_concurrent",
+        help="Maximum concurrency when adapting to host load.")
+    parser.add_option("--cpu", type='int', dest="cpu_capacity",
+        help="CPU units available to instances.")
+    parser.add_option("--memory", type='int', dest="memory_capacity",
+        help="Memory (in MB) available to instances.")
+    parser.add_option("--prefetch", type='int', default=0,
+        help="How many instances to hold locally ahead of free slots.")
+    parser.add_option("--supervisor", type='int',
+        help="ID of the supervisor running this executor.")
     parser.add_option("-e", "--echo", action="store_true", default=False,
         help="Echo log messages to stdout.")
     parser.add_option("-d", "--debug", action="store_true", default=False,
@@ -26,17 +42,52 @@ def main():
     
     (options, args) = parser.parse_args()
 
-    if len(args) != 1:
-        bad_args("A single queue name is required.")
+    if len(args) < 1:
+        bad_args("At least one queue name is required.")
+    
+    adaptive = (options.min_concurrent, options.max_concurrent)
+    if None in adaptive and adaptive != (None, None):
+        bad_args("Adaptive concurrency requires both --min and --max.")
+    if None not in adaptive:
+        if not 1 <= options.min_concurrent <= options.max_concurrent:
+            bad_args("Invalid concurrency bounds.")
+        if options.concurrent == None:
+            options.concurrent = options.min_concurrent
+        options.concurrent = max(options.min_concurrent,
+            min(options.max_concurrent, options.concurrent))
     
     if options.concurrent == None:
         bad_args("You must give a maximum number of concurrent subprocesses.")
     
-    queue = Queue.get(args[0])
-    if not queue:
-        bad_args("Invalid queue name '%s'." % args[0])
+    queues = []
+    for i, arg in enumerate(args):
+        name, _, weight = arg.partition(':')
+        queue = Queue.get(name)
+        if not queue:
+            bad_args("Invalid queue name '%s'." % name)
+        try:
+            weight = int(weight) if weight else 1
+        except ValueError:
+            bad_args("Invalid weight '%s'; must be an integer." % weight)
+        queues.append((queue, weight, i if options.priority else 0))
+    
+    supervisor = None
+    if options.supervisor != None:
+        try:
+            supervisor = Supervisor.objects.get(pk=options.supervisor)
+        except Supervisor.DoesNotExist:
+            bad_args("Invalid supervisor id '%s'." % options.supervisor)
     
-    executor = Executor.objects.create(queue=queue, concurrent=options.concurrent)
+    executor = Executor.objects.create(queue=queues[0][0],
+        concurrent=options.concurrent,
+        min_concurrent=options.min_concurrent,
+        max_concurrent=options.max_concurrent,
+        cpu_capacity=options.cpu_capacity,
+        memory_capacity=options.memory_capacity,
+        prefetch=options.prefetch,
+        supervisor=supervisor)
+    for queue, weight, priority in queues:
+        executor.add_queue(queue, weight, priority)
     executor.log = make_log(executor.log_path,
         echo=options.echo, debug=options.debug)
     executor.start()
@@ -0,0 +1,103 @@
+#!/usr/bin/python
+
+"""A command-line script to run a Norc supervisor.
+
+Each argument is the norc_executor arguments for one executor, e.g.:
+
+    norc_supervisor "q1 q2:3 -c 4" "q3 -c 2 --prefetch 2"
+
+"""
+
+import os
+import sys
+import socket
+from optparse import OptionParser
+
+from norc.core.models import Supervisor, Queue
+from norc.core.autoscale import Autoscaler
+from norc.core.constants import (CONCURRENCY_LIMIT,
+    AUTOSCALE_BACKLOG, AUTOSCALE_MAX_WAIT)
+from norc.norc_utils.log import make_log
+
+def send(command):
+    """Sends a command to this host's supervisor and prints the reply."""
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(Supervisor.socket_path())
+    except socket.error, e:
+        print "Couldn't reach a supervisor on this host: %s" % e
+        sys.exit(1)
+    conn.sendall(command + '\n')
+    reply = conn.makefile().read()
+    conn.close()
+    sys.stdout.write(reply)
+
+def main():
+    usage = "norc_supervisor '<executor args>' ... [-a <queue> ...] " + \
+        "[--backlog <n>] [--max-wait <secs>] [--max-slots <n>] " + \
+        "[--per-executor <n>] [-e] [-d] | " + \
+        "norc_supervisor --send [status | stop | kill]"
+    
+    def bad_args(message):
+        print message
+        print usage
+        sys.exit(2)
+    
+    parser = OptionParser(usage)
+    parser.add_option("-s", "--send",
+        help="Send a command to the running supervisor on this host.")
+    parser.add_option("-a", "--autoscale", action="append", default=[],
+        help="Add and remove executors for a queue according to its "
+            "backlog.  May be given more than once.")
+    parser.add_option("--backlog", type='int', default=AUTOSCALE_BACKLOG,
+        help="Queued instances per slot to aim for when autoscaling.")
+    parser.add_option("--max-wait", type='int', default=AUTOSCALE_MAX_WAIT,
+        dest="max_wait", help="Seconds an instance may wait in the queue "
+            "before autoscaling adds slots regardless.")
+    parser.add_option("--max-slots", type='int', dest="max_slots",
+        help="The most slots autoscaling may give each queue.")
+    parser.add_option("--per-executor", type='int', dest="per_executor",
+        default=CONCURRENCY_LIMIT,
+        help="The most slots autoscaling gives each executor.")
+    parser.add_option("-e", "--echo", action="store_true", default=False,
+        help="Echo log messages to stdout.")
+    parser.add_option("-d", "--debug", action="store_true", default=False,
+        help="Enable debug messages.")
+    
+    (options, args) = parser.parse_args()
+    
+    if options.send:
+        return send(options.send)
+    
+    if len(args) < 1 and not options.autoscale:
+        bad_args("At least one executor or autoscaled queue is required.")
+    
+    queues = []
+    for name in options.autoscale:
+        queue = Queue.get(name)
+        if not queue:
+            bad_args("Invalid queue name '%s'." % name)
+        queues.append(queue)
+    if options.backlog < 1 or options.per_executor < 1:
+        bad_args("--backlog and --per-executor must be positive.")
+    
+    if Supervisor.objects.alive().filter(host=os.uname()[1]).count() > 0:
+        print "Cannot run more than one supervisor per host."
+        return
+    
+    supervisor = Supervisor.objects.create()
+    supervisor.specs = args
+    for queue in queues:
+        def start(slots, queue=queue):
+            supervisor.add_executors(queue, slots, options.per_executor)
+        supervisor.autoscalers.append(Autoscaler(queue,
+            backlog=options.backlog, max_wait=options.max_wait,
+            max_slots=options.max_slots, per_executor=options.per_executor,
+            start=start, stop=supervisor.stop_executor,
+            host=supervisor.host))
+    supervisor.log = make_log(supervisor.log_path,
+        echo=options.echo, debug=options.debug)
+    supervisor.start()
+    
+if __name__ == '__main__':
+    main()
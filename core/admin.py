@@ -5,10 +5,23 @@ from norc.core import models
 
 class ExecutorAdmin(admin.ModelAdmin):
     list_display = ['id', 'host', 'pid', 'status', 'request', 
-        'heartbeat', 'started', 'ended', 'queue', 'concurrent']
+        'heartbeat', 'started', 'ended', 'queue', 'concurrent',
+        'min_concurrent', 'max_concurrent', 'cpu_capacity',
+        'memory_capacity', 'prefetch', 'running', 'held', 'supervisor']
 
 admin.site.register(models.Executor, ExecutorAdmin)
 
+class SupervisorAdmin(admin.ModelAdmin):
+    list_display = ['id', 'host', 'pid', 'status', 'request',
+        'heartbeat', 'started', 'ended']
+
+admin.site.register(models.Supervisor, SupervisorAdmin)
+
+class ExecutorQueueAdmin(admin.ModelAdmin):
+    list_display = ['id', 'executor', 'queue', 'weight', 'priority']
+
+admin.site.register(models.ExecutorQueue, ExecutorQueueAdmin)
+
 class DBQueueAdmin(admin.ModelAdmin):
     list_display = ['id', 'name', 'count_']
     
@@ -36,7 +49,9 @@ admin.site.register(models.Job, JobAdmin)
 class CommandTaskAdmin(admin.ModelAdmin):
     list_display = ['id', 'name', 'description', 
         'command', 'nice',
-        'timeout', 'date_added']
+        'timeout', 'cpu_units', 'memory_mb', 'memory_limit',
+        'cpu_time_limit', 'cpu_affinity', 'io_class', 'idempotent',
+        'batch_size', 'date_added']
     
     def timeout_(self, j):
         return j.timeout
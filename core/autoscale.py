@@ -0,0 +1,115 @@
+
+"""Queue-depth driven autoscaling of executors.
+
+An Autoscaler watches one queue's backlog and the age of its oldest item
+and sizes the executors drawing from it to keep both within targets.  It
+first changes the concurrency of existing executors, then calls its
+start and stop hooks to add or remove executors.  A Supervisor provides
+hooks that spawn and stop its children (see norc_supervisor --autoscale);
+other deployments can pass their own.
+
+"""
+
+import math
+from datetime import datetime
+
+from norc.core.models import Executor
+from norc.core.constants import (Request, CONCURRENCY_LIMIT,
+    AUTOSCALE_BACKLOG, AUTOSCALE_MAX_WAIT)
+
+class Autoscaler(object):
+    """Sizes the executors for a queue according to its backlog.
+    
+    backlog is the number of queued items per slot to aim for, and
+    max_wait the age in seconds the oldest queued item may reach before
+    more slots are added regardless.  The total number of slots moves by
+    at most step per call to scale(), between min_slots and max_slots.
+    No executor is given more than per_executor slots.
+    
+    start(slots) is called to add executors for that many more slots and
+    stop(executor) to remove one.  Without them, only the concurrency of
+    existing executors changes.  If host is given, only executors on that
+    host are changed, though the backlog is shared by all of them.
+    
+    """
+    def __init__(self, queue, backlog=AUTOSCALE_BACKLOG,
+        max_wait=AUTOSCALE_MAX_WAIT, min_slots=1, max_slots=None, step=1,
+        per_executor=CONCURRENCY_LIMIT, start=None, stop=None, host=None):
+        self.queue = queue
+        self.backlog, self.max_wait = backlog, max_wait
+        self.min_slots, self.max_slots = min_slots, max_slots
+        self.step, self.per_executor = step, per_executor
+        self.start, self.stop = start, stop
+        self.host = host
+    
+    def age(self):
+        """Seconds the oldest queued item has waited, if known."""
+        try:
+            item = self.queue.peek()
+        except NotImplementedError:
+            return None
+        if item and getattr(item, 'enqueued', None):
+            wait = datetime.utcnow() - item.enqueued
+            return wait.days * 86400 + wait.seconds
+    
+    def desired(self, depth, age, slots):
+        """The number of slots wanted given the current backlog."""
+        want = int(math.ceil(float(depth) / self.backlog))
+        if age != None and age > self.max_wait:
+            want = max(want, slots + self.step)
+        elif want < slots and age != None and age > self.max_wait / 2:
+            # Still busy enough that shrinking would just bounce back.
+            want = slots
+        want = max(slots - self.step, min(slots + self.step, want))
+        if self.max_slots != None:
+            want = min(want, self.max_slots)
+        return max(want, self.min_slots)
+    
+    def scale(self):
+        """Resizes the executors once.  Returns the slots now wanted."""
+        executors = list(Executor.objects.for_queue(self.queue).alive())
+        slots = sum(e.concurrent for e in executors)
+        want = self.desired(self.queue.count(), self.age(), slots)
+        if want != slots:
+            if self.host:
+                executors = [e for e in executors if e.host == self.host]
+            self.resize(executors, want - slots)
+        return want
+    
+    def resize(self, executors, delta):
+        """Adds (or, if negative, removes) delta slots."""
+        # Adaptive executors size themselves, and ones with a request
+        # pending are about to change anyway.
+        fixed = [e for e in executors if not e.adaptive and e.request == None]
+        if delta > 0:
+            for e in sorted(fixed, key=lambda e: e.concurrent):
+                room = min(delta, self.per_executor - e.concurrent)
+                if room > 0:
+                    self.set_concurrent(e, e.concurrent + room)
+                    delta -= room
+            if delta > 0 and self.start:
+                self.start(delta)
+        else:
+            delta = -delta
+            for e in sorted(fixed, key=lambda e: e.concurrent):
+                if delta <= 0:
+                    break
+                if self.stop and e.concurrent <= delta:
+                    self.stop(e)
+                    delta -= e.concurrent
+                elif e.concurrent > 1:
+                    cut = min(delta, e.concurrent - 1)
+                    self.set_concurrent(e, e.concurrent - cut)
+                    delta -= cut
+    
+    def set_concurrent(self, executor, concurrent):
+        """Asks an executor to change its concurrency."""
+        # Skip it if a request arrived since it was read.
+        Executor.objects.filter(pk=executor.pk, request=None).update(
+            concurrent=concurrent, request=Request.RELOAD)
+    
+    def __unicode__(self):
+        return u"<Autoscaler for %s>" % self.queue
+    
+    __repr__ = __unicode__
+
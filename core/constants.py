@@ -15,8 +15,80 @@ SCHEDULER_PERIOD = 5
 # How many new schedules the scheduler can pull from the database at once.
 SCHEDULER_LIMIT = 10000
 
+# How often a scheduler looks through every schedule for ones to claim, in
+# seconds.  In between, it only looks at schedules newer than any it's seen.
+SCHEDULER_RESCAN = 60
+
+# How far ahead in seconds a scheduler claims schedules.  Schedules due
+# later stay in the database until they come within this horizon, so it
+# should be several times SCHEDULER_RESCAN.
+SCHEDULER_HORIZON = 15 * 60
+
+# How many threads a scheduler enqueues due schedules with, and how many
+# schedules each thread takes at a time.
+SCHEDULER_THREADS = 4
+SCHEDULER_BATCH = 500
+
 EXECUTOR_PERIOD = 0.5
 
+# How often a Supervisor checks on its executors, in seconds.
+SUPERVISOR_PERIOD = 1
+
+# How long a Supervisor waits before restarting an executor that crashed
+# soon after starting, in seconds.
+RESTART_DELAY = 10
+
+# How often an Executor checks its idempotent instances for stragglers and
+# for copies that another executor has already finished, in seconds.
+SPECULATION_PERIOD = 5
+
+# An instance of an idempotent task is duplicated once it has run this many
+# times the 95th percentile duration of its task's last SPECULATION_HISTORY
+# successful instances.  At least SPECULATION_MIN_SAMPLES are needed.
+SPECULATION_FACTOR = 1.5
+SPECULATION_HISTORY = 100
+SPECULATION_MIN_SAMPLES = 10
+
+# How often an Autoscaler resizes the executors for its queue, in seconds.
+# This should leave new executors time to start up.
+AUTOSCALE_PERIOD = 30
+
+# The queued instances per executor slot an Autoscaler aims for, and how
+# long in seconds the oldest may wait before it adds slots regardless.
+AUTOSCALE_BACKLOG = 10
+AUTOSCALE_MAX_WAIT = 60
+
+# How long an Executor may hold a prefetched instance before giving it
+# back to its queue, in seconds.
+PREFETCH_LEASE = 60
+
+# How often an Executor looks for instances on its queues whose lease has
+# lapsed or whose holder has died, in seconds.
+RECLAIM_PERIOD = 15
+
+# How long an Executor waits after sending SIGTERM to an instance's process
+# group before sending SIGKILL, in seconds.
+KILL_GRACE = 5
+
+# How long past its timeout an instance may run before its Executor kills
+# it, in seconds.  This gives the instance a chance to time itself out.
+TIMEOUT_GRACE = 5
+
+# How often an adaptive Executor re-evaluates its concurrency, in seconds.
+ADAPT_PERIOD = 10
+
+# Host pressure thresholds for adaptive Executors.  Load is the one minute
+# load average per CPU, memory is the fraction of memory available, and
+# iowait is the fraction of CPU time spent waiting on IO.  Concurrency is
+# lowered if any HIGH threshold is crossed and only raised when all values
+# are comfortably within the LOW thresholds.
+LOAD_HIGH = 1.0
+LOAD_LOW = 0.7
+MEMORY_LOW = 0.10
+MEMORY_HIGH = 0.25
+IOWAIT_HIGH = 0.30
+IOWAIT_LOW = 0.10
+
 # A list of all Task implementations.
 TASK_MODELS = [] # NOTE: This is dynamically generated by MetaTask.
 
@@ -74,6 +146,7 @@ class Status(object):
     SUCCESS = 7         # Succeeded.
     ENDED = 8           # Ended gracefully.
     KILLED = 9          # Forcefully killed.
+    SUPERSEDED = 10     # A copy of the instance finished first.
     HANDLED = 12        # Was ERROR, but the problem's been handled.
     
     # Failure states.
@@ -5,5 +5,6 @@ from norc.core.models.schedules import *
 from norc.core.models.scheduler import *
 from norc.core.models.queue import *
 from norc.core.models.executor import *
+from norc.core.models.supervisor import *
 
 from norc import settings
@@ -11,8 +11,10 @@ from threading import Thread, Event
 # Alas, 2.5 doesn't have multiprocessing...
 from subprocess import Popen
 import resource
+from collections import deque
+import heapq
 
-from django.db.models import (Model, Manager, query,
+from django.db.models import (Model, Manager, query, Q, Count, Sum,
     CharField,
     DateTimeField,
     IntegerField,
@@ -26,9 +28,14 @@ from django.contrib.contenttypes.generic import (GenericRelation,
 from norc.core.models.queue import Queue
 from norc.core.models.daemon import AbstractDaemon
 from norc.core.constants import (Status, Request, CONCURRENCY_LIMIT,
-    EXECUTOR_PERIOD, HEARTBEAT_PERIOD, HEARTBEAT_FAILED, INSTANCE_MODELS)
+    EXECUTOR_PERIOD, HEARTBEAT_PERIOD, HEARTBEAT_FAILED, INSTANCE_MODELS,
+    PREFETCH_LEASE, RECLAIM_PERIOD, KILL_GRACE, TIMEOUT_GRACE, ADAPT_PERIOD,
+    SPECULATION_PERIOD, SPECULATION_FACTOR,
+    LOAD_HIGH, LOAD_LOW, MEMORY_LOW, MEMORY_HIGH, IOWAIT_HIGH, IOWAIT_LOW)
 from norc.norc_utils.django_extras import QuerySetManager, MultiQuerySet
 from norc.norc_utils.parallel import ThreadPool
+from norc.norc_utils.system import (HostMonitor, parse_cpu_list,
+    set_affinity, set_io_priority, group_pids, kill_group)
 from norc.norc_utils.log import make_log
 from norc.norc_utils.backup import backup_log
 from norc import settings
@@ -36,9 +43,9 @@ from norc import settings
 class Executor(AbstractDaemon):
     """Executors are responsible for the running of instances.
     
-    Executors have a single queue that they pull instances from.  There
-    can (and in many cases should) be more than one Executor running for
-    a single queue.
+    Executors pull instances from one or more queues (see ExecutorQueue).
+    There can (and in many cases should) be more than one Executor running
+    for a single queue.
     
     """
     
@@ -52,8 +59,40 @@ class Executor(AbstractDaemon):
         
         def for_queue(self, q):
             """Executors pulling from the given queue."""
-            return self.filter(queue_id=q.id,
-                queue_type=ContentType.objects.get_for_model(q).id)
+            ct = ContentType.objects.get_for_model(q).id
+            return self.filter(Q(queue_id=q.id, queue_type=ct) |
+                Q(executor_queues__queue_id=q.id,
+                    executor_queues__queue_type=ct)).distinct()
+        
+        def capacity(self, by='queue'):
+            """Slots of these executors, totalled per queue or per host.
+            
+            Returns a list of dicts with the executors, slots, running,
+            held (prefetched) and free slots of each queue (identified by
+            queue_type and queue_id) or host, all from one query.  An
+            executor's slots count toward every queue it draws from.
+            
+            """
+            if by == 'queue':
+                rows = ExecutorQueue.objects.filter(executor__in=self)
+                keys = ['queue_type', 'queue_id']
+                prefix = 'executor__'
+            elif by == 'host':
+                rows, keys, prefix = self, ['host'], ''
+            else:
+                raise ValueError("Can't total capacity by '%s'." % by)
+            # Clear the ordering, which would otherwise be grouped on.
+            rows = rows.order_by().values(*keys).annotate(
+                executors=Count(prefix + 'id'),
+                slots=Sum(prefix + 'concurrent'),
+                running=Sum(prefix + 'running'),
+                held=Sum(prefix + 'held'))
+            totals = []
+            for row in rows:
+                row = dict(row)
+                row['free'] = max(0, row['slots'] - row['running'])
+                totals.append(row)
+            return totals
     
     @property
     def instances(self):
@@ -77,6 +116,7 @@ class Executor(AbstractDaemon):
         Request.KILL,
         Request.PAUSE,
         Request.RESUME,
+        Request.RELOAD,
     ]
     
     # The status of this executor.
@@ -87,7 +127,7 @@ class Executor(AbstractDaemon):
     request = PositiveSmallIntegerField(null=True,
         choices=[(r, Request.name(r)) for r in VALID_REQUESTS])
     
-    # The queue this executor draws task instances from.
+    # The primary queue this executor draws task instances from.
     queue_type = ForeignKey(ContentType)
     queue_id = PositiveIntegerField()
     queue = GenericForeignKey('queue_type', 'queue_id')
@@ -95,19 +135,84 @@ class Executor(AbstractDaemon):
     # The number of things that can be run concurrently.
     concurrent = IntegerField()
     
+    # Bounds for adaptive concurrency.  If both are set, the executor will
+    # adjust concurrent between them according to the load on its host.
+    min_concurrent = IntegerField(null=True, blank=True)
+    max_concurrent = IntegerField(null=True, blank=True)
+    
+    # The CPU units and memory (in MB) this executor may hand out to the
+    # instances it runs.  Null means unlimited.
+    cpu_capacity = PositiveIntegerField(null=True, blank=True)
+    memory_capacity = PositiveIntegerField(null=True, blank=True)
+    
+    # How many popped instances to hold locally beyond those that can be
+    # started right away, so that a freed slot needn't wait on a queue.
+    prefetch = PositiveIntegerField(default=0)
+    
+    # Slots in use and instances held (prefetched), as of the last
+    # heartbeat.  See Executor.objects.capacity().
+    running = PositiveIntegerField(default=0)
+    held = PositiveIntegerField(default=0)
+    
+    # The supervisor running this executor, if any.  A supervised executor
+    # leaves its heartbeat and request polling to the supervisor.
+    supervisor = ForeignKey('core.Supervisor', null=True, blank=True,
+        related_name='executors')
+    
     @property
     def alive(self):
         return self.status == Status.RUNNING and self.heartbeat > \
             datetime.utcnow() - timedelta(seconds=HEARTBEAT_FAILED)
     
+    @property
+    def adaptive(self):
+        """Whether concurrency adapts to host load."""
+        return self.min_concurrent != None and self.max_concurrent != None
+    
     def __init__(self, *args, **kwargs):
         AbstractDaemon.__init__(self, *args, **kwargs)
         self.processes = {}
+        # Process groups being killed, mapped to when to escalate to
+        # SIGKILL.  Each instance runs in its own group, led by its pid.
+        self.dying = {}
+        # A heap of (deadline, pid) for instances with a timeout.
+        self.deadlines = []
+        self.next_adapt = 0
+        self.next_speculate = 0
+        self.next_publish = 0
+        self.next_reclaim = 0
+        self.published = (0, 0)
+        # Instances popped but not yet started, as [queue, instance,
+        # lease time] lists.  The lease time is None until the instance
+        # has been leased, i.e. marked in the DB as held by this executor.
+        self.prefetched = deque()
+        self.supervised = self.supervisor_id != None
+        # Set when the supervisor signals that a request is waiting.
+        self.poked = False
+    
+    def heart_run(self):
+        """Beats the heart, unless a supervisor is doing it for us."""
+        if not self.supervised:
+            AbstractDaemon.heart_run(self)
+    
+    def poke_handler(self, signum, frame=None):
+        """Handles the supervisor's signal that a request is waiting."""
+        self.poked = True
+        self.flag.set()
+    
+    def detach(self):
+        """Takes over the heartbeat and request polling from a supervisor."""
+        self.supervised = False
+        self.heart = Thread(target=self.heart_run)
+        self.heart.daemon = True
+        self.heart.flag = Event()
+        self.heart.start()
     
     def run(self):
         """Core executor function."""
         if settings.BACKUP_SYSTEM:
-            self.pool = ThreadPool(self.concurrent * 2)
+            self.pool = ThreadPool(
+                (self.max_concurrent or self.concurrent) * 2)
         self.log.info("%s is now running on host %s." % (self, self.host))
         
         if self.log.debug_on:
@@ -115,46 +220,230 @@ class Executor(AbstractDaemon):
             self.resource_reporter.daemon = True
             self.resource_reporter.start()
         
+        if self.adaptive:
+            self.monitor = HostMonitor()
+            self.next_adapt = time.time() + ADAPT_PERIOD
+        
+        self.queues = self.load_queues()
+        
+        if self.supervised:
+            self.parent = os.getppid()
+            try:
+                signal.signal(signal.SIGUSR1, self.poke_handler)
+            except ValueError:
+                # Not in the main thread (i.e., testing); poll instead.
+                self.detach()
+        self.log.info("Drawing from: %s" % ', '.join(map(str, self.queues)))
+        
         # Main loop.
         while not Status.is_final(self.status):
             if self.request:
                 self.handle_request()
             
             if self.status == Status.RUNNING:
-                while len(self.processes) < self.concurrent:
-                    # self.log.debug("Popping instance...")
-                    instance = self.queue.pop()
-                    if instance:
-                        # self.log.debug("Popped %s" % instance)
-                        self.start_instance(instance)
-                    else:
-                        # self.log.debug("No instance in queue.")
-                        break
+                if self.adaptive and time.time() >= self.next_adapt:
+                    self.adapt_concurrency()
+                self.expire_leases()
+                if time.time() >= self.next_reclaim:
+                    self.reclaim_leases()
+                self.fill()
             
             elif self.status == Status.STOPPING and len(self.processes) == 0:
                 self.set_status(Status.ENDED)
                 self.save(safe=True)
             
             # Clean up completed tasks before iterating.
-            for pid, p in self.processes.items()[:]:
-                p.poll()
-                # self.log.debug(
-                #     "Checking pid %s: return code %s." % (pid, p.returncode))
-                if not p.returncode == None:
-                    i = type(p.instance).objects.get(pk=p.instance.pk)
-                    self.log.info("Instance '%s' ended with status %s." %
-                        (i, Status.name(i.status)))
-                    del self.processes[pid]
-                    if settings.BACKUP_SYSTEM:
-                        self.pool.queueTask(self.backup_instance_log, [i])
+            self.reap()
+            self.enforce_timeouts()
+            self.escalate()
+            if time.time() >= self.next_speculate:
+                self.speculate()
+            self.publish()
             
             if not Status.is_final(self.status):
                 self.wait(EXECUTOR_PERIOD)
-                self.request = Executor.objects.get(pk=self.pk).request
+                if self.supervised and os.getppid() != self.parent:
+                    self.log.info("Supervisor has gone away; "
+                        "running unsupervised.")
+                    self.detach()
+                if not self.supervised or self.poked:
+                    self.poked = False
+                    self.request = Executor.objects.get(pk=self.pk).request
+    
+    def reap(self):
+        """Cleans up after instance processes that have exited."""
+        for pid, p in self.processes.items()[:]:
+            # wait4 is used instead of p.poll() to get the rusage.
+            wpid, status, usage = os.wait4(pid, os.WNOHANG)
+            # self.log.debug(
+            #     "Checking pid %s: return code %s." % (pid, p.returncode))
+            if wpid != 0:
+                p.returncode = -os.WTERMSIG(status) \
+                    if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+                self.record_usage(p, usage)
+                for i in p.batch:
+                    i = type(i).objects.get(pk=i.pk)
+                    if not Status.is_final(i.status):
+                        # Killed before it could record its own status.
+                        i.status = Status.TIMEDOUT \
+                            if getattr(p, 'timed_out', False) \
+                            else Status.INTERRUPTED
+                        i.ended = datetime.utcnow()
+                        i.save()
+                    self.log.info("Instance '%s' ended with status %s." %
+                        (i, Status.name(i.status)))
+                    if settings.BACKUP_SYSTEM:
+                        self.pool.submit(self.backup_instance_log, [i])
+                del self.processes[pid]
+                # Anything left in the group was orphaned by the instance.
+                orphans = group_pids(pid)
+                if orphans:
+                    self.log.info("Killing processes orphaned by %s: %s" %
+                        (p.instance, orphans))
+                    self.terminate(pid)
+                else:
+                    self.dying.pop(pid, None)
+    
+    def enforce_timeouts(self):
+        """Kills the process group of any instance past its deadline.
+        
+        Instances time themselves out with an alarm, but that won't fire
+        while blocked in C code and can be ignored, so the executor gives
+        them TIMEOUT_GRACE more seconds before stepping in.
+        
+        """
+        now = time.time()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, pid = heapq.heappop(self.deadlines)
+            p = self.processes.get(pid)
+            # The pid may have been reaped, or even reused, since.
+            if p and p.deadline == deadline:
+                self.log.info("%s overran its timeout; killing it." %
+                    p.instance)
+                p.timed_out = True
+                self.terminate(pid)
+    
+    def publish(self):
+        """Updates the slots in use and instances held.
+        
+        The heart saves them along with the heartbeat, except for
+        supervised executors, which save them here when they change, at
+        most once per HEARTBEAT_PERIOD.
+        
+        """
+        self.running, self.held = len(self.processes), len(self.prefetched)
+        if self.supervised and time.time() >= self.next_publish and \
+            (self.running, self.held) != self.published:
+            self.next_publish = time.time() + HEARTBEAT_PERIOD
+            self.published = (self.running, self.held)
+            Executor.objects.filter(pk=self.pk).update(
+                running=self.running, held=self.held)
+    
+    def speculate(self):
+        """Handles the speculative execution of idempotent instances.
+        
+        Stragglers, which have run SPECULATION_FACTOR times their task's
+        usual duration, are copied back onto their queue for another
+        executor to run.  Processes whose instance has been settled by
+        another copy are killed; the grace of a period lets a process
+        that settled its own instance exit normally.
+        
+        """
+        now = time.time()
+        self.next_speculate = now + SPECULATION_PERIOD
+        by_model = {}
+        for p in self.processes.values():
+            if p.idempotent and not p.pid in self.dying:
+                by_model.setdefault(type(p.instance), []).append(p)
+        for model, ps in by_model.iteritems():
+            settled = set(model.objects.filter(
+                pk__in=[p.instance.pk for p in ps],
+                status__in=Status.GROUPS("final")).values_list(
+                'pk', flat=True))
+            for p in ps:
+                if p.instance.pk in settled:
+                    if p.settled == None:
+                        p.settled = now
+                    elif now - p.settled >= SPECULATION_PERIOD:
+                        self.log.info("Another copy of %s finished first; "
+                            "killing it." % p.instance)
+                        self.terminate(p.pid)
+                elif p.speculate_at and now >= p.speculate_at and \
+                    self.status == Status.RUNNING:
+                    p.speculate_at = None
+                    self.duplicate(p)
+    
+    def duplicate(self, p):
+        """Queues a copy of a straggling instance for another executor."""
+        others = Executor.objects.for_queue(p.queue).alive().exclude(
+            pk=self.pk)
+        if others.count() == 0:
+            self.log.debug("No other executor to run a copy of %s." %
+                p.instance)
+            return
+        copy = p.instance.duplicate()
+        p.queue.push(copy)
+        self.log.info("%s is straggling; queued %s to race it." %
+            (p.instance, copy))
+    
+    def terminate(self, pgid):
+        """Sends SIGTERM to a process group, escalating later if needed."""
+        if kill_group(pgid, signal.SIGTERM):
+            self.dying.setdefault(pgid, time.time() + KILL_GRACE)
+    
+    def escalate(self):
+        """Sends SIGKILL to groups that outlived their grace period.
+        
+        Groups are checked once more a period after SIGKILL; anything still
+        alive then (usually stuck in uninterruptible sleep) is reported and
+        forgotten.  Returns the PIDs reported.
+        
+        """
+        leftovers = []
+        now = time.time()
+        for pgid, deadline in self.dying.items():
+            pids = group_pids(pgid)
+            if pids == []:
+                del self.dying[pgid]
+            elif deadline == None:
+                if pids:
+                    self.log.error("Processes in group %s survived "
+                        "SIGKILL: %s" % (pgid, pids))
+                    leftovers.extend(pids)
+                del self.dying[pgid]
+            elif deadline <= now:
+                self.log.info("Process group %s ignored SIGTERM; "
+                    "sending SIGKILL." % pgid)
+                kill_group(pgid, signal.SIGKILL)
+                self.dying[pgid] = None
+        return leftovers
+    
+    def kill_all(self):
+        """Kills every instance's process group and reaps the leaders.
+        
+        Blocks for a little over KILL_GRACE while the groups are sent
+        SIGTERM, then SIGKILL if need be.  Returns any PIDs that survived.
+        
+        """
+        for pid, p in self.processes.iteritems():
+            self.log.info("Killing process group for %s." % p.instance)
+            self.terminate(pid)
+        leftovers = []
+        deadline = time.time() + KILL_GRACE + 2
+        while (self.processes or self.dying) and time.time() < deadline:
+            time.sleep(0.1)
+            self.reap()
+            leftovers.extend(self.escalate())
+        if self.processes:
+            self.log.error("Failed to reap processes: %s" %
+                self.processes.keys())
+        return leftovers
     
     def clean_up(self):
+        self.release_prefetched()
+        self.running = self.held = 0
         if settings.BACKUP_SYSTEM:
-            self.pool.joinAll()
+            self.pool.join()
     
     def report_resources(self):
         while not Status.is_final(self.status):
@@ -163,19 +452,415 @@ class Executor(AbstractDaemon):
             self.log.debug(rself)
             rchildren = resource.getrusage(resource.RUSAGE_CHILDREN)
             self.log.debug(rchildren)
+            if settings.BACKUP_SYSTEM:
+                self.log.debug("Backup pool: %s" % self.pool.stats())
+    
+    def record_usage(self, p, usage):
+        """Saves the rusage of a reaped process on its instances.
+        
+        The usage of a batch is shared evenly among its instances, except
+        for max RSS, which they all get.
+        
+        """
+        n = len(p.batch)
+        type(p.instance).objects.filter(
+            pk__in=[i.pk for i in p.batch]).update(
+            cpu_user=usage.ru_utime / n,
+            cpu_system=usage.ru_stime / n,
+            max_rss=usage.ru_maxrss,
+            block_in=usage.ru_inblock // n,
+            block_out=usage.ru_oublock // n,
+            wall_time=(time.time() - p.launched) / n)
+    
+    def adapt_concurrency(self):
+        """Samples the host and saves any change to concurrent."""
+        self.next_adapt = time.time() + ADAPT_PERIOD
+        sample = self.monitor.sample()
+        self.log.debug("Host sample: %s" % sample)
+        concurrent = self.concurrency_for(sample)
+        if concurrent != self.concurrent:
+            self.log.info("Changing concurrency from %s to %s." %
+                (self.concurrent, concurrent))
+            self.concurrent = concurrent
+            self.save(safe=True)
+    
+    def concurrency_for(self, sample):
+        """The concurrency this executor should have given a host sample.
+        
+        Concurrency is lowered by one if the host is under any pressure,
+        and raised by one only if every slot is in use and the host is
+        comfortably idle.  Missing measurements are ignored.
+        
+        """
+        load, memory, iowait = \
+            sample.get('load'), sample.get('memory'), sample.get('iowait')
+        concurrent = self.concurrent
+        if load == memory == iowait == None:
+            return concurrent
+        if (load != None and load > LOAD_HIGH) or \
+            (memory != None and memory < MEMORY_LOW) or \
+            (iowait != None and iowait > IOWAIT_HIGH):
+            concurrent -= 1
+        elif len(self.processes) >= self.concurrent and \
+            (load == None or load < LOAD_LOW) and \
+            (memory == None or memory > MEMORY_HIGH) and \
+            (iowait == None or iowait < IOWAIT_LOW):
+            concurrent += 1
+        return max(self.min_concurrent, min(self.max_concurrent, concurrent))
+    
+    @staticmethod
+    def requirements(instance):
+        """The (cpu units, memory MB) an instance needs to run."""
+        task = instance.task
+        return task.cpu_units, task.memory_mb
+    
+    def available(self):
+        """The (cpu units, memory MB) not in use; None is unlimited."""
+        cpu, memory = self.cpu_capacity, self.memory_capacity
+        if cpu != None:
+            cpu -= sum(p.cpu for p in self.processes.values())
+        if memory != None:
+            memory -= sum(p.memory for p in self.processes.values())
+        return cpu, memory
+    
+    def fits(self, instance, capacity):
+        """Whether instance fits in the given (cpu, memory) capacity."""
+        return all(c == None or r <= c
+            for r, c in zip(self.requirements(instance), capacity))
+    
+    def fill(self):
+        """Starts instances in free slots and refills the prefetch window.
+        
+        Instances are started in the order they were popped.  If the next
+        one doesn't fit in the remaining capacity it is held (and blocks
+        those behind it) until enough capacity frees up; one that could
+        never fit is given up with reject().  Copies of instances this
+        executor is running are set aside and returned to their queue at
+        the end, for another executor to run.
+        
+        """
+        empty, others = set(), []
+        while len(self.processes) < self.concurrent:
+            if not self.prefetched:
+                # self.log.debug("Popping instance...")
+                queue, instance = self.pop(empty)
+                if not instance:
+                    # self.log.debug("No instance in queue.")
+                    break
+                # self.log.debug("Popped %s" % instance)
+                self.prefetched.append([queue, instance, None])
+            queue, instance, leased = self.prefetched[0]
+            if not self.fits(instance,
+                (self.cpu_capacity, self.memory_capacity)):
+                self.reject(self.prefetched.popleft(), empty)
+                continue
+            if not self.fits(instance, self.available()):
+                # Hold on to it until enough capacity frees up.
+                if not leased:
+                    self.lease(self.prefetched[0])
+                break
+            entry = self.prefetched.popleft()
+            if self.races(instance):
+                others.append(entry)
+                continue
+            if leased and not self.unlease(instance, self):
+                # Reclaimed by another executor after the lease lapsed.
+                continue
+            self.start_instance(instance, queue, self.gather(queue, instance))
+        while len(self.prefetched) < self.prefetch:
+            queue, instance = self.pop(empty)
+            if not instance:
+                break
+            entry = [queue, instance, None]
+            if self.races(instance):
+                others.append(entry)
+                continue
+            self.lease(entry)
+            self.prefetched.append(entry)
+        for entry in others:
+            self.return_instance(*entry)
+    
+    def reject(self, entry, empty):
+        """Gives up a prefetched instance too big to ever run here.
+        
+        If a live executor drawing from its queue is big enough, it goes
+        back to the queue and the queue is skipped for the rest of the
+        pass.  Otherwise nothing can run it, so it errors.
+        
+        """
+        queue, instance, leased = entry
+        if any(self.fits(instance, (e.cpu_capacity, e.memory_capacity))
+            for e in Executor.objects.alive().for_queue(queue)):
+            self.return_instance(*entry)
+            empty.update([eq for eq in self.queues if eq.queue == queue])
+            return
+        if leased and not self.unlease(instance):
+            return
+        self.log.error("%s can't fit on any executor for %s." %
+            (instance, queue))
+        instance.status = Status.ERROR
+        instance.ended = datetime.utcnow()
+        instance.save()
+    
+    def races(self, instance):
+        """Whether instance is a copy of one this executor is running.
+        
+        A copy is no use on the executor that is straggling.
+        
+        """
+        return instance.duplicate_of_id != None and \
+            instance.duplicate_of.executor_id == self.id
+    
+    @staticmethod
+    def batch_key(instance):
+        """Instances with the same key may be run in one batch."""
+        return (type(instance), type(instance.task), instance.task.pk)
     
-    def start_instance(self, instance):
-        """Starts a given instance in a new process."""
+    def gather(self, queue, instance):
+        """Collects instances to run in a batch with the given one.
+        
+        Instances of the same task are taken first from those prefetched,
+        then popped from the instance's queue up to the task's batch_size.
+        Popping stops at the first instance of another task, which is
+        held as if prefetched.  Returns a list of (queue, instance).
+        
+        """
+        size = instance.task.batch_size
+        if size <= 1 or instance.duplicate_of_id:
+            return []
+        key = Executor.batch_key(instance)
+        batch = []
+        for entry in list(self.prefetched):
+            if len(batch) >= size - 1:
+                break
+            if Executor.batch_key(entry[1]) == key and \
+                not entry[1].duplicate_of_id:
+                self.prefetched.remove(entry)
+                if not entry[2] or self.unlease(entry[1], self):
+                    batch.append((entry[0], entry[1]))
+        while len(batch) < size - 1:
+            other = queue.pop()
+            if not other:
+                break
+            if Executor.batch_key(other) != key or other.duplicate_of_id:
+                entry = [queue, other, None]
+                self.lease(entry)
+                self.prefetched.append(entry)
+                break
+            batch.append((queue, other))
+        return batch
+    
+    def lease(self, entry):
+        """Marks a prefetched instance as held by this executor."""
+        queue, instance = entry[:2]
         instance.executor = self
+        instance.queue = queue
+        instance.leased = datetime.utcnow()
         instance.save()
-        self.log.info("Starting instance '%s'..." % instance)
+        entry[2] = time.time()
+    
+    def unlease(self, instance, executor=None):
+        """Ends this executor's lease on an instance, passing it on.
+        
+        Returns False if the lease was already reclaimed by another
+        executor, in which case the instance is no longer ours.
+        
+        """
+        updated = type(instance).objects.filter(pk=instance.pk,
+            executor=self.pk, leased__isnull=False,
+            status=Status.CREATED).update(executor=executor, leased=None)
+        instance.executor, instance.leased = executor, None
+        return updated == 1
+    
+    def reclaim_leases(self):
+        """Returns lapsed leases on this executor's queues to the queues.
+        
+        A lease lapses PREFETCH_LEASE seconds after it was taken, or as
+        soon as the executor holding it dies.  Executors return their own
+        lapsed leases (see expire_leases), but one that crashed can't, so
+        every executor looks after the queues it draws from.
+        
+        """
+        self.next_reclaim = time.time() + RECLAIM_PERIOD
+        cutoff = datetime.utcnow() - timedelta(seconds=PREFETCH_LEASE)
+        alive = Executor.objects.alive()
+        for eq in self.queues:
+            for model in INSTANCE_MODELS:
+                lapsed = model.objects.from_queue(eq.queue).filter(
+                    status=Status.CREATED, leased__isnull=False).exclude(
+                    executor=self.pk).filter(
+                    Q(leased__lt=cutoff) | ~Q(executor__in=alive))
+                for instance in lapsed:
+                    # Its holder may start or return it in the meantime.
+                    if model.objects.filter(pk=instance.pk,
+                        executor=instance.executor_id,
+                        leased=instance.leased).update(
+                        executor=None, leased=None):
+                        self.log.info("Reclaiming %s from executor #%s." %
+                            (instance, instance.executor_id))
+                        instance.executor, instance.leased = None, None
+                        eq.queue.push(instance)
+    
+    def expire_leases(self):
+        """Returns instances held longer than PREFETCH_LEASE seconds."""
+        cutoff = time.time() - PREFETCH_LEASE
+        for entry in list(self.prefetched):
+            if entry[2] and entry[2] < cutoff:
+                self.log.info("Lease on %s expired." % entry[1])
+                self.prefetched.remove(entry)
+                self.return_instance(*entry)
+    
+    def return_instance(self, queue, instance, leased=None):
+        """Gives up a popped instance by pushing it back onto its queue."""
+        if leased and not self.unlease(instance):
+            self.log.info("%s was reclaimed from us." % instance)
+            return
+        if instance.executor_id or instance.leased:
+            instance.executor, instance.leased = None, None
+            instance.save()
+        self.log.info("Returning %s to %s." % (instance, queue))
+        queue.push(instance)
+    
+    def release_prefetched(self):
+        """Returns all prefetched instances to their queues."""
+        while self.prefetched:
+            self.return_instance(*self.prefetched.popleft())
+    
+    def add_queue(self, queue, weight=1, priority=0):
+        """Adds a queue for this executor to draw from."""
+        return ExecutorQueue.objects.create(executor=self, queue=queue,
+            weight=weight, priority=priority)
+    
+    def load_queues(self):
+        """Retrieves the queues to draw from, including the primary queue.
+        
+        Executors created without any ExecutorQueues simply draw from
+        their primary queue; a row is made for it so that for_queue()
+        and the reports see it like any other.
+        
+        """
+        queues = list(self.executor_queues.all())
+        if not queues:
+            queues = [self.add_queue(self.queue)]
+        for eq in queues:
+            eq.current = 0
+        return queues
+    
+    def pop(self, empty):
+        """Pops the next instance from this executor's queues.
+        
+        Queues are tried in priority order.  Queues of equal priority
+        share pops in proportion to their weights, using smooth weighted
+        round-robin.  Queues found empty are added to the empty set and
+        skipped on later calls with the same set.  Returns a tuple of
+        the queue and the instance, or (None, None) if all are empty.
+        
+        """
+        priorities = sorted(set(eq.priority for eq in self.queues))
+        for priority in priorities:
+            candidates = [eq for eq in self.queues
+                if eq.priority == priority and not eq in empty]
+            while candidates:
+                total = sum(eq.weight for eq in candidates)
+                for eq in candidates:
+                    eq.current += eq.weight
+                chosen = max(candidates, key=lambda eq: eq.current)
+                chosen.current -= total
+                instance = chosen.queue.pop()
+                if instance:
+                    return chosen.queue, instance
+                empty.add(chosen)
+                candidates.remove(chosen)
+        return None, None
+    
+    @staticmethod
+    def isolation(instance, count=1):
+        """Returns a function that applies a task's limits to a process.
+        
+        The function is meant to be run in the child between fork and
+        exec, so everything it needs is read from the task beforehand.
+        count is the number of instances the process will run, which
+        the CPU time limit is scaled by.
+        
+        """
+        task = instance.task
+        memory, cpu_time = task.memory_limit, task.cpu_time_limit * count
+        cpus = parse_cpu_list(task.cpu_affinity)
+        io_class, io_priority = task.io_class, task.io_priority
+        def isolate():
+            # Give the instance its own session and process group so that
+            # it and all of its descendants can be signalled together.
+            os.setsid()
+            if memory:
+                size = memory * 1024 * 1024
+                resource.setrlimit(resource.RLIMIT_AS, (size, size))
+            if cpu_time:
+                # SIGXCPU at the soft limit lets the instance record that
+                # it timed out before the hard limit kills it.
+                resource.setrlimit(resource.RLIMIT_CPU,
+                    (cpu_time, cpu_time + 5))
+            if cpus:
+                set_affinity(cpus)
+            if io_class:
+                set_io_priority(io_class, io_priority)
+        return isolate
+    
+    def start_instance(self, instance, queue=None, batch=()):
+        """Starts a given instance in a new process.
+        
+        batch is a list of (queue, instance) for more instances of the
+        same task to run one after another in the same process.
+        
+        """
+        if instance.duplicate_of_id and Status.is_final(
+            type(instance).objects.get(pk=instance.pk).status):
+            self.log.info("Skipping %s; it has been superseded." % instance)
+            return
+        instances = [(queue or self.queue, instance)] + list(batch)
+        for q, i in instances:
+            i.executor = self
+            i.queue = q
+            i.save()
+        instances = [i for q, i in instances]
+        if batch:
+            self.log.info("Starting a batch of %s instances: %s" %
+                (len(instances), instances))
+        else:
+            self.log.info("Starting instance '%s'..." % instance)
         # p = Process(target=self.execute, args=[instance.start])
         # p.start()
         ct = ContentType.objects.get_for_model(instance)
-        p = Popen('norc_taskrunner --ct_pk %s --target_pk %s' %
-            (ct.pk, instance.pk), shell=True)
-        p.instance = instance
+        try:
+            # Exec directly so that the pid is the taskrunner's own.
+            p = Popen(['norc_taskrunner', '--ct_pk', str(ct.pk),
+                '--target_pk', ','.join([str(i.pk) for i in instances])],
+                preexec_fn=self.isolation(instance, len(instances)))
+        except Exception:
+            # Most likely a bad limit on the task; don't take the
+            # executor down with it.
+            self.log.error("Failed to start %s!" % instance, trace=True)
+            for i in instances:
+                i.status = Status.ERROR
+                i.ended = datetime.utcnow()
+                i.save()
+            return
+        p.instance, p.batch = instance, instances
+        p.launched = time.time()
+        p.cpu, p.memory = self.requirements(instance)
+        p.queue = instance.queue
+        # Only lone instances are run speculatively.
+        p.idempotent = instance.task.idempotent and not batch
+        p.speculate_at = p.settled = None
+        if p.idempotent and not instance.duplicate_of_id:
+            expected = instance.expected_duration()
+            if expected != None:
+                p.speculate_at = p.launched + expected * SPECULATION_FACTOR
         self.processes[p.pid] = p
+        p.deadline = None
+        if instance.timeout > 0:
+            p.deadline = p.launched + TIMEOUT_GRACE + \
+                instance.timeout * len(instances)
+            heapq.heappush(self.deadlines, (p.deadline, p.pid))
     
     # This should be used in 2.6, but with subprocess it's not possible.
     # def execute(self, func):
@@ -191,12 +876,16 @@ class Executor(AbstractDaemon):
         # Clear request immediately.
         request = self.request
         self.request = None
+        if request == Request.RELOAD:
+            # Pick up the new settings before saving over them.
+            self.concurrent = Executor.objects.get(pk=self.pk).concurrent
         self.save()
         
         self.log.info("Request received: %s" % Request.name(request))
         
         if request == Request.PAUSE:
             self.set_status(Status.PAUSED)
+            self.release_prefetched()
         
         elif request == Request.RESUME:
             if self.status != Status.PAUSED:
@@ -206,14 +895,41 @@ class Executor(AbstractDaemon):
         
         elif request == Request.STOP:
             self.set_status(Status.STOPPING)
+            self.release_prefetched()
         
         elif request == Request.KILL:
-            # for p in self.processes.values():
-            #     p.terminate()
-            for pid, p in self.processes.iteritems():
-                self.log.info("Killing process for %s." % p.instance)
-                os.kill(pid, signal.SIGTERM)
+            self.release_prefetched()
+            self.kill_all()
             self.set_status(Status.KILLED)
+        
+        elif request == Request.RELOAD:
+            self.log.info("Concurrency is now %s." % self.concurrent)
+    
+    def save(self, *args, **kwargs):
+        """Overwrites AbstractDaemon.save().
+        
+        A safe save also keeps the concurrency waiting to be reloaded, so
+        that the heart doesn't overwrite it first.  The heartbeat of a
+        supervised executor is beaten by its supervisor, so it is only
+        written if it's newer than the one saved.
+        
+        """
+        if kwargs.pop('safe', False):
+            current = Executor.objects.get(id=self.id)
+            self.request = current.request
+            if self.request == Request.RELOAD:
+                self.concurrent = current.concurrent
+        if self.supervised and self.pk:
+            executor = Executor.objects.filter(pk=self.pk)
+            executor.update(**dict([(f.name, getattr(self, f.attname))
+                for f in self._meta.local_fields
+                if not f.primary_key and f.name != 'heartbeat']))
+            if self.heartbeat:
+                executor.filter(Q(heartbeat__isnull=True) |
+                    Q(heartbeat__lt=self.heartbeat)).update(
+                    heartbeat=self.heartbeat)
+            return
+        return Model.save(self, *args, **kwargs)
     
     def backup_instance_log(self, instance):
         self.log.info("Attempting upload of log for %s..." % instance)
@@ -231,3 +947,35 @@ class Executor(AbstractDaemon):
     
     __repr__ = __unicode__
     
+
+class ExecutorQueue(Model):
+    """A queue that an Executor draws from, and how heavily.
+    
+    An executor drains queues in order of increasing priority, moving on
+    to the next priority only when every queue before it is empty.
+    Queues of equal priority share the executor according to weight.
+    
+    """
+    class Meta:
+        app_label = 'core'
+        db_table = 'norc_executorqueue'
+        ordering = ['priority', 'id']
+    
+    executor = ForeignKey(Executor, related_name='executor_queues')
+    
+    queue_type = ForeignKey(ContentType)
+    queue_id = PositiveIntegerField()
+    queue = GenericForeignKey('queue_type', 'queue_id')
+    
+    # Relative share of pops among queues with the same priority.
+    weight = PositiveIntegerField(default=1)
+    
+    # Lower numbers are drained first.
+    priority = PositiveIntegerField(default=0)
+    
+    def __unicode__(self):
+        return u"%s (weight %s, priority %s)" % \
+            (self.queue, self.weight, self.priority)
+    
+    __repr__ = __unicode__
+    
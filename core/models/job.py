@@ -35,12 +35,14 @@ class Job(Task):
                 instance.schedule.queue.push(node_instance)
         while True:
             complete = True
-            for ni in instance.nodis.all():
+            # Speculative duplicates are settled through their originals.
+            nodis = instance.nodis.filter(duplicate_of=None)
+            for ni in nodis:
                 if not Status.is_final(ni.status):
                     complete = False
                 elif Status.is_failure(ni.status):
                     return False
-            if complete and instance.nodis.count() == self.nodes.count():
+            if complete and nodis.count() == self.nodes.count():
                 return True
             time.sleep(1)
     
@@ -79,21 +81,26 @@ class JobNodeInstance(AbstractInstance):
     # The JobInstance that this NodeInstance belongs to.
     job_instance = ForeignKey(Instance, related_name='nodis')
     
-    def start(self):
+    def start(self, exit=True):
         try:
-            AbstractInstance.start(self)
+            AbstractInstance.start(self, exit)
         finally:
             ji = self.job_instance
-            if not Status.is_failure(self.status):
+            # A superseded copy leaves this to the copy that won.
+            if not Status.is_failure(self.status) and \
+                self.status != Status.SUPERSEDED:
                 for sub_dep in self.node.sub_deps.all():
                     sub_node = sub_dep.child
-                    ni = sub_node.nis.get(job_instance=ji)
+                    ni = sub_node.nis.get(job_instance=ji, duplicate_of=None)
                     if ni.can_run():
                         self.job_instance.schedule.queue.push(ni)
     
     def run(self):
         self.node.task.run()
     
+    def peers(self):
+        return JobNodeInstance.objects.filter(node=self.node_id)
+    
     @property
     def timeout(self):
         return self.node.task.timeout
@@ -114,7 +121,8 @@ class JobNodeInstance(AbstractInstance):
     def can_run(self):
         """Whether dependencies are met for this instance to run."""
         for dep in self.node.super_deps.all():
-            ni = dep.parent.nis.get(job_instance=self.job_instance)
+            ni = dep.parent.nis.get(job_instance=self.job_instance,
+                duplicate_of=None)
             if ni.status != Status.SUCCESS:
                 return False
         return True
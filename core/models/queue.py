@@ -14,7 +14,7 @@ from django.contrib.contenttypes.generic import (GenericRelation,
                                                  GenericForeignKey)
 
 from norc.core import TimedoutException
-from norc.norc_utils.django_extras import queryset_exists
+from norc.norc_utils.django_extras import queryset_exists, insert_many
 
 from django.db.models.base import ModelBase
 
@@ -70,6 +70,11 @@ class Queue(Model):
     def push(self, item):
         raise NotImplementedError
     
+    def push_many(self, items):
+        """Adds several items.  Implementations can do this in bulk."""
+        for item in items:
+            self.push(item)
+    
     def count(self):
         raise NotImplementedError
     
@@ -115,6 +120,11 @@ class DBQueue(Queue):
         """Adds an item to the queue."""
         DBQueueItem.objects.create(dbqueue=self, item=item)
     
+    def push_many(self, items):
+        """Adds several items with one insert."""
+        insert_many(DBQueueItem,
+            [DBQueueItem(dbqueue=self, item=item) for item in items])
+    
     def count(self):
         return self.items.count()
 
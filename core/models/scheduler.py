@@ -13,24 +13,30 @@ import time
 from datetime import datetime, timedelta
 from threading import Thread, Event
 import itertools
+from uuid import uuid4
 
 # from django.db.models.query import QuerySet
-from django.db.models import (Model, Manager,
+from django.db.models import (Model, Manager, F, Q,
     BooleanField,
     CharField,
     DateTimeField,
     PositiveSmallIntegerField)
 
+from django.contrib.contenttypes.models import ContentType
+
 from norc import settings
 from norc.core.models.task import Instance
 from norc.core.models.schedules import Schedule, CronSchedule
 from norc.core.models.daemon import AbstractDaemon
 from norc.core.constants import (Status, Request,
-    SCHEDULER_PERIOD, SCHEDULER_LIMIT, HEARTBEAT_PERIOD, HEARTBEAT_FAILED)
+    SCHEDULER_PERIOD, SCHEDULER_LIMIT, SCHEDULER_RESCAN, SCHEDULER_THREADS,
+    SCHEDULER_BATCH, SCHEDULER_HORIZON,
+    HEARTBEAT_PERIOD, HEARTBEAT_FAILED)
 from norc.norc_utils import search
-from norc.norc_utils.parallel import MultiTimer
+from norc.norc_utils.parallel import MultiTimer, TimingWheel, ThreadPool
 from norc.norc_utils.log import make_log
 from norc.norc_utils.django_extras import queryset_exists, get_object
+from norc.norc_utils.django_extras import insert_many, update_grouped
 from norc.norc_utils.django_extras import QuerySetManager, MultiQuerySet
 from norc.norc_utils.backup import backup_log
 
@@ -41,6 +47,14 @@ class Scheduler(AbstractDaemon):
     instance to a timer.  At the appropriate time, the instance is
     added to its queue and the Schedule is updated.
     
+    Only schedules due within SCHEDULER_HORIZON seconds are claimed, and
+    a schedule is let go again when its next run falls beyond that.
+    
+    Several schedulers can run at once.  Each alive scheduler owns the
+    schedules whose ids fall in its shard, taken by id modulo the number
+    of schedulers.  When one joins or dies, the others release schedules
+    that left their shard and claim the ones that entered it.
+    
     Idea: Split this up into two threads, one which continuously handles
     already claimed schedules, the other which periodically polls the DB
     for new schedules.
@@ -85,20 +99,27 @@ class Scheduler(AbstractDaemon):
     request = PositiveSmallIntegerField(null=True,
         choices=[(r, Request.name(r)) for r in VALID_REQUESTS])
     
+    # Timer implementations, chosen by the SCHEDULER_TIMER setting.
+    TIMERS = {
+        'heap': MultiTimer,
+        'wheel': TimingWheel,
+    }
+    
     def __init__(self, *args, **kwargs):
         AbstractDaemon.__init__(self, *args, **kwargs)
-        self.timer = MultiTimer()
-    
-    def start(self):
-        """Starts the Scheduler."""
-        # Temporary check until multiple schedulers is supported fully.
-        if Scheduler.objects.alive().count() > 0:
-            print "Cannot run more than one scheduler at a time."
-            return
-        AbstractDaemon.start(self)
+        self.timer = Scheduler.TIMERS[settings.SCHEDULER_TIMER](
+            dispatch=self.dispatch)
+        self.pool = None
+        # Ids of the alive schedulers the schedules are sharded among.
+        self.members = []
+        # The highest schedule id looked at so far for each model.
+        self.high_water = {CronSchedule: 0, Schedule: 0}
+        self.next_rescan = 0
     
     def run(self):
         """Main run loop of the Scheduler."""
+        self.pool = ThreadPool(SCHEDULER_THREADS,
+            max_queued=SCHEDULER_THREADS * 2)
         self.timer.start()
         
         while not Status.is_final(self.status):
@@ -106,37 +127,115 @@ class Scheduler(AbstractDaemon):
                 self.handle_request()
             
             if self.status == Status.RUNNING:
-                # Clean up orphaned schedules and undead schedulers.
-                # Schedule.objects.orphaned().update(scheduler=None)
-                # CronSchedule.objects.orphaned().update(scheduler=None)
-                
-                cron = CronSchedule.objects.unclaimed()[:SCHEDULER_LIMIT]
-                simple = Schedule.objects.unclaimed()[:SCHEDULER_LIMIT]
-                for schedule in itertools.chain(cron, simple):
-                    self.log.info('Claiming %s.' % schedule)
-                    schedule.scheduler = self
-                    schedule.save()
-                    self.add(schedule)
+                members = self.get_members()
+                if members != self.members:
+                    self.rebalance(members)
+                    self.next_rescan = 0
+                now = time.time()
+                if now >= self.next_rescan:
+                    self.next_rescan = now + SCHEDULER_RESCAN
+                    self.claim(full=True)
+                else:
+                    self.claim()
             
             if not Status.is_final(self.status):
                 self.wait()
                 self.request = Scheduler.objects.get(pk=self.pk).request
+    
+    def get_members(self):
+        """Sorted ids of the alive schedulers, including this one."""
+        members = list(Scheduler.objects.alive().order_by('id').values_list(
+            'id', flat=True))
+        if not self.id in members:
+            members = sorted(members + [self.id])
+        return members
+    
+    @property
+    def shard(self):
+        """The index of this scheduler's shard and the number of shards."""
+        return self.members.index(self.id), len(self.members)
+    
+    def rebalance(self, members):
+        """Releases claimed schedules that now belong to another shard."""
+        self.log.info("Sharding schedules among schedulers %s." % members)
+        self.members = members
+        index, count = self.shard
+        released = [(model, pk) for model, pk in self.timer.keys()
+            if pk % count != index]
+        for key in released:
+            self.timer.cancel_task(key)
+        for model in [CronSchedule, Schedule]:
+            pks = [pk for m, pk in released if m == model]
+            if pks:
+                model.objects.filter(pk__in=pks, scheduler=self).update(
+                    scheduler=None)
+        if released:
+            self.log.info("Released %s schedules." % len(released))
+    
+    def claim(self, full=False):
+        """Claims unclaimed and orphaned schedules in this shard.
         
-        cron = self.cronschedules.all()
-        simple = self.schedules.all()
-        claimed_count = cron.count() + simple.count()
-        if claimed_count > 0:
-            self.log.info('Cleaning up %s schedules.' % claimed_count)
-            cron.update(scheduler=None)
-            simple.update(scheduler=None)
+        Only schedules due within the horizon are claimed.  Unless full is
+        True, only unclaimed ones and ones newer than any seen before are
+        looked for, leaving those orphaned by dead schedulers to full
+        rescans.  Unclaimed ones have to be included: peers release the
+        schedules that fall in this shard on their own passes, after this
+        scheduler's full claim on joining.
+        Each kind of schedule takes one query to find them, one to claim
+        them all and one to load the ones claimed.
+        
+        """
+        index, count = self.shard
+        horizon = datetime.utcnow() + timedelta(seconds=SCHEDULER_HORIZON)
+        for model in [CronSchedule, Schedule]:
+            found = model.objects.claimable(self.members).due_by(
+                horizon).shard(index, count)
+            if not full:
+                found = found.filter(Q(pk__gt=self.high_water[model]) |
+                    Q(scheduler__isnull=True))
+            pks = list(found.order_by('id').values_list('id',
+                flat=True)[:SCHEDULER_LIMIT])
+            if not pks:
+                continue
+            self.high_water[model] = max(self.high_water[model], pks[-1])
+            # Another scheduler may have claimed some in the meantime.
+            claimed = model.objects.claimable(self.members).due_by(
+                horizon).filter(pk__in=pks).update(scheduler=self)
+            if claimed > 0:
+                self.log.info('Claiming %s %ss.' % (claimed, model.__name__))
+                # Only the stored next runs are needed, not whole
+                # schedules; those not stored yet are worked out.
+                rows = list(model.objects.filter(pk__in=pks,
+                    scheduler=self).values_list('id', 'next'))
+                missing = [pk for pk, next in rows if next == None]
+                loaded = missing and model.objects.in_bulk(missing) or {}
+                for pk, next in rows:
+                    if next == None:
+                        next = loaded[pk].next
+                    self.add_key((model, pk), next)
     
     def wait(self):
         """Waits on the flag."""
         AbstractDaemon.wait(self, SCHEDULER_PERIOD)
     
     def clean_up(self):
+        """Stops enqueueing, then releases all claimed schedules.
+        
+        The pool is joined first so that enqueues still in flight can't
+        claim their schedules again after they've been released.
+        
+        """
         self.timer.cancel()
         self.timer.join()
+        if self.pool:
+            self.pool.join()
+        cron = self.cronschedules.all()
+        simple = self.schedules.all()
+        claimed_count = cron.count() + simple.count()
+        if claimed_count > 0:
+            self.log.info('Cleaning up %s schedules.' % claimed_count)
+            cron.update(scheduler=None)
+            simple.update(scheduler=None)
     
     def handle_request(self):
         """Called when a request is found."""
@@ -167,44 +266,115 @@ class Scheduler(AbstractDaemon):
             changed = MultiQuerySet(Schedule, CronSchedule)
             changed = changed.objects.unfinished.filter(
                 changed=True, scheduler=self)
-            for item in self.timer.tasks:
-                s = item[2][0]
-                if s in changed:
-                    self.log.info("Removing outdated: %s" % s)
-                    self.timer.tasks.remove(item)
-                s = type(s).objects.get(pk=s.pk)
             for s in changed:
-                self.log.info("Adding updated: %s" % s)
+                # Replaces the outdated timer task, if there is one.
+                self.log.info("Reloading %s." % s)
                 self.add(s)
             changed.update(changed=False)
     
     def add(self, schedule):
         """Adds the schedule to the timer."""
-        self.log.debug('Adding %s to timer for %s.' %
-            (schedule, schedule.next))
-        self.timer.add_task(schedule.next, self._enqueue, [schedule])
+        self.add_key((type(schedule), schedule.pk), schedule.next)
     
-    def _enqueue(self, schedule):
+    def add_key(self, key, next):
+        """Adds the schedule with key (its model and pk) to the timer.
+        
+        Only the key is kept; the schedule is loaded when it's due.
+        
+        """
+        self.log.debug('Adding %s #%s to timer for %s.' %
+            (key[0].__name__, key[1], next))
+        self.timer.add_task(next, self._enqueue, key, key=key)
+    
+    def dispatch(self, calls):
+        """Hands timer tasks that came due together to the pool.
+        
+        They're split into groups of up to SCHEDULER_BATCH per pool task.
+        Once the pool's queue is full, this blocks the timer until there
+        is room rather than letting work pile up.
+        
+        """
+        keys = [args for func, args, kwargs in calls]
+        for i in range(0, len(keys), SCHEDULER_BATCH):
+            self.pool.submit(self._enqueue_many, [keys[i:i + SCHEDULER_BATCH]])
+    
+    def _enqueue(self, model, pk):
         """Called by the timer to add an instance to the queue."""
-        updated_schedule = get_object(type(schedule), pk=schedule.pk)
-        if updated_schedule == None or updated_schedule.deleted:
-            self.log.info('%s was removed.' % schedule)
-            return
-        schedule = updated_schedule
+        self._enqueue_many([(model, pk)])
+    
+    def _enqueue_many(self, keys):
+        """Enqueues instances for the due schedules with the given keys."""
+        for model in [CronSchedule, Schedule]:
+            pks = [pk for m, pk in keys if m == model]
+            if pks:
+                try:
+                    self.enqueue(model, pks)
+                except Exception:
+                    self.log.error("Failed to enqueue %ss %s." %
+                        (model.__name__, pks), trace=True)
+    
+    def enqueue(self, model, pks):
+        """Enqueues an instance for each due schedule of model in pks.
         
-        if not schedule.scheduler == self:
-            self.log.info("%s is no longer tied to this scheduler.")
+        However many schedules there are, the instances are created with
+        one insert, each queue gets one push_many(), and the schedules
+        are updated with a query per distinct set of new values.
+        
+        """
+        found = model.objects.in_bulk(pks)
+        now = datetime.utcnow()
+        due = []
+        for pk in pks:
+            schedule = found.get(pk)
+            if schedule == None or schedule.deleted:
+                self.log.info('%s #%s was removed.' % (model.__name__, pk))
+            elif schedule.scheduler_id != self.id:
+                self.log.info("%s #%s is no longer tied to this scheduler." %
+                    (model.__name__, pk))
+            elif schedule.next >= now:
+                # The timer fired a little early; try again.
+                self.add(schedule)
+            else:
+                due.append(schedule)
+        if not due:
             return
-        instance = Instance.objects.create(
-            task=schedule.task, schedule=schedule)
-        self.log.info('Enqueuing %s.' % instance)
-        schedule.queue.push(instance)
-        schedule.enqueued()
-        if not schedule.finished():
-            self.add(schedule)
-        else:
-            schedule.scheduler = None
-            schedule.save()
+        
+        schedule_type = ContentType.objects.get_for_model(model)
+        # The insert doesn't return ids, so the rows are tagged with a
+        # token no other insert or copy shares and looked up by it.
+        batch = uuid4().hex
+        instances = [Instance(task_type_id=s.task_type_id, task_id=s.task_id,
+            schedule_type=schedule_type, schedule_id=s.pk, enqueued=now,
+            batch=batch) for s in due]
+        insert_many(Instance, instances)
+        ids = dict(Instance.objects.filter(batch=batch).values_list(
+            'schedule_id', 'id'))
+        by_queue = {}
+        for s, instance in zip(due, instances):
+            instance.id = ids[s.pk]
+            by_queue.setdefault((s.queue_type_id, s.queue_id), []).append(
+                instance)
+        for (queue_type_id, queue_id), items in by_queue.iteritems():
+            queue = ContentType.objects.get_for_id(
+                queue_type_id).get_object_for_this_type(pk=queue_id)
+            self.log.info('Enqueuing %s instances to %s.' %
+                (len(items), queue))
+            queue.push_many(items)
+        
+        # Schedules not due again soon are left for a later claim.
+        horizon = now + timedelta(seconds=SCHEDULER_HORIZON)
+        for s in due:
+            s.advance(now)
+            if s.finished() or s.next > horizon:
+                s.scheduler = None
+        limited = [s.pk for s in due if s.repetitions > 0]
+        if limited:
+            model.objects.filter(pk__in=limited).update(
+                remaining=F('remaining') - 1)
+        update_grouped(model, due, model.ADVANCE_FIELDS + ['scheduler'])
+        for s in due:
+            if s.scheduler_id == self.id:
+                self.add(s)
     
     @property
     def log_path(self):
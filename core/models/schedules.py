@@ -19,9 +19,14 @@ from norc.core.models.task import Instance
 from norc.norc_utils import search
 from norc.norc_utils.django_extras import QuerySetManager
 from norc.norc_utils.parallel import MultiTimer
+from norc.norc_utils import cron
 from norc.norc_utils.log import make_log
 
 
+def _runs_left(rows):
+    """The runs left for rows ending in repetitions and remaining."""
+    return [r[-1] if r[-2] > 0 else None for r in rows]
+
 class AbstractSchedule(Model):
     """A schedule of executions for a specific task."""
     
@@ -42,6 +47,41 @@ class AbstractSchedule(Model):
         def orphaned(self):
             cutoff = datetime.utcnow() - timedelta(seconds=HEARTBEAT_FAILED)
             return self.unfinished.exclude(scheduler__heartbeat__gt=cutoff)
+        
+        def claimable(self, owners):
+            """Unfinished schedules not claimed by any of owners."""
+            return self.unfinished.filter(
+                Q(scheduler__isnull=True) | ~Q(scheduler__in=owners))
+        
+        def due_by(self, when):
+            """Schedules whose next run is no later than when."""
+            return self.filter(Q(next__lte=when) | Q(next__isnull=True))
+        
+        def shard(self, index, count):
+            """Schedules in the index'th of count disjoint shards by id."""
+            if count <= 1:
+                return self
+            where = '%s.id %%%% %%s = %%s' % self.model._meta.db_table
+            return self.extra(where=[where], params=[count, index])
+        
+        def next_times(self, count=1):
+            """Returns the ids of unfinished schedules and their next runs.
+            
+            The next count runs of each are a row of an array from
+            norc_utils.cron, in seconds since the epoch and left blank
+            past the schedule's last run.
+            
+            """
+            raise NotImplementedError
+        
+        def run_counts(self, edges):
+            """Returns the ids of unfinished schedules and how many runs
+            each has left before each of edges, in seconds since the epoch.
+            
+            Runs are only worked out up to the last edge.
+            
+            """
+            raise NotImplementedError
     
     # The Task this is a schedule for.
     task_type = ForeignKey(ContentType, related_name='%(class)ss')
@@ -86,6 +126,14 @@ class AbstractSchedule(Model):
         """Called when the next instance has been enqueued."""
         raise NotImplementedError
     
+    def advance(self, now):
+        """Moves the schedule past the run just enqueued without saving.
+        
+        Only remaining and the fields in ADVANCE_FIELDS are changed.
+        
+        """
+        raise NotImplementedError
+    
     def finished(self):
         """Checks whether all runs of the Schedule have been completed."""
         return self.remaining == 0 and self.repetitions > 0
@@ -107,14 +155,29 @@ class Schedule(AbstractSchedule):
     objects = QuerySetManager()
     
     class QuerySet(AbstractSchedule.QuerySet):
-        pass
+        
+        def next_times(self, count=1):
+            rows = list(self.unfinished.values_list('id', 'next', 'period',
+                'repetitions', 'remaining'))
+            times = cron.periodic_times([cron.to_epoch(r[1]) for r in rows],
+                [r[2] for r in rows], count)
+            return [r[0] for r in rows], cron.truncate(times, _runs_left(rows))
+        
+        def run_counts(self, edges):
+            rows = list(self.unfinished.values_list('id', 'next', 'period',
+                'repetitions', 'remaining'))
+            counts = cron.periodic_counts([cron.to_epoch(r[1]) for r in rows],
+                [r[2] for r in rows], edges)
+            return [r[0] for r in rows], cron.cap(counts, _runs_left(rows))
     
     # Next execution.
-    next = DateTimeField(null=True)
+    next = DateTimeField(null=True, db_index=True)
     
     # The delay in between executions.
     period = PositiveIntegerField()
     
+    ADVANCE_FIELDS = ['next']
+    
     @staticmethod
     def create(task, queue, period=0, reps=1, start=0, make_up=False):
         if type(start) == int:
@@ -126,12 +189,15 @@ class Schedule(AbstractSchedule):
     
     def enqueued(self):
         """Called when the next instance has been enqueued."""
-        now = datetime.utcnow()
+        self.period = Schedule.objects.get(pk=self.pk).period
+        self.advance(datetime.utcnow())
+        self.save()
+    
+    def advance(self, now):
         # Sanity check: this method should never be called before self.next.
         assert self.next < now, "Enqueued too early!"
         if self.repetitions > 0:
             self.remaining -= 1
-        self.period = Schedule.objects.get(pk=self.pk).period
         if not self.finished() and self.period > 0:
             period = timedelta(seconds=self.period)
             self.next += period
@@ -139,7 +205,6 @@ class Schedule(AbstractSchedule):
                 self.next += period
         elif self.finished():
             self.next = None
-        self.save()
     
     def __unicode__(self):
         return u'<Schedule #%s, %s:%ss>' % \
@@ -174,7 +239,22 @@ class CronSchedule(AbstractSchedule):
     objects = QuerySetManager()
     
     class QuerySet(AbstractSchedule.QuerySet):
-        pass
+        
+        def next_times(self, count=1):
+            rows = list(self.unfinished.values_list('id', 'base', 'encoding',
+                'repetitions', 'remaining'))
+            times = cron.next_times_many(
+                [CronSchedule.compile(r[2]) for r in rows],
+                [cron.to_epoch(r[1]) for r in rows], count)
+            return [r[0] for r in rows], cron.truncate(times, _runs_left(rows))
+        
+        def run_counts(self, edges):
+            rows = list(self.unfinished.values_list('id', 'base', 'encoding',
+                'repetitions', 'remaining'))
+            counts = cron.run_counts(
+                [CronSchedule.compile(r[2]) for r in rows],
+                [cron.to_epoch(r[1]) for r in rows], edges)
+            return [r[0] for r in rows], cron.cap(counts, _runs_left(rows))
     
     # The datetime that the next execution time is based off of.
     base = DateTimeField(default=datetime.utcnow)
@@ -182,6 +262,11 @@ class CronSchedule(AbstractSchedule):
     # The string encoding of the schedule.
     encoding = CharField(max_length=864)
     
+    # Next execution, calculated from base and the encoding on save().
+    next = DateTimeField(null=True, db_index=True)
+    
+    ADVANCE_FIELDS = ['base', 'next']
+    
     MONTHS = range(1,13)
     DAYS = range(1,32)
     DAYSOFWEEK = range(7)
@@ -265,33 +350,66 @@ class CronSchedule(AbstractSchedule):
         assert set(results.keys()) == set(SYNS.keys())
         new_encoding = 'o%sd%sw%sh%sm%ss%s' % tuple(['*' if results[k] ==
             SYNS[k][1] else ','.join(map(str, results[k])) for k in 'odwhms'])
+        spec = cron.CronSpec(*[results[k] for k in 'odwhms'])
+        assert spec.next(datetime(2000, 1, 1)) != None, \
+            "Encoding '%s' never matches any date." % encoding
         return new_encoding, results
     
+    # Compiled specs of validated encodings, shared by their schedules.
+    COMPILED = {}
+    
+    @staticmethod
+    def compile(encoding):
+        """Returns an encoding compiled into a CronSpec.
+        
+        The spec for a validated encoding is cached and shared.  Others
+        are compiled anew each time, since validating them can fill in a
+        random second.
+        
+        """
+        spec = CronSchedule.COMPILED.get(encoding)
+        if spec == None:
+            e, d = CronSchedule.validate(encoding)
+            spec = cron.CronSpec(*[d[k] for k in 'odwhms'])
+            if e == encoding:
+                if len(CronSchedule.COMPILED) >= 10000:
+                    CronSchedule.COMPILED.clear()
+                CronSchedule.COMPILED[encoding] = spec
+        return spec
+    
     def __init__(self, *args, **kwargs):
         AbstractSchedule.__init__(self, *args, **kwargs)
-        self.set_lists()
-        self._next = None
-    
-    def set_lists(self, d=None):
-        if not d:
-            d = CronSchedule.validate(self.encoding)[1]
-        self.months = d['o']
-        self.days = d['d']
-        self.daysofweek = d['w']
-        self.hours = d['h']
-        self.minutes = d['m']
-        self.seconds = d['s']
+        # The encoding and its spec, compiled when first needed.
+        self._spec = None
+        if self.next == None and not self.finished():
+            # Saved before next was stored.
+            self.next = self.calculate_next()
+    
+    @property
+    def spec(self):
+        if self._spec == None or self._spec[0] != self.encoding:
+            self._spec = (self.encoding, CronSchedule.compile(self.encoding))
+        return self._spec[1]
+    
+    months = property(lambda self: self.spec.months)
+    days = property(lambda self: self.spec.days)
+    daysofweek = property(lambda self: self.spec.daysofweek)
+    hours = property(lambda self: self.spec.hours)
+    minutes = property(lambda self: self.spec.minutes)
+    seconds = property(lambda self: self.spec.seconds)
     
     def set_encoding(self, encoding):
-        e, d = CronSchedule.validate(encoding)
-        self.encoding = e
-        self.set_lists(d)
+        self.encoding = CronSchedule.validate(encoding)[0]
         self.changed = True
         self.save()
     
     def enqueued(self):
         """Called when the next instance has been enqueued."""
-        now = datetime.utcnow()
+        self.advance(datetime.utcnow())
+        self.encoding = CronSchedule.objects.get(pk=self.pk).encoding
+        self.save()
+    
+    def advance(self, now):
         # Sanity check: this method should never be called before self.next.
         assert self.next < now, "Enqueued too early!"
         if self.repetitions > 0:
@@ -301,54 +419,17 @@ class CronSchedule(AbstractSchedule):
                 self.base = self.next
             else:
                 self.base = now
-        self._next = None # Don't calculate now, but clear the old value.
-        self.encoding = CronSchedule.objects.get(pk=self.pk).encoding
-        self.save()
+            self.next = self.calculate_next()
+        else:
+            self.next = None
     
-    @property
-    def next(self):
-        """Essentially a wrapper for calculate_next() with a cache.
-        
-        The cache is _next, and it is manually cleared by enqueued().
-        
-        """
-        if not self._next:
-            self._next = self.calculate_next()
-        return self._next
+    def save(self, *args, **kwargs):
+        self.next = None if self.finished() else self.calculate_next()
+        AbstractSchedule.save(self, *args, **kwargs)
     
     def calculate_next(self, dt=None):
-        # self.read_encoding()
-        if not dt:
-            dt = self.base
-        dt = dt.replace(microsecond=0)
-        dt += timedelta(seconds=1)
-        second = self.find_gte(dt.second, self.seconds)
-        if second == None:
-            second = self.seconds[0]
-            dt += timedelta(minutes=1)
-        dt = dt.replace(second=second)
-        minute = self.find_gte(dt.minute, self.minutes)
-        if minute == None:
-            minute = self.minutes[0]
-            dt += timedelta(hours=1)
-        dt = dt.replace(minute=minute)
-        hour = self.find_gte(dt.hour, self.hours)
-        if hour == None:
-            hour = self.hours[0]
-            dt += timedelta(days=1)
-        dt = dt.replace(hour=hour)
-        cond = lambda d: d.day in self.days and d.weekday() in self.daysofweek
-        one_day = timedelta(days=1)
-        while not cond(dt):
-            dt += one_day
-        return dt
-    
-    def find_gte(self, p, ls):
-        """Return the first element of ls that is >= p."""
-        # TODO: Binary search.
-        for e in ls:
-            if e >= p:
-                return e
+        """The first time after dt, or base by default, that matches."""
+        return self.spec.next(dt or self.base)
     
     def pretty_name(self):
         """Returns the pretty (predefined) name for this schedule."""
@@ -0,0 +1,318 @@
+
+"""The Norc Supervisor is defined here.
+
+A Supervisor runs a set of executors on one host as its children.  It
+beats their hearts and checks their requests for them in bulk, restarts
+any that crash, and can be controlled through a local Unix socket.
+
+"""
+
+import os
+import signal
+import socket
+import shlex
+import time
+from datetime import datetime
+from threading import Thread
+from subprocess import Popen
+
+from django.db.models import PositiveSmallIntegerField
+
+from norc import settings
+from norc.core.models.daemon import AbstractDaemon
+from norc.core.models.executor import Executor
+from norc.core.constants import (Status, Request,
+    SUPERVISOR_PERIOD, RESTART_DELAY, KILL_GRACE, HEARTBEAT_PERIOD,
+    AUTOSCALE_PERIOD, CONCURRENCY_LIMIT)
+from norc.norc_utils.django_extras import QuerySetManager
+
+class Supervisor(AbstractDaemon):
+    """Runs and watches over the executors on a host."""
+    
+    class Meta:
+        app_label = 'core'
+        db_table = 'norc_supervisor'
+    
+    objects = QuerySetManager()
+    
+    class QuerySet(AbstractDaemon.QuerySet):
+        pass
+    
+    VALID_STATUSES = [
+        Status.CREATED,
+        Status.RUNNING,
+        Status.STOPPING,
+        Status.ENDED,
+        Status.ERROR,
+        Status.KILLED,
+    ]
+    
+    VALID_REQUESTS = [
+        Request.STOP,
+        Request.KILL,
+    ]
+    
+    # The status of this supervisor.
+    status = PositiveSmallIntegerField(default=Status.CREATED,
+        choices=[(s, Status.name(s)) for s in VALID_STATUSES])
+    
+    # A state-change request.
+    request = PositiveSmallIntegerField(null=True,
+        choices=[(r, Request.name(r)) for r in VALID_REQUESTS])
+    
+    def __init__(self, *args, **kwargs):
+        AbstractDaemon.__init__(self, *args, **kwargs)
+        # The norc_executor arguments of each executor to run.
+        self.specs = []
+        # Running executor processes by pid.
+        self.children = {}
+        # Specs waiting to be restarted, as (when, spec) tuples.
+        self.restarts = []
+        # Autoscalers (see norc.core.autoscale) to run periodically.
+        self.autoscalers = []
+        self.next_autoscale = 0
+    
+    @staticmethod
+    def socket_path(host=None):
+        """Where the control socket for a host's supervisor lives."""
+        return os.path.join(settings.NORC_TMP_DIR,
+            'supervisor-%s.sock' % (host or os.uname()[1]))
+    
+    def heart_run(self):
+        """Beats the hearts of this supervisor and all its executors.
+        
+        This takes two queries per period no matter how many executors
+        are being supervised.
+        
+        """
+        while not Status.is_final(self.status):
+            start = time.time()
+            
+            self.heartbeat = datetime.utcnow()
+            self.save(safe=True)
+            pids = self.children.keys()
+            if pids:
+                self.executors.filter(pid__in=pids).status_in(
+                    "active").update(heartbeat=self.heartbeat)
+            
+            wait = HEARTBEAT_PERIOD - (time.time() - start)
+            if wait > 0:
+                self.heart.flag.wait(wait)
+                self.heart.flag.clear()
+    
+    def run(self):
+        """Main run loop of the Supervisor."""
+        self.listener = Thread(target=self.serve)
+        self.listener.daemon = True
+        self.listener.start()
+        
+        for spec in self.specs:
+            self.spawn(spec)
+        
+        while not Status.is_final(self.status):
+            if self.request:
+                self.handle_request()
+            
+            self.reap()
+            
+            if self.status == Status.RUNNING:
+                now = time.time()
+                for when, spec in self.restarts[:]:
+                    if when <= now:
+                        self.restarts.remove((when, spec))
+                        self.spawn(spec)
+                if self.autoscalers and now >= self.next_autoscale:
+                    self.autoscale()
+                self.relay_requests()
+            elif self.status == Status.STOPPING and not self.children:
+                self.set_status(Status.ENDED)
+                self.save(safe=True)
+            
+            if not Status.is_final(self.status):
+                self.wait(SUPERVISOR_PERIOD)
+                self.request = Supervisor.objects.get(pk=self.pk).request
+    
+    def spawn(self, spec):
+        """Starts an executor with the given norc_executor arguments."""
+        args = ['norc_executor'] + shlex.split(spec) + \
+            ['--supervisor', str(self.id)]
+        try:
+            p = Popen(args)
+        except OSError:
+            self.log.error("Failed to start executor '%s'!" % spec,
+                trace=True)
+            self.restarts.append((time.time() + RESTART_DELAY, spec))
+            return
+        p.spec, p.launched = spec, time.time()
+        self.children[p.pid] = p
+        self.log.info("Started executor '%s' as pid %s." % (spec, p.pid))
+    
+    def autoscale(self):
+        """Runs each autoscaler once."""
+        self.next_autoscale = time.time() + AUTOSCALE_PERIOD
+        for autoscaler in self.autoscalers:
+            try:
+                autoscaler.scale()
+            except Exception:
+                self.log.error("%s failed." % autoscaler, trace=True)
+    
+    def add_executors(self, queue, slots, per_executor=CONCURRENCY_LIMIT):
+        """Spawns enough executors on queue to add the given slots."""
+        while slots > 0:
+            concurrent = min(slots, per_executor)
+            self.log.info("Adding an executor for %s." % queue)
+            self.spawn('%s -c %s' % (queue.name, concurrent))
+            slots -= concurrent
+    
+    def stop_executor(self, executor):
+        """Stops an executor, directly if it's one of our children."""
+        self.log.info("Stopping %s." % executor)
+        if executor.pid in self.children and executor.host == self.host:
+            self.signal(executor.pid, signal.SIGINT)
+        else:
+            executor.make_request(Request.STOP)
+    
+    def reap(self):
+        """Handles children that have exited, restarting crashed ones."""
+        for pid, p in self.children.items():
+            if p.poll() == None:
+                continue
+            del self.children[pid]
+            executors = list(self.executors.filter(pid=pid).order_by('-id'))
+            executor = executors[0] if executors else None
+            crashed = executor == None or \
+                not Status.is_final(executor.status) or \
+                executor.status == Status.ERROR
+            if executor and not Status.is_final(executor.status):
+                # It can't record its own death.
+                executor.status = Status.ERROR
+                executor.ended = datetime.utcnow()
+                executor.save()
+            self.log.info("Executor '%s' (pid %s) exited with code %s." %
+                (p.spec, pid, p.returncode))
+            if crashed and self.status == Status.RUNNING:
+                # Don't spin on an executor that dies at startup.
+                quick = time.time() - p.launched < RESTART_DELAY
+                self.restarts.append(
+                    (time.time() + (RESTART_DELAY if quick else 0), p.spec))
+                self.log.info("Restarting executor '%s'." % p.spec)
+    
+    def relay_requests(self):
+        """Wakes executors that have a request waiting.
+        
+        Supervised executors only check for requests when signalled, so
+        this one query stands in for all of their polling.
+        
+        """
+        pids = self.executors.exclude(request=None).status_in(
+            "active").values_list('pid', flat=True)
+        for pid in pids:
+            if pid in self.children:
+                self.signal(pid, signal.SIGUSR1)
+    
+    def signal(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            # Exited already; it'll be reaped next time around.
+            pass
+    
+    def handle_request(self):
+        """Called when a request is found."""
+        
+        # Clear request immediately.
+        request = self.request
+        self.request = None
+        self.save()
+        
+        self.log.info("Request received: %s" % Request.name(request))
+        
+        # Executors treat SIGINT as a stop and SIGTERM as a kill request.
+        if request == Request.STOP:
+            self.set_status(Status.STOPPING)
+            for pid in self.children:
+                self.signal(pid, signal.SIGINT)
+        
+        elif request == Request.KILL:
+            self.set_status(Status.STOPPING)
+            for pid in self.children:
+                self.signal(pid, signal.SIGTERM)
+            # Executors may take KILL_GRACE to kill their instances.
+            deadline = time.time() + KILL_GRACE * 3
+            while self.children and time.time() < deadline:
+                time.sleep(SUPERVISOR_PERIOD)
+                self.reap()
+            if self.children:
+                self.log.error("Executors still running: %s" %
+                    self.children.keys())
+            self.set_status(Status.KILLED)
+        
+        self.save(safe=True)
+    
+    def serve(self):
+        """Serves the control socket until the supervisor ends.
+        
+        Each connection sends one command line and gets a reply: 'status'
+        describes the executors, and 'stop' or 'kill' make a request.
+        
+        """
+        path = Supervisor.socket_path(self.host)
+        try:
+            if os.path.exists(path):
+                # Left by a supervisor that didn't shut down cleanly.
+                os.remove(path)
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            listener.bind(path)
+            listener.listen(5)
+            listener.settimeout(SUPERVISOR_PERIOD)
+        except Exception:
+            self.log.error("Couldn't open control socket %s." % path,
+                trace=True)
+            return
+        self.log.info("Listening for commands on %s." % path)
+        try:
+            while not Status.is_final(self.status):
+                try:
+                    conn, _ = listener.accept()
+                except socket.timeout:
+                    continue
+                try:
+                    conn.settimeout(SUPERVISOR_PERIOD)
+                    command = conn.makefile().readline().strip().lower()
+                    conn.sendall(self.control(command))
+                except Exception:
+                    self.log.error("Control connection failed.", trace=True)
+                conn.close()
+        finally:
+            listener.close()
+            os.remove(path)
+    
+    def control(self, command):
+        """Carries out a control command and returns the reply."""
+        if command == 'status':
+            lines = ["%s is %s." % (self, Status.name(self.status))]
+            for e in self.executors.filter(pid__in=self.children.keys()):
+                lines.append("  %s: %s" % (e, Status.name(e.status)))
+            for when, spec in self.restarts:
+                lines.append("  '%s' restarting in %.0fs." %
+                    (spec, max(0, when - time.time())))
+            return '\n'.join(lines) + '\n'
+        elif command in ['stop', 'kill']:
+            if self.make_request(getattr(Request, command.upper())):
+                return "%s request sent.\n" % command.upper()
+            return "%s has already ended.\n" % self
+        return "Unknown command '%s'.\n" % command
+    
+    def clean_up(self):
+        for pid in self.children:
+            self.signal(pid, signal.SIGTERM)
+    
+    @property
+    def log_path(self):
+        return 'supervisors/supervisor-%s' % self.id
+    
+    def __unicode__(self):
+        return u"<Supervisor #%s on %s>" % (self.id, self.host)
+    
+    __repr__ = __unicode__
+    
@@ -1,9 +1,12 @@
 
 """All basic task related models."""
 
+import os
 import sys
+import math
 from datetime import datetime
 import re
+import shlex
 import subprocess
 import signal
 
@@ -11,6 +14,7 @@ from django.db.models import (Model, query, base,
     BooleanField,
     CharField,
     DateTimeField,
+    FloatField,
     IntegerField,
     PositiveIntegerField,
     PositiveSmallIntegerField,
@@ -20,7 +24,8 @@ from django.contrib.contenttypes.generic import (GenericRelation,
                                                  GenericForeignKey)
 
 from norc import settings
-from norc.core.constants import Status, TASK_MODELS, INSTANCE_MODELS
+from norc.core.constants import (Status, TASK_MODELS, INSTANCE_MODELS,
+    SPECULATION_HISTORY, SPECULATION_MIN_SAMPLES)
 from norc.norc_utils.log import make_log
 from norc.norc_utils.django_extras import QuerySetManager
 from norc.norc_utils.parsing import parse_since
@@ -51,6 +56,32 @@ class Task(Model):
     description = CharField(max_length=512, blank=True, default='')
     date_added = DateTimeField(default=datetime.utcnow)
     timeout = PositiveIntegerField(default=0)
+    
+    # Resources an instance of this task needs from its executor: CPU
+    # units (roughly, cores) and memory in megabytes.
+    cpu_units = PositiveIntegerField(default=1)
+    memory_mb = PositiveIntegerField(default=0)
+    
+    # Limits the executor applies to an instance's process when launching
+    # it.  memory_limit caps the address space in megabytes and
+    # cpu_time_limit the CPU seconds; 0 means no limit.  cpu_affinity is
+    # a CPU list like '0-3,6'.  io_class is an ionice(1) scheduling class
+    # (0 to leave it alone) and io_priority its level from 0 to 7.
+    memory_limit = PositiveIntegerField(default=0)
+    cpu_time_limit = PositiveIntegerField(default=0)
+    cpu_affinity = CharField(max_length=256, blank=True, default='')
+    io_class = PositiveSmallIntegerField(default=0)
+    io_priority = PositiveSmallIntegerField(default=4)
+    
+    # Whether running an instance twice is harmless.  Executors may start
+    # a duplicate of a straggling instance of an idempotent task on
+    # another executor; whichever copy succeeds first wins.
+    idempotent = BooleanField(default=False)
+    
+    # How many queued instances an executor may run one after another in
+    # a single process, to save on process startup for short tasks.
+    batch_size = PositiveIntegerField(default=1)
+    
     instances = GenericRelation('Instance',
         content_type_field='task_type', object_id_field='task_id')
     
@@ -97,6 +128,7 @@ class AbstractInstance(Model):
         Status.CREATED,
         Status.RUNNING,
         Status.SUCCESS,
+        Status.SUPERSEDED,
         Status.FAILURE,
         Status.HANDLED,
         Status.ERROR,
@@ -121,7 +153,37 @@ class AbstractInstance(Model):
     executor = ForeignKey('core.Executor', null=True,
         related_name='_%(class)ss')
     
-    def start(self):
+    # The queue the executor popped this instance from.
+    queue_type = ForeignKey(ContentType, null=True,
+        related_name='%(class)s_from_queue')
+    queue_id = PositiveIntegerField(null=True, db_index=True)
+    queue = GenericForeignKey('queue_type', 'queue_id')
+    
+    # When the executor holding this instance (prefetched, but not yet
+    # started) leased it.  Null when it isn't held.
+    leased = DateTimeField(null=True, blank=True)
+    
+    # Resources used by the instance's process, recorded by the executor
+    # when it reaps the process.  CPU and wall times are in seconds, max
+    # RSS in kilobytes, and block IO in filesystem operations.
+    cpu_user = FloatField(null=True, blank=True)
+    cpu_system = FloatField(null=True, blank=True)
+    max_rss = PositiveIntegerField(null=True, blank=True)
+    block_in = PositiveIntegerField(null=True, blank=True)
+    block_out = PositiveIntegerField(null=True, blank=True)
+    wall_time = FloatField(null=True, blank=True)
+    
+    # The instance this is a speculative copy of.
+    duplicate_of = ForeignKey('self', null=True, blank=True,
+        related_name='duplicates')
+    
+    def start(self, exit=True):
+        """Runs the instance, recording its status.
+        
+        Exits the process when done unless exit is False, as when running
+        a batch of instances in one process.
+        
+        """
         if not hasattr(self, 'log'):
             self.log = make_log(self.log_path)
         if self.status != Status.CREATED:
@@ -130,6 +192,8 @@ class AbstractInstance(Model):
         try:
             for signum in [signal.SIGINT, signal.SIGTERM]:
                 signal.signal(signum, self.kill_handler)
+            # Sent when the task's cpu_time_limit is exceeded.
+            signal.signal(signal.SIGXCPU, self.timeout_handler)
         except ValueError:
             pass
         if self.timeout > 0:
@@ -158,16 +222,93 @@ class AbstractInstance(Model):
                 self.status = Status.FAILURE
         finally:
             self.ended = datetime.utcnow()
-            self.save()
+            if self.task.idempotent:
+                self.resolve()
+            else:
+                self.save()
             self.log.info("Task ended with status %s." %
                 Status.name(self.status))
+            if self.timeout > 0:
+                signal.alarm(0)
             self.log.stop_redirect()
             self.log.close()
-            sys.exit(0 if self.status == Status.SUCCESS else 1)
+            if exit:
+                sys.exit(0 if self.status == Status.SUCCESS else 1)
     
     def run(self):
         raise NotImplementedError
     
+    def resolve(self):
+        """Saves the result of an instance that may have been duplicated.
+        
+        Copies settle the outcome with conditional updates, so only one
+        can win.  A success wins by moving the original out of an
+        unfinished status, or, once the original has ended without
+        succeeding, this copy; it then supersedes unfinished duplicates.
+        Any other result only stands if this copy is still unfinished.
+        A copy that loses is left SUPERSEDED, and executors notice the
+        change and kill any copies still running.
+        
+        """
+        model = type(self)
+        original = self.duplicate_of_id or self.id
+        unfinished = [Status.CREATED, Status.RUNNING]
+        settle = lambda pk: model.objects.filter(pk=pk,
+            status__in=unfinished).update(
+            status=self.status, ended=self.ended) == 1
+        if self.status == Status.SUCCESS:
+            won = settle(original)
+            if not won and original != self.id:
+                # The original ended without succeeding; it isn't racing.
+                won = model.objects.filter(pk=original,
+                    status=Status.SUCCESS).count() == 0 and settle(self.pk)
+        else:
+            won = settle(self.pk)
+        if not won:
+            self.log.info("Another copy finished first.")
+            self.status = Status.SUPERSEDED
+            return
+        self.save()
+        if self.status == Status.SUCCESS:
+            model.objects.filter(duplicate_of=original,
+                status__in=unfinished).exclude(pk=self.pk).update(
+                status=Status.SUPERSEDED, ended=self.ended)
+    
+    def peers(self):
+        """Other instances of the same task, for estimating durations."""
+        raise NotImplementedError
+    
+    def expected_duration(self, percentile=95):
+        """A percentile of the wall time of recent successful peers.
+        
+        Returns None if there aren't enough successful peers to judge.
+        
+        """
+        times = list(self.peers().filter(status=Status.SUCCESS,
+            wall_time__isnull=False).order_by('-id').values_list(
+            'wall_time', flat=True)[:SPECULATION_HISTORY])
+        if len(times) < SPECULATION_MIN_SAMPLES:
+            return None
+        times.sort()
+        return times[int(math.ceil(len(times) * percentile / 100.0)) - 1]
+    
+    def duplicate(self):
+        """Creates a new copy of this instance to be run speculatively."""
+        # Only the fields particular to the kind of instance are copied;
+        # everything in AbstractInstance describes a run.
+        run_fields = set(f.name for f in AbstractInstance._meta.fields)
+        copy = dict((f.attname, getattr(self, f.attname))
+            for f in self._meta.fields
+            if not f.name in run_fields and not f.primary_key)
+        copy.pop('batch', None)
+        return type(self).objects.create(duplicate_of=self, **copy)
+    
+    @property
+    def cpu_time(self):
+        """Total user and system CPU time, if it was recorded."""
+        if self.cpu_user != None and self.cpu_system != None:
+            return self.cpu_user + self.cpu_system
+    
     def kill_handler(self, *args, **kwargs):
         raise NorcInterruptException()
     
@@ -178,13 +319,6 @@ class AbstractInstance(Model):
     def source(self):
         return None
     
-    @property
-    def queue(self):
-        try:
-            return self.executor.queue
-        except AttributeError:
-            return None
-    
     def __unicode__(self):
         return u"<%s #%s>" % (type(self).__name__, self.id)
     
@@ -213,8 +347,8 @@ class Instance(AbstractInstance):
             return self.filter(status__in=statuses) if statuses else self
         
         def from_queue(self, q):
-            return self.filter(executor__queue_id=q.id,
-                executor__queue_type=ContentType.objects.get_for_model(q).id)
+            return self.filter(queue_id=q.id,
+                queue_type=ContentType.objects.get_for_model(q).id)
     
     # The object that spawned this instance.
     task_type = ForeignKey(ContentType, related_name='instances')
@@ -226,9 +360,17 @@ class Instance(AbstractInstance):
     schedule_id = PositiveIntegerField(null=True)
     schedule = GenericForeignKey('schedule_type', 'schedule_id')
     
+    # Marks the instances a scheduler inserted together, so it can find
+    # their ids again.
+    batch = CharField(max_length=32, null=True, blank=True, db_index=True)
+    
     def run(self):
         return self.task.start(self)
     
+    def peers(self):
+        return Instance.objects.filter(task_type=self.task_type_id,
+            task_id=self.task_id)
+    
     @property
     def timeout(self):
         return self.task.timeout
@@ -249,7 +391,12 @@ class Instance(AbstractInstance):
     
 
 class CommandTask(Task):
-    """Task which runs an arbitrary shell command."""
+    """Task which runs an arbitrary shell command.
+    
+    Commands that don't use any shell features are split into arguments
+    and executed directly, without starting a shell.
+    
+    """
     
     class Meta:
         app_label = 'core'
@@ -261,6 +408,33 @@ class CommandTask(Task):
     INTERPRETED_SETTINGS = ['NORC_TMP_DIR', 'DATABASE_NAME', 'DATABASE_USER',
         'DATABASE_PASSWORD', 'DATABASE_HOST', 'DATABASE_PORT']
     
+    # Characters that mean something to the shell outside of quotes.
+    SHELL_CHARS = re.compile(r'[|&;<>()$`\\*?\[\]{}~#!\n]')
+    
+    # Commands that only exist inside a shell.
+    SHELL_BUILTINS = set(['.', 'source', 'cd', 'export', 'set', 'unset',
+        'alias', 'eval', 'exec', 'exit', 'ulimit', 'umask', 'trap', 'wait',
+        'if', 'for', 'while', 'until', 'case', 'function', 'time'])
+    
+    @staticmethod
+    def split(cmd):
+        """Splits a command into arguments if it can run without a shell.
+        
+        Returns None if the command needs a shell.
+        
+        """
+        if CommandTask.SHELL_CHARS.search(cmd):
+            return None
+        try:
+            args = shlex.split(cmd)
+        except ValueError:
+            # Unbalanced quotes; let the shell complain.
+            return None
+        if not args or args[0] in CommandTask.SHELL_BUILTINS or \
+            '=' in args[0]:
+            return None
+        return args
+    
     @staticmethod
     def interpret(cmd):
         for s in CommandTask.INTERPRETED_SETTINGS:
@@ -283,13 +457,19 @@ class CommandTask(Task):
     
     def run(self):
         command = CommandTask.interpret(self.command)
-        if self.nice:
-            command = "nice -n %s %s" % (self.nice, command)
+        args = CommandTask.split(command)
         print "Executing command...\n$ %s" % command
         sys.stdout.flush()
-        exit_status = subprocess.call(command, shell=True,
-            stdout=sys.stdout, stderr=sys.stderr)
-        if exit_status in [126, 127]:
+        nice = self.nice
+        preexec = (lambda: os.nice(nice)) if nice else None
+        try:
+            exit_status = subprocess.call(args or command,
+                shell=args == None, preexec_fn=preexec,
+                stdout=sys.stdout, stderr=sys.stderr)
+        except OSError, e:
+            # Only possible without a shell, which would give 126 or 127.
+            raise ValueError("Invalid command: %s (%s)" % (command, e))
+        if args == None and exit_status in [126, 127]:
             raise ValueError("Invalid command: %s" % command)
         return exit_status == 0
     
@@ -7,8 +7,10 @@ from optparse import OptionParser
 
 from django.contrib.contenttypes.models import ContentType
 
+from norc.core.constants import Status
+
 def main():
-    usage = "norc_taskrunner --ct_pk <pk> --content_pk <pk>" # [-e] [-d]"
+    usage = "norc_taskrunner --ct_pk <pk> --target_pk <pk>[,<pk>...]"
     
     def bad_args(message):
         print message
@@ -19,7 +21,8 @@ def main():
     parser.add_option("--ct_pk",
         help="The ContentType primary key for the object to start().")
     parser.add_option("--target_pk",
-        help="The primary key of the object to start().")
+        help="The primary key of the object to start(), or a comma " +
+            "separated list of them to start one after another.")
     # parser.add_option("-e", "--echo", action="store_true", default=False,
     #     help="Echo log messages to stdout.")
     # parser.add_option("-d", "--debug", action="store_true", default=False,
@@ -35,12 +38,23 @@ def main():
     except ContentType.DoesNotExist:
         bad_args("Invalid ContentType primary key '%s'." % options.ct_pk)
     
-    try:
-        target = ct.get_object_for_this_type(pk=options.target_pk)
-    except ct.model_class().DoesNotExist:
-        bad_args("Target object not found for pk='%s'" % options.target_pk)
+    targets = []
+    for pk in options.target_pk.split(','):
+        try:
+            targets.append(ct.get_object_for_this_type(pk=pk))
+        except ct.model_class().DoesNotExist:
+            bad_args("Target object not found for pk='%s'" % pk)
     
-    target.start()
+    if len(targets) == 1:
+        targets[0].start()
+    else:
+        for target in targets:
+            target.start(exit=False)
+            if target.status == Status.INTERRUPTED:
+                # Killed; leave the rest for the executor to clean up.
+                break
+        sys.exit(0 if all([t.status == Status.SUCCESS for t in targets])
+            else 1)
 
 if __name__ == '__main__':
     main()
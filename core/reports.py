@@ -8,13 +8,17 @@ external modules from having to query core classes directly.
 
 """
 
+from datetime import datetime
+
 from django.contrib.contenttypes.models import ContentType
+from django.db.models import Sum, Max
 
 from norc.core.models import *
 from norc.core.constants import Status, TASK_MODELS, INSTANCE_MODELS
 from norc.norc_utils.parsing import parse_since
 from norc.norc_utils.formatting import untitle
 from norc.norc_utils.django_extras import get_object
+from norc.norc_utils.cron import to_epoch, from_epoch, histogram
 
 from norc import settings    
 
@@ -41,6 +45,8 @@ def make_status_color(status, alive):
         return "status_error"
 
 def generate(data_set, report, params):
+    # Lets data functions share work between the rows of one report.
+    params = dict(params, cache={})
     ret_list = []
     for obj in data_set:
         obj_data = {}
@@ -127,6 +133,46 @@ def _parse_content_ids(id_str):
 def _find_ct(obj):
     return ContentType.objects.get_for_model(obj).id
 
+def _format_secs(secs):
+    return '%.2fs' % secs if secs != None else '-'
+
+def _format_kb(kb):
+    return '%.1fMB' % (kb / 1024.0) if kb != None else '-'
+
+def _task_usage(task, cache=None):
+    """Aggregate resource usage over all instances of a task."""
+    key = ('usage', type(task), task.pk)
+    if cache != None and key in cache:
+        return cache[key]
+    usage = task.instances.aggregate(
+        user=Sum('cpu_user'), system=Sum('cpu_system'), rss=Max('max_rss'))
+    if usage['user'] != None and usage['system'] != None:
+        usage['cpu'] = usage['user'] + usage['system']
+    else:
+        usage['cpu'] = None
+    if cache != None:
+        cache[key] = usage
+    return usage
+
+# The forecast report counts the runs due in each of FORECAST_PERIODS
+# coming periods of FORECAST_WIDTH seconds.
+FORECAST_WIDTH = 5 * 60
+FORECAST_PERIODS = 12
+
+def _forecast():
+    """Rows of the runs and schedules due in each coming period."""
+    start = to_epoch(datetime.utcnow())
+    edges = [start + i * FORECAST_WIDTH for i in range(FORECAST_PERIODS + 1)]
+    runs, schedules = [0] * FORECAST_PERIODS, [0] * FORECAST_PERIODS
+    for model in [Schedule, CronSchedule]:
+        counts = model.objects.run_counts(edges)[1]
+        r, s = histogram(counts, FORECAST_PERIODS)
+        runs = map(sum, zip(runs, r))
+        schedules = map(sum, zip(schedules, s))
+    return [{'period': from_epoch(start + i * FORECAST_WIDTH),
+        'runs': runs[i], 'schedules': schedules[i]}
+        for i in range(FORECAST_PERIODS)]
+
 class BaseReport(object):
     """Ideally, this would be replaced with a class decorator in 2.6."""
     __metaclass__ = Report
@@ -141,6 +187,27 @@ class BaseReport(object):
 def _executor_instance_counter(executor, since, group):
     return executor.instances.since(since).status_in(group).count()
 
+def _executor_queues(executor):
+    eqs = executor.executor_queues.all()
+    if len(eqs) == 0:
+        return executor.queue.name
+    return ', '.join([eq.queue.name if eq.weight == 1
+        else '%s:%s' % (eq.queue.name, eq.weight) for eq in eqs])
+
+def _queue_free_slots(queue, cache=None):
+    if cache != None and 'free' in cache:
+        free = cache['free']
+    else:
+        free = dict([((row['queue_type'], row['queue_id']), row['free'])
+            for row in Executor.objects.alive().capacity()])
+        if cache != None:
+            cache['free'] = free
+    return free.get((ContentType.objects.get_for_model(queue).id, queue.id), 0)
+
+def _queue_instance_counter(queue, since, group):
+    return sum([i.objects.from_queue(queue).since(since).status_in(
+        group).count() for i in INSTANCE_MODELS])
+
 class executors(BaseReport):
     
     get = lambda id: get_object(Executor, id=id)
@@ -153,13 +220,19 @@ class executors(BaseReport):
         'instances': lambda id, since=None, status=None, **kws:
             executors.get(id).instances.since(since).status_in(status),
     }
-    headers = ['ID', 'Queue', 'Queue Type', 'Host', 'PID', 'Running',
-        'Succeeded', 'Failed', 'Started', 'Ended', 'Status']
+    headers = ['ID', 'Queue', 'Queue Type', 'Host', 'PID', 'Concurrent',
+        'Running', 'Held', 'Succeeded', 'Failed', 'Started', 'Ended',
+        'Status']
     data = {
-        'queue': lambda obj, **kws: obj.queue.name,
+        'queue': lambda obj, **kws: _executor_queues(obj),
+        'concurrent': lambda obj, **kws: obj.concurrent if not obj.adaptive
+            else '%s (%s-%s)' % (obj.concurrent,
+                obj.min_concurrent, obj.max_concurrent),
         'queue_type': lambda obj, **kws: obj.queue.__class__.__name__,
-        'running': lambda obj, since, **kws:
-            obj.instances.since(since).status_in('running').count(),
+        # Published by the executor, so only meaningful while it's alive.
+        'running': lambda obj, **kws:
+            obj.running if obj.is_alive() else '-',
+        'held': lambda obj, **kws: obj.held if obj.is_alive() else '-',
         'succeeded': lambda obj, since, **kws:
             obj.instances.since(since).status_in('succeeded').count(),
         'failed': lambda obj, since, **kws:
@@ -205,12 +278,21 @@ class queues(BaseReport):
     get_all = Queue.all_queues
     order_by = lambda data, o: sorted(data, key=lambda v: v.name)
     
-    headers = ['Name', 'Type', 'Items', 'Executors']
+    headers = ['Name', 'Type', 'Items', 'Executors', 'Free Slots',
+        'Running', 'Succeeded', 'Failed']
     data = {
         'type': lambda obj, **kws: type(obj).__name__,
         'items': lambda obj, **kws: obj.count(),
         'executors': lambda obj, **kws:
             Executor.objects.for_queue(obj).alive().count(),
+        'free_slots': lambda obj, cache=None, **kws:
+            _queue_free_slots(obj, cache),
+        'running': lambda obj, since=None, **kws:
+            _queue_instance_counter(obj, since, 'running'),
+        'succeeded': lambda obj, since=None, **kws:
+            _queue_instance_counter(obj, since, 'succeeded'),
+        'failed': lambda obj, since=None, **kws:
+            _queue_instance_counter(obj, since, 'failed'),
         # 'failure_rate': _queue_failure_rate,
     }
 
@@ -222,13 +304,18 @@ class tasks(BaseReport):
     details = {
         'instances': lambda id, **kws: _parse_content_ids(id).instances.all(),
     }
-    headers = ['Name', 'Type', 'Description', 'Added', 'Timeout', 'Instances']
+    headers = ['Name', 'Type', 'Description', 'Added', 'Timeout',
+        'Instances', 'CPU Time', 'Max RSS']
     data = {
         'id': lambda obj, **kws: '%s_%s' %
             (ContentType.objects.get_for_model(obj).id, obj.id),
         'type': lambda obj, **kws: type(obj).__name__,
         'added': lambda obj, **kws: obj.date_added,
         'instances': lambda obj, **kws: obj.instances.count(),
+        'cpu_time': lambda obj, cache=None, **kws:
+            _format_secs(_task_usage(obj, cache)['cpu']),
+        'max_rss': lambda obj, cache=None, **kws:
+            _format_kb(_task_usage(obj, cache)['rss']),
     }
 
 class instances(BaseReport):
@@ -239,13 +326,19 @@ class instances(BaseReport):
     since_filter = date_ended_since
     order_by = date_ended_order
     
-    headers = ['ID#', 'Type', 'Source', 'Started', 'Ended', 'Status']
+    headers = ['ID#', 'Type', 'Source', 'Started', 'Ended', 'Wall Time',
+        'CPU Time', 'Max RSS', 'Block IO', 'Status']
     data = {
         'id': lambda obj, **kws: '%s_%s' % (_find_ct(obj), obj.id),
         'id#': lambda obj, **kws: obj.id,
         'type': lambda obj, **kws: type(obj).__name__,
         'source': lambda i, **kws: i.source or 'n/a',
             # i.source if hasattr(i, 'source') else 'n/a',
+        'wall_time': lambda obj, **kws: _format_secs(obj.wall_time),
+        'cpu_time': lambda obj, **kws: _format_secs(obj.cpu_time),
+        'max_rss': lambda obj, **kws: _format_kb(obj.max_rss),
+        'block_io': lambda obj, **kws: '-' if obj.block_in == None
+            else '%s/%s' % (obj.block_in, obj.block_out),
         'status': lambda obj, **kws: Status.name(obj.status),
     }
 
@@ -259,3 +352,16 @@ class task_classes(BaseReport):
         'task': lambda task, **kws: task.__name__,
         'objects': lambda task, **kws: task.objects.count(),
     }
+    
+
+class forecast(BaseReport):
+    
+    get_all = _forecast
+    
+    headers = ['Period', 'Runs', 'Schedules']
+    data = {
+        'period': lambda row, **kws: row['period'],
+        'runs': lambda row, **kws: row['runs'],
+        'schedules': lambda row, **kws: row['schedules'],
+    }
+    
@@ -5,6 +5,9 @@ from schedule_test import *
 from scheduler_test import *
 from executor_test import *
 from queue_test import *
+from parallel_test import *
+from supervisor_test import *
+from autoscale_test import *
 
 from norc import settings
 settings.BACKUP_SYSTEM = None
@@ -0,0 +1,54 @@
+"""Tests for queue-depth driven autoscaling."""
+
+from datetime import datetime
+
+from django.test import TestCase
+
+from norc.core.models import Executor, DBQueue, CommandTask, Instance
+from norc.core.autoscale import Autoscaler
+from norc.core.constants import Status, Request
+
+class AutoscalerTest(TestCase):
+    """Tests the sizing decisions of Autoscaler."""
+    
+    def setUp(self):
+        self.queue = DBQueue.objects.create(name='test')
+        self.started, self.stopped = [], []
+        self.autoscaler = Autoscaler(self.queue, backlog=1, max_wait=60,
+            step=3, per_executor=4, start=self.started.append,
+            stop=self.stopped.append)
+    
+    def executor(self, concurrent):
+        return Executor.objects.create(queue=self.queue,
+            concurrent=concurrent, status=Status.RUNNING,
+            heartbeat=datetime.utcnow())
+    
+    def test_desired(self):
+        a = Autoscaler(self.queue, backlog=10, max_wait=60, max_slots=8,
+            step=2)
+        self.assertEqual(a.desired(100, 0, 4), 6)
+        self.assertEqual(a.desired(100, 0, 7), 8)
+        self.assertEqual(a.desired(0, None, 4), 2)
+        self.assertEqual(a.desired(0, None, 1), 1)
+        # An old backlog adds slots even if it's short...
+        self.assertEqual(a.desired(5, 120, 4), 6)
+        # ...and holds them while it's still getting old.
+        self.assertEqual(a.desired(5, 40, 4), 4)
+    
+    def test_grow(self):
+        task = CommandTask.objects.create(name='scale', command='true')
+        for i in range(10):
+            self.queue.push(Instance.objects.create(task=task))
+        e = self.executor(3)
+        self.assertEqual(self.autoscaler.scale(), 6)
+        e = Executor.objects.get(pk=e.pk)
+        self.assertEqual(e.concurrent, 4)
+        self.assertEqual(e.request, Request.RELOAD)
+        self.assertEqual(self.started, [2])
+    
+    def test_shrink(self):
+        small, big = self.executor(1), self.executor(4)
+        self.assertEqual(self.autoscaler.scale(), 2)
+        self.assertEqual([e.pk for e in self.stopped], [small.pk])
+        self.assertEqual(Executor.objects.get(pk=big.pk).concurrent, 2)
+    
@@ -2,13 +2,18 @@
 """Module for testing anything related to executors."""
 
 import os
+import time
+from datetime import datetime, timedelta
 from threading import Thread
+from subprocess import Popen, PIPE
 
 from django.test import TestCase
 
+from norc.core import reports
 from norc.core.models import Executor, DBQueue, CommandTask, Instance
 from norc.core.constants import Status, Request
 from norc.norc_utils import wait_until, log
+from norc.norc_utils.system import group_pids
 
 class ExecutorTest(TestCase):
     """Tests for a Norc executor."""
@@ -72,3 +77,449 @@ class ExecutorTest(TestCase):
         self._executor.heart.join(7)
         assert not self.thread.isAlive()
         assert not self._executor.heart.isAlive()
+
+class AdaptiveConcurrencyTest(TestCase):
+    """Tests for the adaptive concurrency policy of executors."""
+    
+    def setUp(self):
+        self.queue = DBQueue.objects.create(name='test')
+        self.executor = Executor(queue=self.queue,
+            concurrent=4, min_concurrent=2, max_concurrent=5)
+    
+    def test_pressure(self):
+        sample = dict(load=2.0, memory=0.5, iowait=0.0)
+        self.assertEqual(self.executor.concurrency_for(sample), 3)
+        sample = dict(load=None, memory=0.05, iowait=None)
+        self.assertEqual(self.executor.concurrency_for(sample), 3)
+        self.executor.concurrent = 2
+        self.assertEqual(self.executor.concurrency_for(sample), 2)
+    
+    def test_idle(self):
+        idle = dict(load=0.1, memory=0.9, iowait=0.01)
+        # Not saturated, so no reason to grow.
+        self.assertEqual(self.executor.concurrency_for(idle), 4)
+        self.executor.processes = dict.fromkeys(range(4))
+        self.assertEqual(self.executor.concurrency_for(idle), 5)
+        self.executor.concurrent = 5
+        self.executor.processes = dict.fromkeys(range(5))
+        self.assertEqual(self.executor.concurrency_for(idle), 5)
+        empty = dict(load=None, memory=None, iowait=None)
+        self.assertEqual(self.executor.concurrency_for(empty), 5)
+    
+class ResourceSlotTest(TestCase):
+    """Tests for resource-aware slot accounting in executors."""
+    
+    class FakeProcess(object):
+        def __init__(self, cpu, memory):
+            self.cpu, self.memory = cpu, memory
+    
+    def setUp(self):
+        self.queue = DBQueue.objects.create(name='test')
+        self.executor = Executor(queue=self.queue, concurrent=4,
+            cpu_capacity=4, memory_capacity=1024)
+        self.big = Instance.objects.create(task=CommandTask.objects.create(
+            name='big', command='true', cpu_units=3, memory_mb=768))
+        self.small = Instance.objects.create(task=CommandTask.objects.create(
+            name='small', command='true', cpu_units=1, memory_mb=128))
+    
+    def test_fits(self):
+        e = self.executor
+        self.assertEqual(e.available(), (4, 1024))
+        self.assertTrue(e.fits(self.big, e.available()))
+        e.processes[1] = self.FakeProcess(3, 768)
+        self.assertEqual(e.available(), (1, 256))
+        self.assertFalse(e.fits(self.big, e.available()))
+        self.assertTrue(e.fits(self.small, e.available()))
+        e.processes[2] = self.FakeProcess(1, 128)
+        self.assertFalse(e.fits(self.small, e.available()))
+    
+    def test_unlimited(self):
+        e = Executor(queue=self.queue, concurrent=4)
+        e.processes[1] = self.FakeProcess(100, 100000)
+        self.assertEqual(e.available(), (None, None))
+        self.assertTrue(e.fits(self.big, e.available()))
+    
+class IsolationTest(TestCase):
+    """Tests that executors apply task limits to instance processes."""
+    
+    def setUp(self):
+        self.executor = Executor(queue=DBQueue.objects.create(name='test'),
+            concurrent=2)
+        self.executor.log = log.Log(os.devnull)
+    
+    def test_limits(self):
+        ct = CommandTask.objects.create(name='limited', command='true',
+            memory_limit=512, cpu_time_limit=30, cpu_affinity='0')
+        instance = Instance.objects.create(task=ct)
+        p = Popen('ulimit -v; ulimit -t; grep Cpus_allowed_list '
+            '/proc/self/status', shell=True, stdout=PIPE,
+            preexec_fn=Executor.isolation(instance))
+        out = p.communicate()[0].split()
+        self.assertEqual(out[:2], [str(512 * 1024), '30'])
+        self.assertEqual(out[-1], '0')
+    
+    def launch(self, command):
+        ct = CommandTask.objects.create(name=command, command=command)
+        instance = Instance.objects.create(task=ct)
+        p = Popen(command, shell=True,
+            preexec_fn=Executor.isolation(instance))
+        p.instance, p.batch = instance, [instance]
+        p.launched = time.time()
+        self.executor.processes[p.pid] = p
+        return p
+    
+    def test_orphans(self):
+        p = self.launch('sleep 30 & exit 0')
+        def reaped():
+            self.executor.reap()
+            return not self.executor.processes
+        wait_until(reaped, 5, 0.1)
+        self.assertTrue(p.pid in self.executor.dying)
+        wait_until(lambda: group_pids(p.pid) == [], 5, 0.1)
+        self.assertEqual(self.executor.escalate(), [])
+        self.assertEqual(self.executor.dying, {})
+    
+    def test_timeout(self):
+        p = self.launch('sleep 30')
+        p.deadline = time.time() - 1
+        self.executor.deadlines = [(p.deadline, p.pid)]
+        self.executor.enforce_timeouts()
+        self.assertEqual(self.executor.deadlines, [])
+        def reaped():
+            self.executor.reap()
+            return not self.executor.processes
+        wait_until(reaped, 5, 0.1)
+        self.assertEqual(Instance.objects.get(pk=p.instance.pk).status,
+            Status.TIMEDOUT)
+    
+    def test_kill_all(self):
+        ps = [self.launch('sleep 30 & sleep 30'), self.launch('sleep 30')]
+        self.assertEqual(self.executor.kill_all(), [])
+        self.assertEqual(self.executor.processes, {})
+        for p in ps:
+            self.assertEqual(group_pids(p.pid), [])
+            self.assertEqual(Instance.objects.get(pk=p.instance.pk).status,
+                Status.INTERRUPTED)
+    
+class UsageTest(TestCase):
+    """Tests the per-instance resource accounting of executors."""
+    
+    def test_record_usage(self):
+        ct = CommandTask.objects.create(name='usage', command='true')
+        instance = Instance.objects.create(task=ct)
+        executor = Executor(queue=DBQueue.objects.create(name='test'),
+            concurrent=1)
+        p = Popen(['python', '-c', 'sum(range(10 ** 6))'])
+        p.instance, p.batch = instance, [instance]
+        p.launched = time.time()
+        pid, status, usage = os.wait4(p.pid, 0)
+        executor.record_usage(p, usage)
+        instance = Instance.objects.get(pk=instance.pk)
+        self.assertTrue(instance.cpu_time > 0)
+        self.assertTrue(instance.max_rss > 0)
+        self.assertTrue(instance.wall_time >= 0)
+    
+class MultiQueueTest(TestCase):
+    """Tests for executors drawing from several queues."""
+    
+    def setUp(self):
+        self.a = DBQueue.objects.create(name='a')
+        self.b = DBQueue.objects.create(name='b')
+        task = CommandTask.objects.create(name='multi', command='true')
+        for q in [self.a, self.b]:
+            for i in range(8):
+                q.push(Instance.objects.create(task=task))
+        self.executor = Executor.objects.create(queue=self.a, concurrent=1)
+    
+    def pop_names(self, n):
+        popped = [self.executor.pop(set())[0] for i in range(n)]
+        return [q and q.name for q in popped]
+    
+    def test_weighted(self):
+        self.executor.add_queue(self.a, 1)
+        self.executor.add_queue(self.b, 3)
+        self.executor.queues = self.executor.load_queues()
+        names = self.pop_names(8)
+        self.assertEqual(names.count('a'), 2)
+        self.assertEqual(names.count('b'), 6)
+        # Once b is drained, a gets everything.
+        names = self.pop_names(8)
+        self.assertEqual(names.count('a'), 6)
+        self.assertEqual(names[-4:], ['a'] * 4)
+        self.assertEqual(self.executor.pop(set()), (None, None))
+    
+    def test_priority(self):
+        self.executor.add_queue(self.a, 1, 1)
+        self.executor.add_queue(self.b, 1, 0)
+        self.executor.queues = self.executor.load_queues()
+        self.assertEqual(self.pop_names(10), ['b'] * 8 + ['a'] * 2)
+    
+    def test_for_queue(self):
+        self.executor.queues = self.executor.load_queues()
+        self.assertEqual(list(Executor.objects.for_queue(self.a)),
+            [self.executor])
+        self.assertEqual(Executor.objects.for_queue(self.b).count(), 0)
+        self.executor.add_queue(self.b)
+        self.assertEqual(list(Executor.objects.for_queue(self.b)),
+            [self.executor])
+    
+class PrefetchTest(TestCase):
+    """Tests for the prefetch window of executors."""
+    
+    def setUp(self):
+        self.queue = DBQueue.objects.create(name='test')
+        task = CommandTask.objects.create(name='prefetch', command='true')
+        for i in range(5):
+            self.queue.push(Instance.objects.create(task=task))
+        self.executor = Executor.objects.create(queue=self.queue,
+            concurrent=2, prefetch=2)
+        self.executor.log = log.Log(os.devnull)
+        self.executor.queues = self.executor.load_queues()
+        self.started = []
+        def start_instance(instance, queue, batch=()):
+            self.started.append(instance)
+            self.executor.processes[instance.pk] = \
+                ResourceSlotTest.FakeProcess(1, 0)
+        self.executor.start_instance = start_instance
+    
+    def test_fill(self):
+        self.executor.fill()
+        self.assertEqual(len(self.started), 2)
+        self.assertEqual(len(self.executor.prefetched), 2)
+        self.assertEqual(self.queue.count(), 1)
+        leased = [e[1].pk for e in self.executor.prefetched]
+        self.assertEqual(Instance.objects.filter(pk__in=leased,
+            executor=self.executor).count(), 2)
+        # A freed slot is filled from the prefetched instances.
+        self.executor.processes.popitem()
+        self.executor.fill()
+        self.assertEqual(len(self.started), 3)
+        self.assertEqual(self.started[-1].pk, leased[0])
+        self.assertEqual(self.queue.count(), 0)
+    
+    def test_too_big(self):
+        task = CommandTask.objects.create(name='big', command='true',
+            cpu_units=8)
+        big = Instance.objects.create(task=task)
+        other = DBQueue.objects.create(name='other')
+        other.push(big)
+        self.executor.cpu_capacity = 4
+        self.executor.add_queue(other, priority=-1)
+        self.executor.queues = self.executor.load_queues()
+        # A bigger executor can take it, so it's left for that one.
+        larger = Executor.objects.create(queue=other, concurrent=1,
+            cpu_capacity=8, status=Status.RUNNING,
+            heartbeat=datetime.utcnow())
+        self.executor.fill()
+        self.assertEqual(len(self.started), 2)
+        self.assertEqual(other.count(), 1)
+        self.assertTrue(all(e[0] == self.queue
+            for e in self.executor.prefetched))
+        # With nothing able to run it, it errors instead of bouncing.
+        # It's prefetched first, then given up when it's next in line.
+        larger.delete()
+        for i in range(2):
+            self.executor.processes.clear()
+            self.executor.fill()
+        self.assertEqual(other.count(), 0)
+        self.assertEqual(Instance.objects.get(pk=big.pk).status,
+            Status.ERROR)
+        self.assertFalse(big.pk in [e[1].pk for e in self.executor.prefetched])
+    
+    def test_release(self):
+        self.executor.fill()
+        self.executor.prefetched[0][2] -= 3600
+        self.executor.expire_leases()
+        self.assertEqual(len(self.executor.prefetched), 1)
+        self.assertEqual(self.queue.count(), 2)
+        self.executor.release_prefetched()
+        self.assertEqual(self.queue.count(), 3)
+        self.assertEqual(Instance.objects.filter(
+            executor=self.executor).count(), 0)
+    
+    def test_reclaim(self):
+        self.executor.heartbeat = datetime.utcnow()
+        self.executor.save()
+        self.executor.fill()
+        leased = [e[1].pk for e in self.executor.prefetched]
+        other = Executor.objects.create(queue=self.queue, concurrent=1)
+        other.log = log.Log(os.devnull)
+        other.queues = other.load_queues()
+        other.reclaim_leases()
+        self.assertEqual(self.queue.count(), 1)
+        # A lapsed lease is reclaimed even though its holder is alive.
+        Instance.objects.filter(pk=leased[0]).update(
+            leased=datetime.utcnow() - timedelta(hours=1))
+        other.reclaim_leases()
+        self.assertEqual(self.queue.count(), 2)
+        # Every lease held by a dead executor is reclaimed.
+        self.executor.heartbeat -= timedelta(hours=1)
+        self.executor.save()
+        other.reclaim_leases()
+        self.assertEqual(self.queue.count(), 3)
+        self.assertEqual(Instance.objects.filter(executor=self.executor,
+            leased__isnull=False).count(), 0)
+        # The holder doesn't hand them out a second time.
+        self.executor.release_prefetched()
+        self.assertEqual(self.queue.count(), 3)
+    
+class StragglerTest(TestCase):
+    """Tests speculative execution of straggling idempotent instances."""
+    
+    def setUp(self):
+        self.queue = DBQueue.objects.create(name='test')
+        self.executor = Executor.objects.create(queue=self.queue,
+            concurrent=2, status=Status.RUNNING)
+        self.executor.log = log.Log(os.devnull)
+        Executor.objects.create(queue=self.queue, concurrent=2,
+            status=Status.RUNNING, heartbeat=datetime.utcnow())
+        task = CommandTask.objects.create(name='idempotent',
+            command='true', idempotent=True)
+        instance = Instance.objects.create(task=task,
+            status=Status.RUNNING)
+        self.p = Popen('sleep 30', shell=True,
+            preexec_fn=Executor.isolation(instance))
+        self.p.instance, self.p.queue = instance, self.queue
+        self.p.batch = [instance]
+        self.p.launched = time.time()
+        self.p.idempotent = True
+        self.p.speculate_at, self.p.settled = time.time(), None
+        self.executor.processes[self.p.pid] = self.p
+    
+    def tearDown(self):
+        self.executor.kill_all()
+    
+    def test_straggler(self):
+        self.executor.speculate()
+        copy = self.queue.pop()
+        self.assertEqual(copy.duplicate_of, self.p.instance)
+        self.assertEqual(self.p.speculate_at, None)
+    
+    def test_own_copy(self):
+        self.executor.queues = self.executor.load_queues()
+        self.executor.prefetch = 1
+        Instance.objects.filter(pk=self.p.instance.pk).update(
+            executor=self.executor)
+        copy = self.p.instance.duplicate()
+        self.queue.push(copy)
+        started = []
+        self.executor.start_instance = \
+            lambda instance, queue, batch=(): started.append(instance)
+        self.executor.fill()
+        # The copy is left on the queue for another executor.
+        self.assertEqual(started, [])
+        self.assertEqual(len(self.executor.prefetched), 0)
+        self.assertEqual(self.queue.count(), 1)
+        copy = Instance.objects.get(pk=copy.pk)
+        self.assertEqual((copy.executor, copy.leased), (None, None))
+    
+    def test_settled(self):
+        Instance.objects.filter(pk=self.p.instance.pk).update(
+            status=Status.SUPERSEDED)
+        self.executor.speculate()
+        self.assertFalse(self.p.pid in self.executor.dying)
+        self.p.settled -= 60
+        self.executor.speculate()
+        self.assertTrue(self.p.pid in self.executor.dying)
+    
+class BatchTest(TestCase):
+    """Tests gathering instances of a task into batches."""
+    
+    def setUp(self):
+        self.queue = DBQueue.objects.create(name='test')
+        self.executor = Executor.objects.create(queue=self.queue,
+            concurrent=1)
+        self.executor.log = log.Log(os.devnull)
+        self.batched = CommandTask.objects.create(name='batched',
+            command='true', batch_size=3)
+        self.other = CommandTask.objects.create(name='other',
+            command='true')
+    
+    def push(self, task, n):
+        instances = [Instance.objects.create(task=task) for i in range(n)]
+        for instance in instances:
+            self.queue.push(instance)
+        return instances
+    
+    def test_gather(self):
+        self.push(self.batched, 5)
+        first = self.queue.pop()
+        rest = Instance.objects.filter(pk__gt=first.pk).order_by('id')
+        batch = self.executor.gather(self.queue, first)
+        self.assertEqual([i.pk for q, i in batch], [i.pk for i in rest[:2]])
+        self.assertEqual(self.queue.count(), 2)
+    
+    def test_other_task(self):
+        second = self.push(self.batched, 2)[1]
+        other = self.push(self.other, 1)[0]
+        self.push(self.batched, 1)
+        first = self.queue.pop()
+        batch = self.executor.gather(self.queue, first)
+        self.assertEqual([i.pk for q, i in batch], [second.pk])
+        # The other task's instance is held rather than lost.
+        self.assertEqual(self.executor.prefetched[0][1].pk, other.pk)
+        self.assertEqual(self.queue.count(), 1)
+        self.assertEqual(self.executor.gather(self.queue, other), [])
+    
+class CapacityTest(TestCase):
+    """Tests the capacity executors publish and its totals."""
+    
+    def setUp(self):
+        self.a = DBQueue.objects.create(name='a')
+        self.b = DBQueue.objects.create(name='b')
+    
+    def executor(self, host, concurrent, running, held, queues):
+        e = Executor.objects.create(queue=queues[0], host=host,
+            concurrent=concurrent, running=running, held=held,
+            status=Status.RUNNING, heartbeat=datetime.utcnow())
+        for q in queues:
+            e.add_queue(q)
+        return e
+    
+    def test_capacity(self):
+        self.executor('one', 4, 1, 2, [self.a, self.b])
+        self.executor('one', 2, 2, 0, [self.a])
+        self.executor('two', 3, 0, 0, [self.b])
+        hosts = Executor.objects.alive().capacity('host')
+        hosts = dict((r['host'], r) for r in hosts)
+        self.assertEqual((hosts['one']['slots'], hosts['one']['free'],
+            hosts['one']['held']), (6, 3, 2))
+        self.assertEqual(hosts['two']['free'], 3)
+        queues = dict((r['queue_id'], r)
+            for r in Executor.objects.alive().capacity())
+        self.assertEqual((queues[self.a.id]['executors'],
+            queues[self.a.id]['free']), (2, 3))
+        self.assertEqual((queues[self.b.id]['executors'],
+            queues[self.b.id]['free']), (2, 6))
+    
+    def test_report(self):
+        self.executor('one', 4, 1, 0, [self.a, self.b])
+        capacity, calls = Executor.QuerySet.capacity, []
+        def counted(qs, *args):
+            calls.append(args)
+            return capacity(qs, *args)
+        Executor.QuerySet.capacity = counted
+        try:
+            rows = reports.generate([self.a, self.b], reports.queues,
+                dict(since=None))
+        finally:
+            Executor.QuerySet.capacity = capacity
+        self.assertEqual([r['free_slots'] for r in rows], [3, 3])
+        # Worked out once for the whole report.
+        self.assertEqual(len(calls), 1)
+    
+    def test_publish(self):
+        e = self.executor('one', 2, 0, 0, [self.a])
+        e.supervised = True
+        e.processes[1] = ResourceSlotTest.FakeProcess(1, 0)
+        e.publish()
+        self.assertEqual(Executor.objects.get(pk=e.pk).running, 1)
+        # Changes within a heartbeat period wait for the next one.
+        e.processes[2] = ResourceSlotTest.FakeProcess(1, 0)
+        e.publish()
+        self.assertEqual(e.running, 2)
+        self.assertEqual(Executor.objects.get(pk=e.pk).running, 1)
+        e.next_publish = 0
+        e.publish()
+        self.assertEqual(Executor.objects.get(pk=e.pk).running, 2)
+    
@@ -0,0 +1,156 @@
+"""Tests for the parallel utilities used by the daemons."""
+
+import time
+from threading import Event
+from Queue import Full
+
+from django.test import TestCase
+
+from norc.norc_utils.parallel import (ThreadPool, CancelledError,
+    MultiTimer, TimingWheel)
+
+class ThreadPoolTest(TestCase):
+    """Tests for the condition-based ThreadPool."""
+    
+    def setUp(self):
+        self.pool = ThreadPool(2, max_queued=2)
+    
+    def test_results(self):
+        futures = [self.pool.submit(lambda x: x * 2, [i]) for i in range(2)]
+        self.assertEqual([f.result(5) for f in futures], [0, 2])
+        failed = self.pool.submit(lambda: 1 / 0)
+        self.assertTrue(isinstance(failed.exception(5), ZeroDivisionError))
+        self.assertRaises(ZeroDivisionError, failed.result)
+        stats = self.pool.stats()
+        self.assertEqual(stats['completed'], 3)
+        self.assertEqual(stats['failed'], 1)
+    
+    def test_backpressure(self):
+        release = Event()
+        running = [self.pool.submit(release.wait) for i in range(2)]
+        time.sleep(0.1)
+        self.assertEqual(self.pool.stats()['active'], 2)
+        queued = [self.pool.submit(time.time) for i in range(2)]
+        self.assertRaises(Full, lambda:
+            self.pool.submit(time.time, block=False))
+        release.set()
+        for f in running + queued:
+            f.result(5)
+        self.assertEqual(self.pool.stats()['queued'], 0)
+    
+    def test_join(self):
+        release = Event()
+        running = [self.pool.submit(release.wait) for i in range(2)]
+        time.sleep(0.1)
+        queued = self.pool.submit(time.time)
+        release.set()
+        self.pool.join(wait=False)
+        self.assertTrue(all([f.done() for f in running]))
+        self.assertTrue(queued.done())
+        self.assertRaises(RuntimeError, lambda: self.pool.submit(time.time))
+    
+    def test_callback(self):
+        done = []
+        f = self.pool.submit(lambda: 'x')
+        f.add_done_callback(lambda f: done.append(f.result()))
+        f.result(5)
+        time.sleep(0.1)
+        self.assertEqual(done, ['x'])
+    
+    def tearDown(self):
+        if not self.pool.joining:
+            self.pool.join()
+    
+
+class MultiTimerTest(TestCase):
+    """Tests for the keyed, cancellable MultiTimer."""
+    
+    def make_timer(self, dispatch=None):
+        return MultiTimer(dispatch=dispatch)
+    
+    def setUp(self):
+        self.timer = self.make_timer()
+        self.timer.start()
+        self.fired = []
+    
+    def fire(self, name):
+        self.fired.append(name)
+    
+    def test_order(self):
+        for name, delay in [('b', 0.2), ('a', 0.1), ('c', 0.3)]:
+            self.timer.add_task(delay, self.fire, [name])
+        time.sleep(0.5)
+        self.assertEqual(self.fired, ['a', 'b', 'c'])
+        self.assertEqual(len(self.timer), 0)
+    
+    def test_cancel(self):
+        self.timer.add_task(0.1, self.fire, ['a'], key='a')
+        handle = self.timer.add_task(0.1, self.fire, ['b'])
+        self.assertTrue(self.timer.cancel_task(handle))
+        self.assertFalse(self.timer.cancel_task(handle))
+        self.assertEqual(self.timer.keys(), ['a'])
+        time.sleep(0.3)
+        self.assertEqual(self.fired, ['a'])
+        self.assertFalse('a' in self.timer)
+    
+    def test_reschedule(self):
+        self.timer.add_task(0.1, self.fire, ['a'], key='a')
+        self.timer.add_task(0.2, self.fire, ['b'], key='b')
+        self.assertTrue(self.timer.reschedule('a', 0.3))
+        # Adding with a key that's pending replaces that task.
+        self.timer.add_task(0.1, self.fire, ['c'], key='b')
+        self.assertEqual(len(self.timer), 2)
+        time.sleep(0.5)
+        self.assertEqual(self.fired, ['c', 'a'])
+        self.assertFalse(self.timer.reschedule('a', 0.1))
+    
+    def test_many_cancelled(self):
+        for i in range(1000):
+            self.timer.add_task(60, self.fire, [i], key=i)
+        for i in range(999):
+            self.timer.cancel_task(i)
+        self.assertEqual(len(self.timer), 1)
+        if isinstance(self.timer, MultiTimer):
+            self.assertTrue(len(self.timer.tasks) < 100)
+    
+    def test_dispatch(self):
+        groups = []
+        timer = self.make_timer(dispatch=groups.append)
+        for name in 'abc':
+            timer.add_task(0, self.fire, [name])
+        timer.add_task(0.2, self.fire, ['d'])
+        timer.start()
+        time.sleep(0.4)
+        timer.cancel()
+        timer.join(5)
+        # Tasks due together are dispatched together, not called.
+        self.assertEqual([[args[0] for f, args, kw in g] for g in groups],
+            [['a', 'b', 'c'], ['d']])
+        self.assertEqual(self.fired, [])
+    
+    def tearDown(self):
+        self.timer.cancel()
+        self.timer.join(5)
+        assert not self.timer.isAlive()
+    
+
+class TimingWheelTest(MultiTimerTest):
+    """Runs the MultiTimer tests against a small TimingWheel."""
+    
+    def make_timer(self, dispatch=None):
+        return TimingWheel(tick=0.01, size=4, levels=3, dispatch=dispatch)
+    
+    def test_cascade(self):
+        # These span every wheel and go past the top one.
+        delays = [0.02, 0.07, 0.3, 0.9, 0.05, 0.5]
+        start = time.time()
+        fired = []
+        for i, delay in enumerate(delays):
+            self.timer.add_task(delay,
+                lambda i: fired.append((i, time.time())), [i])
+        time.sleep(1.1)
+        self.assertEqual([i for i, t in fired],
+            sorted(range(len(delays)), key=lambda i: delays[i]))
+        for i, t in fired:
+            self.assertTrue(0 <= t - start - delays[i] < 0.05)
+    
@@ -3,11 +3,16 @@
 
 import unittest
 import re
+import random
+from datetime import datetime, timedelta
 
 from django.test import TestCase
 
+from norc.core import reports
 from norc.core.models import CommandTask, DBQueue, Schedule, CronSchedule
 from norc.norc_utils import wait_until, log
+from norc.norc_utils import cron
+from norc.norc_utils.cron import next_bit, to_epoch
 
 # class ScheduleTest(TestCase):
 #     
@@ -44,3 +49,159 @@ class CronScheduleTest(TestCase):
         self.assertEqual(make('WEEKLY').pretty_name(), 'WEEKLY')
         self.assertEqual(make('MONTHLY').pretty_name(), 'MONTHLY')
     
+    def test_compile(self):
+        a = CronSchedule.create(self.t, self.q, 'o*d*w*h*m0,30s0')
+        b = CronSchedule.create(self.t, self.q, 'o*d*w*h*m0,30s0')
+        # Loading a schedule doesn't parse its encoding.
+        a = CronSchedule.objects.get(pk=a.pk)
+        self.assertEqual(a._spec, None)
+        self.assertEqual(a.minutes, (0, 30))
+        self.assertTrue(a.minutes is b.minutes)
+        # An encoding that validation would change isn't cached.
+        c = CronSchedule(encoding='m0,30', task=self.t, queue=self.q,
+            repetitions=0, remaining=0)
+        self.assertEqual(c.minutes, (0, 30))
+        self.assertFalse('m0,30' in CronSchedule.COMPILED)
+    
+    def test_next_bit(self):
+        self.assertEqual(next_bit(20, 0), 2)
+        self.assertEqual(next_bit(20, 3), 4)
+        self.assertEqual(next_bit(20, 5), None)
+        self.assertEqual(next_bit(1 << 59, 1), 59)
+        self.assertEqual(next_bit(1 << 59 | 1 << 40, 9), 40)
+    
+    def test_calculate_next(self):
+        def brute(spec, dt):
+            dt = dt.replace(microsecond=0) + timedelta(seconds=1)
+            day = datetime(dt.year, dt.month, dt.day)
+            while True:
+                if day.month in spec.months and day.day in spec.days and \
+                    day.weekday() in spec.daysofweek:
+                    for h in spec.hours:
+                        for m in spec.minutes:
+                            for s in spec.seconds:
+                                t = day.replace(hour=h, minute=m, second=s)
+                                if t >= dt:
+                                    return t
+                day += timedelta(days=1)
+        encodings = ['o*d*w*h*m*s*', 'o*d*w*h*m0,30s0', 'o*d*w*h*m*s15,45',
+            'o3,9d1,15w*h6,18m0s0', 'o*d13w4h0m0s0', 'o2d29w*h12m30s30',
+            'o12d31w6h23m59s59', 'o*d*w0,2h9,17m5,25,45s10']
+        rand = random.Random(7)
+        for e in encodings:
+            spec = CronSchedule.compile(e)
+            for _ in range(20):
+                dt = datetime(2000, 1, 1) + \
+                    timedelta(seconds=rand.randint(0, 20 * 365 * 86400))
+                self.assertEqual(spec.next(dt), brute(spec, dt))
+    
+    def test_months(self):
+        c = CronSchedule.create(self.t, self.q, 'o2d29h0m0s0')
+        self.assertEqual(c.calculate_next(datetime(2001, 1, 1)),
+            datetime(2004, 2, 29))
+        c = CronSchedule.create(self.t, self.q, 'o6d1h0m0s0')
+        self.assertEqual(c.calculate_next(datetime(2010, 6, 1)),
+            datetime(2011, 6, 1))
+        self.assertRaises(AssertionError,
+            lambda: CronSchedule.validate('o2d30'))
+        self.assertRaises(AssertionError,
+            lambda: CronSchedule.validate('o4,6,9,11d31'))
+    
+    def test_next_times(self):
+        rows = lambda a: [[None if t != t else t for t in r]
+            for r in (a.tolist() if hasattr(a, 'tolist') else a)]
+        spec = CronSchedule.compile('o*d*w*h*m0,30s0')
+        base = to_epoch(datetime(2010, 5, 5, 10, 17, 3))
+        expected = [[base + 13 * 60 - 3 + 1800 * k for k in range(3)],
+            [base + 43 * 60 - 3 + 1800 * k for k in range(3)]]
+        self.assertEqual(rows(cron.next_times(spec, [base, base + 1800], 3)),
+            expected)
+        # Bases past the listed times are worked out one by one.
+        limit, cron.FIRE_LIMIT = cron.FIRE_LIMIT, 2
+        try:
+            self.assertEqual(rows(cron.next_times(spec,
+                [base, base + 1800], 3)), expected)
+        finally:
+            cron.FIRE_LIMIT = limit
+        self.assertEqual(rows(cron.next_times(spec, [], 3)), [])
+        # A base far behind the rest is worked out on its own.
+        stale = base - 30 * 86400
+        self.assertEqual(cron._start(spec, [base, stale], 3), base)
+        self.assertEqual(rows(cron.next_times(spec, [base, stale], 3)),
+            [expected[0], cron._chain(spec, stale, 3)])
+    
+    def test_schedule_next_times(self):
+        now = datetime(2010, 5, 5, 10, 17, 3)
+        a = CronSchedule.create(self.t, self.q, 'o*d*w*h*m0,30s0', reps=2)
+        a.base = now
+        a.save()
+        b = Schedule.create(self.t, self.q, period=60, reps=0, start=now)
+        ids, times = CronSchedule.objects.filter(pk=a.pk).next_times(3)
+        self.assertEqual(ids, [a.pk])
+        first = to_epoch(datetime(2010, 5, 5, 10, 30))
+        self.assertEqual(list(times[0][:2]), [first, first + 1800])
+        # Only two runs are left.
+        self.assertTrue(times[0][2] == None or times[0][2] != times[0][2])
+        ids, times = Schedule.objects.filter(pk=b.pk).next_times(3)
+        self.assertEqual(list(times[0]),
+            [to_epoch(now) + 60 * k for k in range(3)])
+        edges = [to_epoch(now) + 1800 * k for k in range(3)]
+        ids, counts = Schedule.objects.filter(pk=b.pk).run_counts(edges)
+        self.assertEqual(cron.histogram(counts, 2), ([30, 30], [1, 1]))
+        ids, counts = CronSchedule.objects.filter(pk=a.pk).run_counts(edges)
+        # The runs at 10:30 and 11:00, and then none are left.
+        self.assertEqual(cron.histogram(counts, 2), ([1, 1], [1, 1]))
+        rows = reports.forecast()
+        self.assertEqual(len(rows), reports.FORECAST_PERIODS)
+    
+    def check_many(self):
+        """Checks next_times_many() and run_counts() against CronSpec.next()
+        for a mix of specs that start at different times of day."""
+        rows = lambda a: [[None if t != t else t for t in r]
+            for r in (a.tolist() if hasattr(a, 'tolist') else a)]
+        random.seed(0)
+        encodings = [make() for make in CronSchedule.MAKE_PREDEFINED.values()
+            for i in range(5)] + ['o*d*w*h*m*s*', 'o*d*w*h3,10m5,40s10,20']
+        specs = [CronSchedule.compile(e) for e in encodings]
+        now = to_epoch(datetime(2010, 5, 5, 10, 17, 3))
+        bases = [now - random.randint(0, 600) for s in specs]
+        bases[-2] = now - 1000
+        expected = [cron._chain(s, b, 3) for s, b in zip(specs, bases)]
+        self.assertEqual(rows(cron.next_times_many(specs, bases, 3)),
+            expected)
+        edges = [now + 900 * k for k in range(5)]
+        expected = []
+        for spec, base in zip(specs, bases):
+            dt, times = spec.next(cron.from_epoch(base)), []
+            while to_epoch(dt) < edges[-1]:
+                times.append(to_epoch(dt))
+                dt = spec.next(dt)
+            expected.append([len([t for t in times if t < e]) for e in edges])
+        self.assertEqual(rows(cron.run_counts(specs, bases, edges)),
+            expected)
+        # With too many times to list, those before the first edge are
+        # left out.
+        limit, cron.FIRE_LIMIT = cron.FIRE_LIMIT, 4000
+        try:
+            counts = rows(cron.run_counts(specs, bases, edges))
+        finally:
+            cron.FIRE_LIMIT = limit
+        self.assertEqual([[c - r[0] for c in r] for r in counts],
+            [[c - r[0] for c in r] for r in expected])
+    
+    def test_many_lists(self):
+        numpy, cron.numpy = cron.numpy, None
+        try:
+            self.check_many()
+        finally:
+            cron.numpy = numpy
+    
+    def test_many_numpy(self):
+        if cron.numpy == None:
+            # Skipping needs Python 2.7; earlier ones just pass.
+            if hasattr(self, 'skipTest'):
+                self.skipTest(
+                    "NumPy isn't installed, so only lists can be checked.")
+            return
+        self.check_many()
+    
@@ -2,15 +2,19 @@
 """Test schedule handling cases in the SchedulableTask class."""
 
 import os, sys
+import time
 from threading import Thread
 from datetime import timedelta, datetime
 
 from django.test import TestCase
 
-from norc.core.models import Scheduler, Schedule, CronSchedule
+from norc.core.models import (Scheduler, Schedule, CronSchedule, DBQueue,
+    Instance)
 from norc.core.constants import Status, Request
 from norc.norc_utils import wait_until, log
 from norc.norc_utils.testing import make_queue, make_task
+from norc.norc_utils.parallel import ThreadPool
+from norc.core.models import scheduler as scheduler_module
 
 class SchedulerTest(TestCase):
     
@@ -117,3 +121,205 @@ class SchedulerTest(TestCase):
         assert not self.thread.isAlive()
         assert not self._scheduler.timer.isAlive()
     
+
+class ShardTest(TestCase):
+    """Tests sharding schedules among several schedulers."""
+    
+    def make_scheduler(self):
+        s = Scheduler.objects.create(status=Status.RUNNING,
+            heartbeat=datetime.utcnow())
+        s.log = log.Log(os.devnull)
+        return s
+    
+    def claimed(self, scheduler):
+        return set(s.pk for s in Schedule.objects.filter(scheduler=scheduler))
+    
+    def setUp(self):
+        self.task = make_task()
+        self.queue = make_queue()
+        self.schedules = [Schedule.create(self.task, self.queue, 60, 0, 60)
+            for i in range(6)]
+        self.pks = set(s.pk for s in self.schedules)
+    
+    def test_shards(self):
+        a, b = self.make_scheduler(), self.make_scheduler()
+        for s in [a, b]:
+            s.rebalance(s.get_members())
+            s.claim()
+        self.assertEqual(a.members, [a.id, b.id])
+        self.assertEqual(len(self.claimed(a)), 3)
+        self.assertEqual(len(self.claimed(b)), 3)
+        self.assertEqual(self.claimed(a) | self.claimed(b), self.pks)
+        self.assertEqual(len(a.timer), 3)
+    
+    def test_clean_up(self):
+        s = self.make_scheduler()
+        s.rebalance(s.get_members())
+        s.claim()
+        s.timer.start()
+        s.pool = ThreadPool(1)
+        def enqueue():
+            # An enqueue in flight when the scheduler stops.
+            time.sleep(0.2)
+            Schedule.objects.filter(pk__in=self.pks).update(scheduler=s)
+        s.pool.submit(enqueue)
+        s.clean_up()
+        self.assertEqual(self.claimed(s), set())
+    
+    def test_rebalance(self):
+        a, b = self.make_scheduler(), self.make_scheduler()
+        a.rebalance(a.get_members())
+        a.claim()
+        # b dies; a takes over its shard.
+        b.rebalance(b.get_members())
+        b.claim()
+        b.heartbeat = datetime.utcnow() - timedelta(hours=1)
+        b.save()
+        a.rebalance(a.get_members())
+        a.claim(full=True)
+        self.assertEqual(self.claimed(a), self.pks)
+        self.assertEqual(len(a.timer), 6)
+        # c joins; a gives up what is now c's shard.
+        c = self.make_scheduler()
+        c.rebalance(c.get_members())
+        a.rebalance(a.get_members())
+        self.assertEqual(len(self.claimed(a)), 3)
+        self.assertEqual(len(a.timer), 3)
+        c.claim()
+        self.assertEqual(self.claimed(a) | self.claimed(c), self.pks)
+    
+    def test_high_water(self):
+        a = self.make_scheduler()
+        a.rebalance(a.get_members())
+        a.claim()
+        self.assertEqual(self.claimed(a), self.pks)
+        # Orphaned schedules are only found again by a full rescan.
+        old = self.schedules[0]
+        dead = Scheduler.objects.create(status=Status.RUNNING,
+            heartbeat=datetime.utcnow() - timedelta(hours=1))
+        Schedule.objects.filter(pk=old.pk).update(scheduler=dead)
+        new = Schedule.create(self.task, self.queue, 60, 0, 60)
+        a.claim()
+        self.assertEqual(self.claimed(a), self.pks - set([old.pk]) |
+            set([new.pk]))
+        a.claim(full=True)
+        self.assertEqual(self.claimed(a), self.pks | set([new.pk]))
+        # Released ones are found by the next claim, as when a peer gives
+        # them up after this scheduler joined.
+        Schedule.objects.filter(pk=old.pk).update(scheduler=None)
+        a.timer.cancel_task((Schedule, old.pk))
+        a.claim()
+        self.assertEqual(self.claimed(a), self.pks | set([new.pk]))
+    
+
+class EnqueueTest(TestCase):
+    """Tests enqueuing many due schedules at once."""
+    
+    def setUp(self):
+        self.scheduler = Scheduler.objects.create(status=Status.RUNNING,
+            heartbeat=datetime.utcnow())
+        self.scheduler.log = log.Log(os.devnull)
+        self.task = make_task()
+        self.queues = [make_queue(), DBQueue.objects.create(name='Other')]
+    
+    def test_enqueue(self):
+        base = datetime.utcnow() - timedelta(seconds=5)
+        simple = [Schedule.create(self.task, self.queues[i % 2], 60, 2, -5)
+            for i in range(6)]
+        cron = [CronSchedule(encoding='o*d*w*h*m*s*', task=self.task,
+            queue=self.queues[0], repetitions=1, remaining=1, base=base)
+            for i in range(3)]
+        for s in cron:
+            s.save()
+        self.scheduler.members = [self.scheduler.id]
+        self.scheduler.claim()
+        # As if the timer had fired them all.
+        for key in self.scheduler.timer.keys():
+            self.scheduler.timer.cancel_task(key)
+        self.scheduler.enqueue(Schedule, [s.pk for s in simple])
+        self.scheduler.enqueue(CronSchedule, [s.pk for s in cron])
+        self.assertEqual(Instance.objects.count(), 9)
+        self.assertEqual(self.queues[0].count(), 6)
+        self.assertEqual(self.queues[1].count(), 3)
+        items = [self.queues[0].pop() for i in range(6)]
+        self.assertEqual(len(set([i.pk for i in items])), 6)
+        for s in simple:
+            s = Schedule.objects.get(pk=s.pk)
+            self.assertEqual(s.remaining, 1)
+            self.assertTrue(s.next > datetime.utcnow())
+            self.assertEqual(s.scheduler_id, self.scheduler.id)
+            self.assertEqual(s.instances.count(), 1)
+        for s in cron:
+            s = CronSchedule.objects.get(pk=s.pk)
+            self.assertEqual(s.remaining, 0)
+            self.assertEqual(s.scheduler, None)
+        # Only the unfinished schedules go back on the timer.
+        self.assertEqual(len(self.scheduler.timer), 6)
+    
+    def test_horizon(self):
+        near = Schedule.create(self.task, self.queues[0], 3600, 0, -5)
+        far = Schedule.create(self.task, self.queues[0], 60, 0, 3600)
+        cron = CronSchedule.create(self.task, self.queues[0],
+            'o*d*w*h%sm*s*' % ((datetime.utcnow().hour + 2) % 24))
+        self.assertTrue(CronSchedule.objects.get(pk=cron.pk).next >
+            datetime.utcnow() + timedelta(hours=1))
+        self.scheduler.members = [self.scheduler.id]
+        self.scheduler.claim()
+        self.assertEqual(len(self.scheduler.timer), 1)
+        self.scheduler.timer.cancel_task((Schedule, near.pk))
+        self.scheduler.enqueue(Schedule, [near.pk])
+        # Its next run is an hour off, so it's let go.
+        self.assertEqual(Schedule.objects.get(pk=near.pk).scheduler, None)
+        self.assertEqual(len(self.scheduler.timer), 0)
+        Schedule.objects.filter(pk=far.pk).update(
+            next=datetime.utcnow() + timedelta(seconds=60))
+        self.scheduler.claim(full=True)
+        self.assertEqual(self.scheduler.timer.keys(), [(Schedule, far.pk)])
+    
+    def test_concurrent_copy(self):
+        s = Schedule.create(self.task, self.queues[0], 60, 0, -5)
+        running = Instance.objects.create(task=self.task, schedule=s)
+        self.scheduler.members = [self.scheduler.id]
+        self.scheduler.claim()
+        self.scheduler.timer.cancel_task((Schedule, s.pk))
+        # A speculative copy of the running instance is made right after
+        # the insert, sharing its schedule.
+        insert_many = scheduler_module.insert_many
+        def insert_and_copy(model, objects):
+            insert_many(model, objects)
+            running.duplicate()
+        scheduler_module.insert_many = insert_and_copy
+        try:
+            self.scheduler.enqueue(Schedule, [s.pk])
+        finally:
+            scheduler_module.insert_many = insert_many
+        item = self.queues[0].pop()
+        self.assertEqual(item.duplicate_of, None)
+        self.assertNotEqual(item.pk, running.pk)
+        self.assertEqual(item.schedule_id, s.pk)
+    
+    def test_claim_next(self):
+        stored, fresh = [CronSchedule.create(self.task, self.queues[0],
+            'o*d*w*h*m*s0') for i in range(2)]
+        later = datetime.utcnow().replace(microsecond=0) + \
+            timedelta(minutes=5)
+        CronSchedule.objects.filter(pk=stored.pk).update(next=later)
+        CronSchedule.objects.filter(pk=fresh.pk).update(next=None)
+        added = {}
+        def add_key(key, next):
+            added[key[1]] = next
+        self.scheduler.add_key = add_key
+        self.scheduler.members = [self.scheduler.id]
+        self.scheduler.claim()
+        # The stored next run is used as is; a missing one is worked out.
+        self.assertEqual(added, {stored.pk: later, fresh.pk: fresh.next})
+    
+    def test_not_due(self):
+        s = Schedule.create(self.task, self.queues[0], 60, 1, 60)
+        self.scheduler.members = [self.scheduler.id]
+        self.scheduler.claim()
+        self.scheduler.timer.cancel_task((Schedule, s.pk))
+        self.scheduler.enqueue(Schedule, [s.pk])
+        self.assertEqual(Instance.objects.count(), 0)
+        self.assertEqual(len(self.scheduler.timer), 1)
+    
@@ -0,0 +1,72 @@
+"""Tests for the supervisor."""
+
+import os
+import time
+from datetime import datetime, timedelta
+from subprocess import Popen
+
+from django.test import TestCase
+
+from norc.core.models import Supervisor, Executor, DBQueue
+from norc.core.constants import Status, Request, RESTART_DELAY
+from norc.norc_utils import log
+
+class SupervisorTest(TestCase):
+    """Tests restarting and controlling supervised executors."""
+    
+    def setUp(self):
+        self.supervisor = Supervisor.objects.create(status=Status.RUNNING)
+        self.supervisor.log = log.Log(os.devnull)
+        self.queue = DBQueue.objects.create(name='test')
+    
+    def exited(self, status, code):
+        """Adds a finished child with an executor in the given status."""
+        p = Popen(['sh', '-c', 'exit %s' % code])
+        p.wait()
+        p.spec, p.launched = 'test -c 1', time.time()
+        self.supervisor.children[p.pid] = p
+        return Executor.objects.create(queue=self.queue, concurrent=1,
+            supervisor=self.supervisor, pid=p.pid, status=status)
+    
+    def test_restart(self):
+        executor = self.exited(Status.RUNNING, 1)
+        self.supervisor.reap()
+        self.assertEqual(self.supervisor.children, {})
+        self.assertEqual(Executor.objects.get(pk=executor.pk).status,
+            Status.ERROR)
+        self.assertEqual(len(self.supervisor.restarts), 1)
+        when, spec = self.supervisor.restarts[0]
+        self.assertEqual(spec, 'test -c 1')
+        self.assertTrue(when > time.time() + RESTART_DELAY - 1)
+    
+    def test_no_restart(self):
+        self.exited(Status.ENDED, 0)
+        self.supervisor.reap()
+        self.assertEqual(self.supervisor.restarts, [])
+        self.supervisor.status = Status.STOPPING
+        self.exited(Status.RUNNING, 1)
+        self.supervisor.reap()
+        self.assertEqual(self.supervisor.restarts, [])
+    
+    def test_control(self):
+        self.assertTrue('RUNNING' in self.supervisor.control('status'))
+        self.assertTrue('Unknown' in self.supervisor.control('bogus'))
+        self.supervisor.control('stop')
+        self.assertEqual(Supervisor.objects.get(
+            pk=self.supervisor.pk).request, Request.STOP)
+    
+    def test_heartbeat(self):
+        executor = Executor.objects.create(queue=self.queue, concurrent=1,
+            supervisor=self.supervisor, status=Status.RUNNING,
+            heartbeat=datetime.utcnow() - timedelta(minutes=1))
+        executor = Executor.objects.get(pk=executor.pk)
+        beat = datetime.utcnow()
+        self.supervisor.executors.update(heartbeat=beat)
+        # Saving the executor doesn't turn back the supervisor's beat.
+        executor.concurrent = 2
+        executor.save()
+        executor = Executor.objects.get(pk=executor.pk)
+        self.assertEqual(executor.concurrent, 2)
+        self.assertEqual(executor.heartbeat, beat)
+        self.assertTrue(executor.alive)
+    
@@ -3,6 +3,7 @@
 
 import os
 import time
+from datetime import datetime
 
 from django.test import TestCase
 
@@ -33,3 +34,102 @@ class TestCommandTask(TestCase):
             CommandTask.objects.create(
                 name='Timeout', command='sleep 5', timeout=1)))
     
+    def test_split(self):
+        """Tests which commands are run without a shell."""
+        self.assertEqual(CommandTask.split('echo hi'), ['echo', 'hi'])
+        self.assertEqual(CommandTask.split('echo "a b"'), ['echo', 'a b'])
+        for cmd in ['ls | wc', 'cd /tmp', 'FOO=1 env', 'echo $HOME',
+            'ls *.py', 'echo "unbalanced']:
+            self.assertEqual(CommandTask.split(cmd), None)
+        self.assertEqual(Status.SUCCESS, self.run_task(
+            CommandTask.objects.create(name='nice', command='true', nice=5)))
+    
+    def test_no_exit(self):
+        """Tests that instances can be run in sequence in one process."""
+        ct = CommandTask.objects.create(name='batch', command='true')
+        instances = [Instance.objects.create(task=ct) for i in range(2)]
+        for instance in instances:
+            instance.log = log.Log(os.devnull)
+            instance.start(exit=False)
+        self.assertEqual([i.status for i in Instance.objects.filter(
+            pk__in=[i.pk for i in instances])], [Status.SUCCESS] * 2)
+    
+    
+
+class SpeculationTest(TestCase):
+    """Tests settling the copies of speculatively executed instances."""
+    
+    def setUp(self):
+        self.task = CommandTask.objects.create(name='idempotent',
+            command='true', idempotent=True)
+        self.original = Instance.objects.create(task=self.task,
+            status=Status.RUNNING)
+        self.copy = self.original.duplicate()
+    
+    def run_instance(self, instance):
+        instance.log = log.Log(os.devnull)
+        try:
+            instance.start()
+        except SystemExit:
+            pass
+        return Instance.objects.get(pk=instance.pk).status
+    
+    def test_duplicate(self):
+        self.assertEqual(self.copy.duplicate_of, self.original)
+        self.assertEqual(self.copy.task, self.task)
+        self.assertEqual(self.copy.status, Status.CREATED)
+        self.assertEqual(list(self.original.duplicates.all()), [self.copy])
+    
+    def test_copy_wins(self):
+        self.assertEqual(self.run_instance(self.copy), Status.SUCCESS)
+        self.assertEqual(Instance.objects.get(pk=self.original.pk).status,
+            Status.SUCCESS)
+    
+    def test_original_wins(self):
+        self.original.status = Status.CREATED
+        self.assertEqual(self.run_instance(self.original), Status.SUCCESS)
+        self.assertEqual(Instance.objects.get(pk=self.copy.pk).status,
+            Status.SUPERSEDED)
+    
+    def test_loser_keeps_result(self):
+        Instance.objects.filter(pk=self.copy.pk).update(
+            status=Status.SUPERSEDED)
+        self.copy.log = log.Log(os.devnull)
+        self.copy.status = Status.INTERRUPTED
+        self.copy.resolve()
+        self.assertEqual(self.copy.status, Status.SUPERSEDED)
+        self.assertEqual(Instance.objects.get(pk=self.copy.pk).status,
+            Status.SUPERSEDED)
+    
+    def test_both_succeed(self):
+        # Neither has seen the other's result before settling.
+        for instance in [self.original, self.copy]:
+            instance.log = log.Log(os.devnull)
+            instance.status = Status.SUCCESS
+            instance.ended = datetime.utcnow()
+        self.copy.resolve()
+        self.original.resolve()
+        self.assertEqual(self.original.status, Status.SUPERSEDED)
+        self.assertEqual(Instance.objects.get(pk=self.original.pk).status,
+            Status.SUCCESS)
+        self.assertEqual(Instance.objects.get(pk=self.copy.pk).status,
+            Status.SUCCESS)
+    
+    def test_original_failed(self):
+        Instance.objects.filter(pk=self.original.pk).update(
+            status=Status.FAILURE)
+        self.assertEqual(self.run_instance(self.copy), Status.SUCCESS)
+        self.assertEqual(Instance.objects.get(pk=self.original.pk).status,
+            Status.FAILURE)
+    
+    def test_expected_duration(self):
+        for i in range(1, 9):
+            Instance.objects.create(task=self.task, status=Status.SUCCESS,
+                wall_time=i)
+        self.assertEqual(self.original.expected_duration(), None)
+        for i in range(9, 21):
+            Instance.objects.create(task=self.task, status=Status.SUCCESS,
+                wall_time=i)
+        self.assertEqual(self.original.expected_duration(), 19)
+        self.assertEqual(self.original.expected_duration(50), 10)
+    
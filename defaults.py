@@ -35,6 +35,8 @@ class BaseEnv(object):
     # See core/reports.py for options.
     STATUS_TABLES = ['executors', 'queues', 'schedulers', 'tasks']
     EXTERNAL_CLASSES = [];
+    # The timer schedulers use: 'heap', or 'wheel' for many schedules.
+    SCHEDULER_TIMER = 'heap'
     
     # Important Django settings.
     ADMINS = ()
@@ -0,0 +1,400 @@
+
+"""Cron field lists compiled into bitmasks for finding next fire times.
+
+Each field of a cron encoding becomes an integer with a bit set for each
+value it allows, so finding the next allowed value is a shift and a bit
+trick instead of a search.  Days of the month and days of the week are
+combined ahead of time for each weekday a month can start on, so a month
+is checked for a matching day in one step too.
+
+next_times() finds the next few runs of many schedules at once, as rows of
+an array, and run_counts() counts their runs up to a set of times.  NumPy
+is used for this if it's installed; otherwise the rows are lists, with
+None where NumPy would have NaN.
+
+"""
+
+import calendar
+import math
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta, MAXYEAR
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Weekdays and leap years line up again every 400 years, so a date that
+# doesn't match in that time never will.
+CYCLE_YEARS = 400
+
+ONE_SECOND = timedelta(seconds=1)
+
+# The most times next_times() lists for one spec.  Bases beyond them have
+# their times found one by one.
+FIRE_LIMIT = 100000
+
+def to_epoch(dt):
+    """Seconds since the epoch for a naive UTC datetime."""
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+
+def from_epoch(t):
+    """The naive UTC datetime for seconds since the epoch."""
+    return datetime.utcfromtimestamp(t)
+
+def mask(values):
+    """Returns an integer with the bit for each of values set."""
+    m = 0
+    for v in values:
+        m |= 1 << v
+    return m
+
+# The lowest bit set in each byte, since int.bit_length() is new in
+# Python 2.7.
+LOW_BITS = [None] + [min([i for i in range(8) if b >> i & 1])
+    for b in range(1, 256)]
+
+def next_bit(m, n):
+    """Returns the lowest bit set in m that is >= n, or None."""
+    m >>= n
+    if not m:
+        return None
+    while not m & 0xff:
+        m >>= 8
+        n += 8
+    return n + LOW_BITS[m & 0xff]
+
+# Masks of the days in a month of each length.
+MONTH_LENGTHS = dict([(n, mask(range(1, n + 1))) for n in range(28, 32)])
+
+class CronSpec(object):
+    """The lists of a cron encoding, compiled into bitmasks.
+    
+    The lists are kept as tuples alongside their masks, and none of it
+    should be changed once made since specs are shared between schedules.
+    
+    """
+    __slots__ = ['months', 'days', 'daysofweek', 'hours', 'minutes',
+        'seconds', 'month_mask', 'hour_mask', 'minute_mask', 'second_mask',
+        'day_masks']
+    
+    def __init__(self, months, days, daysofweek, hours, minutes, seconds):
+        self.months = tuple(months)
+        self.days = tuple(days)
+        self.daysofweek = tuple(daysofweek)
+        self.hours = tuple(hours)
+        self.minutes = tuple(minutes)
+        self.seconds = tuple(seconds)
+        self.month_mask = mask(months)
+        self.hour_mask = mask(hours)
+        self.minute_mask = mask(minutes)
+        self.second_mask = mask(seconds)
+        # The allowed days of a month whose first day falls on each weekday.
+        self.day_masks = [mask([d for d in days
+            if (first + d - 1) % 7 in daysofweek]) for first in range(7)]
+    
+    def next(self, dt):
+        """Returns the first time after dt that matches, or None.
+        
+        A day must match both the days and the days of the week.  None is
+        only returned when no time will ever match.
+        
+        """
+        dt = dt.replace(microsecond=0) + ONE_SECOND
+        year, month, day = dt.year, dt.month, dt.day
+        hour, minute, second = dt.hour, dt.minute, dt.second
+        last = min(year + CYCLE_YEARS, MAXYEAR)
+        # Each pass either finds a time or moves on to the start of the
+        # next possible month, day, hour or minute.
+        while year <= last:
+            m = next_bit(self.month_mask, month)
+            if m == None:
+                year, month, day = year + 1, 1, 1
+                hour, minute, second = 0, 0, 0
+                continue
+            if m != month:
+                month, day, hour, minute, second = m, 1, 0, 0, 0
+            first, length = calendar.monthrange(year, month)
+            d = next_bit(self.day_masks[first] & MONTH_LENGTHS[length], day)
+            if d == None:
+                month, day, hour, minute, second = month + 1, 1, 0, 0, 0
+                continue
+            if d != day:
+                day, hour, minute, second = d, 0, 0, 0
+            h = next_bit(self.hour_mask, hour)
+            if h == None:
+                day, hour, minute, second = day + 1, 0, 0, 0
+                continue
+            if h != hour:
+                hour, minute, second = h, 0, 0
+            mi = next_bit(self.minute_mask, minute)
+            if mi == None:
+                hour, minute, second = hour + 1, 0, 0
+                continue
+            if mi != minute:
+                minute, second = mi, 0
+            s = next_bit(self.second_mask, second)
+            if s == None:
+                minute, second = minute + 1, 0
+                continue
+            return datetime(year, month, day, hour, minute, s)
+        return None
+    
+
+def shift(spec):
+    """Splits spec into the fields of one starting each day at midnight
+    and the seconds into the day its times are offset by.
+    
+    Specs that only differ in when during the day they start, like daily
+    schedules at random times, come out the same and can be worked out
+    together.
+    
+    """
+    h, m, s = min(spec.hours), min(spec.minutes), min(spec.seconds)
+    fields = (spec.months, spec.days, spec.daysofweek,
+        tuple([v - h for v in spec.hours]),
+        tuple([v - m for v in spec.minutes]),
+        tuple([v - s for v in spec.seconds]))
+    return fields, 3600 * h + 60 * m + s
+
+def _groups(specs):
+    """The shifted specs of specs, each with the indices and offsets of
+    those that shift to it."""
+    shifts, groups = {}, {}
+    for i, spec in enumerate(specs):
+        if not id(spec) in shifts:
+            shifts[id(spec)] = shift(spec)
+        fields, offset = shifts[id(spec)]
+        groups.setdefault(fields, []).append((i, offset))
+    return [(CronSpec(*fields), members)
+        for fields, members in groups.iteritems()]
+
+def _chain(spec, base, count):
+    """The next count times after base one by one, padded with None."""
+    row, dt = [], from_epoch(base)
+    while len(row) < count and dt != None:
+        dt = spec.next(dt)
+        if dt != None:
+            row.append(to_epoch(dt))
+    return row + [None] * (count - len(row))
+
+def empty(rows, count):
+    """An array of rows with count blank times each."""
+    if numpy:
+        times = numpy.empty((rows, count))
+        times.fill(numpy.nan)
+        return times
+    return [[None] * count for _ in range(rows)]
+
+def zeros(rows, count):
+    """An array of rows with count zero counts each."""
+    if numpy:
+        return numpy.zeros((rows, count), dtype=int)
+    return [[0] * count for _ in range(rows)]
+
+def _start(spec, bases, count):
+    """Where to start listing the times for bases in next_times().
+    
+    Listing from a base costs a time for each one between it and the last
+    base, while stepping a base through the spec alone costs count.  The
+    start is the base that costs least in total, so a few bases far below
+    the rest are stepped through alone.  How far apart times are is judged
+    from the first count after the last base.
+    
+    """
+    last = max(bases)
+    ahead = [t for t in _chain(spec, last, count) if t != None]
+    if not ahead:
+        return min(bases)
+    gap = max((ahead[-1] - last) / len(ahead), 1)
+    ordered = sorted(bases)
+    costs = [(last - b) / gap + count * i for i, b in enumerate(ordered)]
+    return ordered[costs.index(min(costs))]
+
+def next_times(spec, bases, count=1):
+    """Returns the next count times of spec after each of bases.
+    
+    Times are in seconds since the epoch, one row per base.  The times
+    from the start given by _start() on are listed once and each base
+    looks up where it falls in them, rather than each base being stepped
+    through the spec separately.
+    
+    """
+    bases = list(bases)
+    if not bases:
+        return empty(0, count)
+    last = max(bases)
+    first = _start(spec, bases, count)
+    fires, t, beyond = [], first, 0
+    while beyond < count and len(fires) < FIRE_LIMIT:
+        dt = spec.next(from_epoch(t))
+        if dt == None:
+            break
+        t = to_epoch(dt)
+        fires.append(t)
+        if t > last:
+            beyond += 1
+    if numpy:
+        f = numpy.array(fires, dtype=float)
+        index = numpy.searchsorted(f, numpy.array(bases, dtype=float),
+            side='right')[:, numpy.newaxis] + numpy.arange(count)
+        times = empty(len(bases), count)
+        listed = index < len(f)
+        times[listed] = f[index[listed]]
+        short = numpy.flatnonzero(~listed[:, -1] |
+            (numpy.array(bases, dtype=float) < first))
+    else:
+        times = []
+        for base in bases:
+            i = bisect_right(fires, base)
+            row = fires[i:i + count]
+            times.append(row + [None] * (count - len(row)))
+        short = [i for i, row in enumerate(times)
+            if row[-1] == None or bases[i] < first]
+    for i in short:
+        row = _chain(spec, bases[i], count)
+        if numpy:
+            row = [numpy.nan if t == None else t for t in row]
+        times[i] = row
+    return times
+
+def next_times_many(specs, bases, count=1):
+    """Returns the next count times of each of specs after its base.
+    
+    Specs that shift() to the same fields are worked out together by
+    next_times(), with each base moved back by its offset and the offset
+    added to its times after.
+    
+    """
+    times = empty(len(bases), count)
+    for spec, members in _groups(specs):
+        found = next_times(spec, [bases[i] - o for i, o in members], count)
+        if numpy:
+            index = [i for i, o in members]
+            times[index] = found + numpy.array([o for i, o in members],
+                dtype=float)[:, numpy.newaxis]
+        else:
+            for (i, o), row in zip(members, found):
+                times[i] = [None if t == None else t + o for t in row]
+    return times
+
+def _fires(spec, start, end):
+    """The times of spec after start and before end, and whether that's
+    all of them or FIRE_LIMIT stopped the listing."""
+    fires, dt = [], from_epoch(start)
+    while len(fires) < FIRE_LIMIT:
+        dt = spec.next(dt)
+        if dt == None:
+            return fires, True
+        t = to_epoch(dt)
+        if t >= end:
+            return fires, True
+        fires.append(t)
+    return fires, False
+
+def run_counts(specs, bases, edges):
+    """Counts the times of each of specs after its base and before each
+    of edges.
+    
+    There's a row per base with a count per edge.  Specs are grouped as
+    in next_times_many() and each group's times are only listed up to the
+    last edge.  They're listed from no earlier than the span of the edges
+    before the first, so times before that after a stale base aren't
+    counted.  If a group still has too many times before the first edge
+    to list, only its times from the first edge on are counted.
+    
+    """
+    counts = zeros(len(bases), len(edges))
+    lookback = 2 * edges[0] - edges[-1]
+    for spec, members in _groups(specs):
+        offsets = [o for i, o in members]
+        shifted = [max(bases[i], lookback) - o for i, o in members]
+        last = edges[-1] - min(offsets)
+        fires, listed = _fires(spec, min(shifted), last)
+        if not listed:
+            first = edges[0] - max(offsets) - 1
+            shifted = [max(b, first) for b in shifted]
+            fires = _fires(spec, first, last)[0]
+        if numpy:
+            f = numpy.array(fires, dtype=float)
+            before = numpy.searchsorted(f, numpy.array(edges, dtype=float) -
+                numpy.array(offsets, dtype=float)[:, numpy.newaxis])
+            after = numpy.searchsorted(f, numpy.array(shifted, dtype=float),
+                side='right')
+            counts[[i for i, o in members]] = numpy.maximum(
+                before - after[:, numpy.newaxis], 0)
+        else:
+            for (i, o), base in zip(members, shifted):
+                after = bisect_right(fires, base)
+                counts[i] = [max(bisect_left(fires, e - o) - after, 0)
+                    for e in edges]
+    return counts
+
+def periodic_times(starts, periods, count=1):
+    """The first count times of each start plus multiples of its period."""
+    if numpy:
+        return numpy.array(starts, dtype=float)[:, numpy.newaxis] + \
+            numpy.array(periods, dtype=float)[:, numpy.newaxis] * \
+            numpy.arange(count)
+    return [[s + p * k for k in range(count)]
+        for s, p in zip(starts, periods)]
+
+def periodic_counts(starts, periods, edges):
+    """Counts the times of each start plus multiples of its period before
+    each of edges.  Those with no period are counted as one time."""
+    if numpy:
+        gaps = numpy.array(edges, dtype=float) - \
+            numpy.array(starts, dtype=float)[:, numpy.newaxis]
+        periods = numpy.array(periods, dtype=float)[:, numpy.newaxis]
+        counts = numpy.where(periods > 0,
+            numpy.ceil(gaps / numpy.where(periods > 0, periods, 1)),
+            gaps > 0)
+        return numpy.maximum(counts, 0).astype(int)
+    return [[max(int(math.ceil((e - s) / float(p))), 0) if p
+        else int(e > s) for e in edges] for s, p in zip(starts, periods)]
+
+def truncate(times, lengths):
+    """Blanks the times in each row past its length, if it has one."""
+    if numpy:
+        lengths = numpy.array([numpy.inf if n == None else n
+            for n in lengths])
+        times[numpy.arange(times.shape[1]) >= lengths[:, numpy.newaxis]] = \
+            numpy.nan
+    else:
+        for row, n in zip(times, lengths):
+            if n != None:
+                row[n:] = [None] * len(row[n:])
+    return times
+
+def cap(counts, lengths):
+    """Limits the counts in each row to its length, if it has one."""
+    if numpy:
+        limited = [i for i, n in enumerate(lengths) if n != None]
+        if limited:
+            counts[limited] = numpy.minimum(counts[limited], numpy.array(
+                [lengths[i] for i in limited])[:, numpy.newaxis])
+    else:
+        for row, n in zip(counts, lengths):
+            if n != None:
+                row[:] = [min(c, n) for c in row]
+    return counts
+
+def histogram(counts, buckets):
+    """Tallies counts from run_counts() between each of buckets pairs of
+    edges.
+    
+    Returns the number of times and the number of rows with a time
+    between each pair.
+    
+    """
+    if numpy:
+        between = numpy.diff(counts, axis=1)
+        return between.sum(axis=0).tolist(), \
+            (between > 0).sum(axis=0).tolist()
+    runs, rows = [0] * buckets, [0] * buckets
+    for row in counts:
+        for k in range(buckets):
+            n = row[k + 1] - row[k]
+            runs[k] += n
+            rows[k] += n > 0
+    return runs, rows
@@ -3,7 +3,8 @@
 
 import itertools
 
-from django.db.models import Manager
+from django.db import connection, transaction
+from django.db.models import Manager, AutoField
 
 # Replaced in Django 1.2 by QuerySet.exists()
 def queryset_exists(q):
@@ -30,6 +31,42 @@ def get_object(model, **kwargs):
 def update_obj(obj):
     return type(obj).objects.get(pk=obj.pk)
 
+def insert_many(model, objects):
+    """Inserts new objects of the given model with a single query.
+    
+    Unlike save(), this sends no signals and doesn't set the objects'
+    primary keys; they have to be looked up afterwards if needed.
+    
+    """
+    if not objects:
+        return
+    fields = [f for f in model._meta.local_fields
+        if not isinstance(f, AutoField)]
+    qn = connection.ops.quote_name
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (qn(model._meta.db_table),
+        ', '.join([qn(f.column) for f in fields]),
+        ', '.join(['%s'] * len(fields)))
+    rows = [[f.get_db_prep_save(f.pre_save(obj, True),
+        connection=connection) for f in fields] for obj in objects]
+    connection.cursor().executemany(sql, rows)
+    transaction.commit_unless_managed()
+
+def update_grouped(model, objects, fields):
+    """Saves the given fields of objects with one UPDATE per distinct value.
+    
+    Objects that share the same values for all of fields are updated
+    together, so this is cheap when most of them changed the same way.
+    
+    """
+    fields = [model._meta.get_field(name) for name in fields]
+    groups = {}
+    for obj in objects:
+        values = tuple([getattr(obj, f.attname) for f in fields])
+        groups.setdefault(values, []).append(obj.pk)
+    for values, pks in groups.iteritems():
+        model.objects.filter(pk__in=pks).update(
+            **dict(zip([f.name for f in fields], values)))
+
 class QuerySetManager(Manager):
     """
     
@@ -1,10 +1,14 @@
 
 from __future__ import division
 
+import sys
 import time
+import math
+import itertools
 from datetime import datetime, timedelta
-from threading import Thread, Event, RLock
-from heapq import heappop, heappush
+from threading import Thread, Event, Lock, RLock
+from heapq import heappop, heappush, heapify
+from Queue import Queue, Empty, Full
 import traceback
 
 def total_secs(td):
@@ -12,257 +16,480 @@ def total_secs(td):
     return (td.microseconds +
         (td.seconds + td.days * 24 * 3600) * 10**6) / float(10**6)
 
+def timestamp(delay):
+    """The time.time() after delay, a number, timedelta or datetime."""
+    if type(delay) == datetime:
+        now = datetime.utcnow()
+        delay = delay - now if now < delay else 0
+    if type(delay) == timedelta:
+        delay = total_secs(delay)
+    return time.time() + delay
+
+def run_calls(calls, dispatch=None):
+    """Makes (func, args, kwargs) calls, or hands them all to dispatch."""
+    if dispatch != None:
+        calls = [(dispatch, [calls], {})]
+    for func, args, kwargs in calls:
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            traceback.print_exc()
+
+class _TimerEntry(object):
+    """A task in a MultiTimer or TimingWheel."""
+    
+    __slots__ = ['when', 'seq', 'key', 'func', 'args', 'kwargs', 'slot']
+    
+    def __init__(self, when, key, func, args, kwargs, seq=0):
+        self.when, self.seq, self.key = when, seq, key
+        self.func, self.args, self.kwargs = func, args, kwargs
+        self.slot = None
+    
+    def __lt__(self, other):
+        return (self.when, self.seq) < (other.when, other.seq)
+    
+
 class MultiTimer(Thread):
-    """A timer implementation that can handle multiple tasks at once."""
+    """A timer implementation that can handle multiple tasks at once.
     
-    def __init__(self):
+    Each task has a key, which add_task() returns as its handle; a key
+    has at most one task pending at a time.  Tasks are kept in a heap
+    with an index from key to entry.  Cancelling only marks the entry
+    dead, to be dropped once it surfaces, so adding, cancelling and
+    rescheduling each take O(log n).  A lock guards every access.
+    
+    Tasks are called on the timer's thread unless dispatch is given.  It
+    is then called with a list of the (func, args, kwargs) of all tasks
+    due at once, and should hand them off to be run elsewhere.
+    
+    """
+    def __init__(self, dispatch=None):
         Thread.__init__(self)
-        self.tasks = [] # SortedList(reverse=True)
+        self.dispatch = dispatch
+        # A heap of _TimerEntry objects, ordered by when they're due.
+        self.tasks = []
+        self.index = {}
+        self.counter = itertools.count()
+        self.lock = Lock()
         self.cancelled = False
         self.interrupt = Event()
     
     def run(self):
         while not self.cancelled:
-            if len(self.tasks) == 0:
-                self.interrupt.wait()
-                self.interrupt.clear()
+            due = []
+            delay = None
+            self.lock.acquire()
+            try:
+                now = time.time()
+                while self.tasks and (self.tasks[0].func == None or
+                    self.tasks[0].when <= now):
+                    entry = heappop(self.tasks)
+                    if entry.func != None:
+                        del self.index[entry.key]
+                        due.append((entry.func, entry.args, entry.kwargs))
+                if self.tasks:
+                    delay = self.tasks[0].when - now
+            finally:
+                self.lock.release()
+            if due:
+                run_calls(due, self.dispatch)
             else:
-                self.interrupt.wait(self.tasks[0][0] - time.time())
-                if not self.interrupt.isSet():
-                    func, args, kwargs = heappop(self.tasks)[1:]
-                    # self.tasks.pop()
-                    # assert item == self.tasks.pop()
-                    try:
-                        func(*args, **kwargs)
-                    except Exception:
-                        traceback.print_exc()
-                else:
-                    self.interrupt.clear()
+                self.interrupt.wait(delay)
+                self.interrupt.clear()
     
     def cancel(self):
         self.cancelled = True
         self.interrupt.set()
     
-    def add_task(self, delay, func, args=[], kwargs={}):
-        if type(delay) == datetime:
-            now = datetime.utcnow()
-            delay = delay - now if now < delay else 0
-        if type(delay) == timedelta:
-            delay = total_secs(delay)
-        delay += time.time()
-        item = (delay, func, args, kwargs)
-        heappush(self.tasks, item)
-        # self.tasks.add(item)
-        if item == self.tasks[0]: # .peek():
-            self.interrupt.set()
-    
-
-## {{{ http://code.activestate.com/recipes/203871/ (r3)
-import threading
-from time import sleep
-
-class ThreadPool:
-
-    """Flexible thread pool class.  Creates a pool of threads, then
-    accepts tasks that will be dispatched to the next available
-    thread."""
-    
-    def __init__(self, numThreads):
-
-        """Initialize the thread pool with numThreads workers."""
-        
-        self.__threads = []
-        self.__resizeLock = threading.Condition(threading.Lock())
-        self.__taskLock = threading.Condition(threading.Lock())
-        self.__tasks = []
-        self.__isJoining = False
-        self.setThreadCount(numThreads)
-
-    def setThreadCount(self, newNumThreads):
-
-        """ External method to set the current pool size.  Acquires
-        the resizing lock, then calls the internal version to do real
-        work."""
+    def add_task(self, delay, func, args=[], kwargs={}, key=None):
+        """Runs func after delay, replacing any task pending for key.
         
-        # Can't change the thread count if we're shutting down the pool!
-        if self.__isJoining:
-            return False
+        delay can be a number of seconds, a timedelta or a datetime.
+        Returns the key, or a new one if none was given.
         
-        self.__resizeLock.acquire()
+        """
+        when = timestamp(delay)
+        if key == None:
+            key = object()
+        self.lock.acquire()
         try:
-            self.__setThreadCountNolock(newNumThreads)
+            self._add(when, func, args, kwargs, key)
         finally:
-            self.__resizeLock.release()
+            self.lock.release()
+        return key
+    
+    def cancel_task(self, key):
+        """Cancels the task pending for key.  Returns whether there was one."""
+        self.lock.acquire()
+        try:
+            return self._cancel(key)
+        finally:
+            self.lock.release()
+    
+    def reschedule(self, key, delay):
+        """Moves the task pending for key.  Returns whether there was one."""
+        when = timestamp(delay)
+        self.lock.acquire()
+        try:
+            entry = self.index.get(key)
+            if entry == None:
+                return False
+            self._add(when, entry.func, entry.args, entry.kwargs, key)
+            return True
+        finally:
+            self.lock.release()
+    
+    def _add(self, when, func, args, kwargs, key):
+        self._cancel(key)
+        entry = _TimerEntry(when, key, func, args, kwargs,
+            self.counter.next())
+        heappush(self.tasks, entry)
+        self.index[key] = entry
+        if self.tasks[0] is entry:
+            self.interrupt.set()
+    
+    def _cancel(self, key):
+        entry = self.index.pop(key, None)
+        if entry == None:
+            return False
+        entry.func = entry.args = entry.kwargs = None
+        # Don't let dead entries pile up past the live ones.
+        if len(self.tasks) > 2 * len(self.index) + 32:
+            self.tasks = [e for e in self.tasks if e.func != None]
+            heapify(self.tasks)
         return True
-
-    def __setThreadCountNolock(self, newNumThreads):
-        
-        """Set the current pool size, spawning or terminating threads
-        if necessary.  Internal use only; assumes the resizing lock is
-        held."""
-        
-        # If we need to grow the pool, do so
-        while newNumThreads > len(self.__threads):
-            newThread = ThreadPoolThread(self)
-            self.__threads.append(newThread)
-            newThread.start()
-        # If we need to shrink the pool, do so
-        while newNumThreads < len(self.__threads):
-            self.__threads[0].goAway()
-            del self.__threads[0]
-
-    def getThreadCount(self):
-
-        """Return the number of threads in the pool."""
-        
-        self.__resizeLock.acquire()
+    
+    def keys(self):
+        """The keys of all pending tasks."""
+        self.lock.acquire()
         try:
-            return len(self.__threads)
+            return self.index.keys()
         finally:
-            self.__resizeLock.release()
-
-    def queueTask(self, task, args=None, taskCallback=None):
+            self.lock.release()
+    
+    def __contains__(self, key):
+        return key in self.index
+    
+    def __len__(self):
+        return len(self.index)
+    
 
-        """Insert a task into the queue.  task must be callable;
-        args and taskCallback can be None."""
+class TimingWheel(Thread):
+    """A hierarchical timing wheel with the same interface as MultiTimer.
+    
+    Time is cut into ticks of tick seconds.  The bottom wheel has a slot
+    for each of the next size ticks, and each wheel above it has slots
+    size times wider than the one below.  Whenever a wheel completes a
+    turn, the next slot of the wheel above is emptied into the wheels
+    below it.  Tasks due past the top wheel wait in it and are placed
+    again as it turns.  Adding, cancelling and rescheduling are O(1),
+    and tasks fire within a tick of their time.  dispatch is as for
+    MultiTimer, and gets the tasks due in each tick together.
+    
+    """
+    def __init__(self, tick=0.1, size=64, levels=4, dispatch=None):
+        Thread.__init__(self)
+        self.dispatch = dispatch
+        self.tick, self.size = tick, size
+        self.wheels = [[{} for i in range(size)] for l in range(levels)]
+        self.index = {}
+        # The last tick that has been processed.
+        self.current = int(time.time() / tick)
+        self.lock = Lock()
+        self.cancelled = False
+        self.interrupt = Event()
+    
+    def run(self):
+        while not self.cancelled:
+            due = []
+            self.lock.acquire()
+            try:
+                now = int(time.time() / self.tick)
+                if not self.index:
+                    self.current = now
+                while self.current < now:
+                    self.current += 1
+                    self._turn(due)
+                for entry in due:
+                    del self.index[entry.key]
+                due.sort(key=lambda e: e.when)
+                wait = None
+                if self.index:
+                    wait = (self.current + 1) * self.tick - time.time()
+            finally:
+                self.lock.release()
+            if due:
+                run_calls([(e.func, e.args, e.kwargs) for e in due],
+                    self.dispatch)
+            else:
+                self.interrupt.wait(wait)
+                self.interrupt.clear()
+    
+    def _turn(self, due):
+        """Processes the current tick, adding entries now due to due."""
+        span = self.size ** (len(self.wheels) - 1)
+        for wheel in reversed(self.wheels[1:]):
+            if self.current % span == 0:
+                slot = wheel[(self.current // span) % self.size]
+                entries = slot.values()
+                slot.clear()
+                for entry in entries:
+                    self._place(entry, due)
+            span //= self.size
+        slot = self.wheels[0][self.current % self.size]
+        entries = slot.values()
+        slot.clear()
+        for entry in entries:
+            self._place(entry, due)
+    
+    def _place(self, entry, due=None):
+        """Puts entry in the slot for its tick, or in due if it's past."""
+        target = int(math.ceil(entry.when / self.tick))
+        if target <= self.current:
+            if due != None:
+                entry.slot = None
+                due.append(entry)
+                return
+            target = self.current + 1
+        delta = target - self.current
+        span = 1
+        for wheel in self.wheels:
+            if delta < span * self.size or wheel is self.wheels[-1]:
+                break
+            span *= self.size
+        entry.slot = wheel[(target // span) % self.size]
+        entry.slot[entry.key] = entry
+    
+    def cancel(self):
+        self.cancelled = True
+        self.interrupt.set()
+    
+    def add_task(self, delay, func, args=[], kwargs={}, key=None):
+        """Runs func after delay, replacing any task pending for key.
         
-        if self.__isJoining == True:
-            return False
-        if not callable(task):
-            return False
+        delay can be a number of seconds, a timedelta or a datetime.
+        Returns the key, or a new one if none was given.
         
-        self.__taskLock.acquire()
+        """
+        when = timestamp(delay)
+        if key == None:
+            key = object()
+        self.lock.acquire()
+        try:
+            self._cancel(key)
+            idle = not self.index
+            if idle:
+                self.current = int(time.time() / self.tick)
+            entry = _TimerEntry(when, key, func, args, kwargs)
+            self._place(entry)
+            self.index[key] = entry
+            if idle:
+                self.interrupt.set()
+        finally:
+            self.lock.release()
+        return key
+    
+    def cancel_task(self, key):
+        """Cancels the task pending for key.  Returns whether there was one."""
+        self.lock.acquire()
+        try:
+            return self._cancel(key)
+        finally:
+            self.lock.release()
+    
+    def reschedule(self, key, delay):
+        """Moves the task pending for key.  Returns whether there was one."""
+        when = timestamp(delay)
+        self.lock.acquire()
         try:
-            self.__tasks.append((task, args, taskCallback))
+            entry = self.index.get(key)
+            if entry == None:
+                return False
+            del entry.slot[key]
+            entry.when = when
+            self._place(entry)
             return True
         finally:
-            self.__taskLock.release()
-
-    def getNextTask(self):
-
-        """ Retrieve the next task from the task queue.  For use
-        only by ThreadPoolThread objects contained in the pool."""
-        
-        self.__taskLock.acquire()
+            self.lock.release()
+    
+    def _cancel(self, key):
+        entry = self.index.pop(key, None)
+        if entry == None:
+            return False
+        del entry.slot[key]
+        return True
+    
+    def keys(self):
+        """The keys of all pending tasks."""
+        self.lock.acquire()
         try:
-            if self.__tasks == []:
-                return (None, None, None)
-            else:
-                return self.__tasks.pop(0)
+            return self.index.keys()
         finally:
-            self.__taskLock.release()
+            self.lock.release()
+    
+    def __contains__(self, key):
+        return key in self.index
+    
+    def __len__(self):
+        return len(self.index)
     
-    def joinAll(self, waitForTasks = True, waitForThreads = True):
-
-        """ Clear the task queue and terminate all pooled threads,
-        optionally allowing the tasks and threads to finish."""
-        
-        # Mark the pool as joining to prevent any more task queueing
-        self.__isJoining = True
 
-        # Wait for tasks to finish
-        if waitForTasks:
-            while self.__tasks != []:
-                sleep(.1)
+class CancelledError(Exception):
+    """Raised when retrieving the result of a cancelled task."""
+    pass
 
-        # Tell all the threads to quit
-        self.__resizeLock.acquire()
+class Future(object):
+    """The eventual result of a task submitted to a ThreadPool."""
+    
+    def __init__(self):
+        self._done = Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._lock = Lock()
+    
+    def done(self):
+        return self._done.isSet()
+    
+    def result(self, timeout=None):
+        """Waits for the task and returns its result or raises its error."""
+        if not self._done.wait(timeout) and not self.done():
+            raise RuntimeError("Timed out waiting for a result.")
+        if self._exception:
+            raise self._exception
+        return self._result
+    
+    def exception(self, timeout=None):
+        """Waits for the task and returns its exception, if any."""
+        if not self._done.wait(timeout) and not self.done():
+            raise RuntimeError("Timed out waiting for a result.")
+        return self._exception
+    
+    def add_done_callback(self, func):
+        """Calls func with this future once the task is finished."""
+        self._lock.acquire()
         try:
-            self.__setThreadCountNolock(0)
-            self.__isJoining = True
-
-            # Wait until all threads have exited
-            if waitForThreads:
-                for t in self.__threads:
-                    t.join()
-                    del t
-
-            # Reset the pool for potential reuse
-            self.__isJoining = False
+            if not self.done():
+                self._callbacks.append(func)
+                return
         finally:
-            self.__resizeLock.release()
-
-
-        
-class ThreadPoolThread(threading.Thread):
-
-    """ Pooled thread class. """
+            self._lock.release()
+        func(self)
+    
+    def _finish(self, result=None, exception=None):
+        self._lock.acquire()
+        try:
+            self._result, self._exception = result, exception
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        finally:
+            self._lock.release()
+        for func in callbacks:
+            try:
+                func(self)
+            except Exception:
+                traceback.print_exc()
     
-    threadSleepTime = 0.1
-
-    def __init__(self, pool):
 
-        """ Initialize the thread and remember the pool. """
+class ThreadPool(object):
+    """A fixed-size pool of threads fed by a bounded queue of tasks.
+    
+    Idle threads block on the queue instead of polling.  If max_queued is
+    positive, no more than that many tasks can wait in the queue; submit()
+    then blocks until there is room, pushing back on the caller.
+    
+    """
+    def __init__(self, num_threads, max_queued=0):
+        self.tasks = Queue(max_queued)
+        self.lock = Lock()
+        self.joining = False
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+        self.busy_time = 0.0
+        self.started = time.time()
+        self.threads = []
+        for i in range(num_threads):
+            t = Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+    
+    def submit(self, func, args=[], kwargs={}, block=True, timeout=None):
+        """Queues func to be called with args and kwargs.
         
-        threading.Thread.__init__(self)
-        self.__pool = pool
-        self.__isDying = False
+        Returns a Future for the result.  If the queue is full and block
+        is False, or timeout seconds pass, Queue.Full is raised.
         
-    def run(self):
-
-        """ Until told to quit, retrieve the next task and execute
-        it, calling the callback if any.  """
+        """
+        if self.joining:
+            raise RuntimeError("Can't submit tasks to a joining pool.")
+        future = Future()
+        self.tasks.put((future, func, args, kwargs), block, timeout)
+        return future
+    
+    def _work(self):
+        while True:
+            item = self.tasks.get()
+            if item == None:
+                self.tasks.task_done()
+                break
+            future, func, args, kwargs = item
+            self.lock.acquire()
+            self.active += 1
+            self.lock.release()
+            start = time.time()
+            result = exception = None
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                exception = sys.exc_info()[1]
+                traceback.print_exc()
+            self.lock.acquire()
+            self.active -= 1
+            self.completed += 1
+            if exception:
+                self.failed += 1
+            self.busy_time += time.time() - start
+            self.lock.release()
+            future._finish(result, exception)
+            self.tasks.task_done()
+    
+    def join(self, wait=True):
+        """Shuts the pool down.
         
-        while self.__isDying == False:
-            cmd, args, callback = self.__pool.getNextTask()
-            # If there's nothing to do, just sleep a bit
-            if cmd is None:
-                sleep(ThreadPoolThread.threadSleepTime)
-            elif callback is None:
-                cmd(*args)
-            else:
-                callback(cmd(*args))
+        If wait is True, every queued task is run first; otherwise queued
+        tasks are cancelled.  Tasks already running are always finished.
+        
+        """
+        self.joining = True
+        if not wait:
+            while True:
+                try:
+                    item = self.tasks.get_nowait()
+                except Empty:
+                    break
+                item[0]._finish(exception=CancelledError())
+                self.tasks.task_done()
+        for t in self.threads:
+            self.tasks.put(None)
+        for t in self.threads:
+            t.join()
     
-    def goAway(self):
-
-        """ Exit the run loop next time through."""
+    def stats(self):
+        """Returns a dict of metrics on the use of this pool.
         
-        self.__isDying = True
-
-# Usage example
-if __name__ == "__main__":
-
-    from random import randrange
-
-    # Sample task 1: given a start and end value, shuffle integers,
-    # then sort them
-    
-    def sortTask(data):
-        print "SortTask starting for ", data
-        numbers = range(data[0], data[1])
-        for a in numbers:
-            rnd = randrange(0, len(numbers) - 1)
-            a, numbers[rnd] = numbers[rnd], a
-        print "SortTask sorting for ", data
-        numbers.sort()
-        print "SortTask done for ", data
-        return "Sorter ", data
-
-    # Sample task 2: just sleep for a number of seconds.
-
-    def waitTask(data):
-        print "WaitTask starting for ", data
-        print "WaitTask sleeping for %d seconds" % data
-        sleep(data)
-        return "Waiter", data
-
-    # Both tasks use the same callback
-
-    def taskCallback(data):
-        print "Callback called for", data
-
-    # Create a pool with three worker threads
-
-    pool = ThreadPool(3)
-
-    # Insert tasks into the queue and let them run
-    pool.queueTask(sortTask, (1000, 100000), taskCallback)
-    pool.queueTask(waitTask, 5, taskCallback)
-    pool.queueTask(sortTask, (200, 200000), taskCallback)
-    pool.queueTask(waitTask, 2, taskCallback)
-    pool.queueTask(sortTask, (3, 30000), taskCallback)
-    pool.queueTask(waitTask, 7, taskCallback)
-
-    # When all tasks are finished, allow the threads to terminate
-    pool.joinAll()
-## end of http://code.activestate.com/recipes/203871/ }}}
+        utilization is the fraction of the pool's thread time since it
+        was created that was spent running tasks.
+        
+        """
+        self.lock.acquire()
+        try:
+            elapsed = (time.time() - self.started) * len(self.threads)
+            return dict(threads=len(self.threads), active=self.active,
+                queued=self.tasks.qsize(), completed=self.completed,
+                failed=self.failed,
+                utilization=self.busy_time / elapsed if elapsed else 0.0)
+        finally:
+            self.lock.release()
+    
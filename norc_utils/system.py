@@ -0,0 +1,177 @@
+"""Utilities for inspecting the host system and controlling processes.
+
+Most of the measurements read from the Linux /proc filesystem.  On
+platforms where that isn't available they return None rather than
+raising, so callers should treat every measurement as optional.  The
+process controls raise OSError if the platform doesn't support them.
+
+"""
+
+import os
+import errno
+
+def cpu_count():
+    """The number of CPUs on this host, defaulting to 1 if unknown."""
+    try:
+        return max(os.sysconf('SC_NPROCESSORS_ONLN'), 1)
+    except (ValueError, OSError, AttributeError):
+        return 1
+
+def load_average():
+    """The one minute load average divided by the number of CPUs."""
+    try:
+        return os.getloadavg()[0] / cpu_count()
+    except (OSError, AttributeError):
+        return None
+
+def memory_free():
+    """The fraction of physical memory available for new processes."""
+    try:
+        f = open('/proc/meminfo')
+        try:
+            info = dict((l.split(':')[0], int(l.split()[1])) for l in f)
+        finally:
+            f.close()
+    except (IOError, ValueError, IndexError):
+        return None
+    if 'MemAvailable' in info:
+        available = info['MemAvailable']
+    else:
+        available = info.get('MemFree', 0) + info.get('Buffers', 0) + \
+            info.get('Cached', 0)
+    return float(available) / info['MemTotal'] if 'MemTotal' in info else None
+
+def cpu_times():
+    """The aggregate CPU time counters from /proc/stat, as a list."""
+    try:
+        f = open('/proc/stat')
+        try:
+            return map(int, f.readline().split()[1:])
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return None
+
+class HostMonitor(object):
+    """Samples load, free memory and iowait on this host.
+
+    iowait is a rate, so it is measured as the fraction of CPU time spent
+    waiting on IO since the previous call to sample(), or since the
+    monitor was made for the first call.
+
+    """
+    def __init__(self):
+        self.last_times = cpu_times()
+
+    def iowait(self):
+        """Fraction of CPU time spent in iowait since the last call."""
+        times = cpu_times()
+        last, self.last_times = self.last_times, times
+        # The fifth column of /proc/stat is iowait.
+        if not times or not last or len(times) < 5:
+            return None
+        deltas = [t - l for t, l in zip(times, last)]
+        total = sum(deltas)
+        return float(deltas[4]) / total if total > 0 else None
+
+    def sample(self):
+        """Returns a dict of the current load, memory and iowait values."""
+        return dict(load=load_average(), memory=memory_free(),
+            iowait=self.iowait())
+
+def parse_cpu_list(cpus):
+    """Parses a CPU list like '0-3,6' into a sorted list of CPU numbers."""
+    result = set()
+    for part in cpus.replace(' ', '').split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = map(int, part.split('-'))
+            if first > last:
+                raise ValueError("Invalid CPU range '%s'." % part)
+            result.update(range(first, last + 1))
+        else:
+            result.add(int(part))
+    return sorted(result)
+
+def _libc():
+    import ctypes, ctypes.util
+    return ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+def set_affinity(cpus, pid=0):
+    """Pins the process (default: this one) to the given CPU numbers."""
+    if hasattr(os, 'sched_setaffinity'):
+        return os.sched_setaffinity(pid, cpus)
+    import ctypes
+    # A cpu_set_t is a bitmask of 1024 bits on Linux.
+    bits = 8 * ctypes.sizeof(ctypes.c_ulong)
+    mask = (ctypes.c_ulong * (1024 // bits))()
+    for cpu in cpus:
+        mask[cpu // bits] |= 1 << (cpu % bits)
+    size = ctypes.sizeof(mask)
+    if _libc().sched_setaffinity(pid, size, ctypes.byref(mask)):
+        raise OSError(ctypes.get_errno(), "sched_setaffinity failed")
+
+# The ioprio_set syscall number by architecture; Python has no wrapper.
+IOPRIO_SET = {'x86_64': 251, 'i386': 289, 'i686': 289,
+    'aarch64': 30, 'armv7l': 314, 'ppc64le': 273}
+
+# IO scheduling classes, as used by ionice(1).
+IOPRIO_CLASSES = {1: 'realtime', 2: 'best-effort', 3: 'idle'}
+
+def set_io_priority(io_class, level=4, pid=0):
+    """Sets the IO scheduling class and level (0-7) of a process."""
+    import ctypes, platform
+    assert io_class in IOPRIO_CLASSES, "Invalid IO class: %s" % io_class
+    assert 0 <= level <= 7, "Invalid IO priority level: %s" % level
+    syscall = IOPRIO_SET.get(platform.machine())
+    if syscall == None:
+        raise OSError("ioprio_set is unsupported on %s." % platform.machine())
+    # 1 is IOPRIO_WHO_PROCESS; the class lives above the 13 data bits.
+    if _libc().syscall(syscall, 1, pid, (io_class << 13) | level):
+        raise OSError(ctypes.get_errno(), "ioprio_set failed")
+
+def group_pids(pgid):
+    """The PIDs of live (non-zombie) processes in a process group.
+    
+    Returns None if /proc isn't available to check.  The group is probed
+    with a null signal first, so /proc is only read when the group
+    still has members.
+    
+    """
+    try:
+        os.killpg(pgid, 0)
+    except OSError, e:
+        if e.errno == errno.ESRCH:
+            return []
+    if not os.path.isdir('/proc'):
+        return None
+    pids = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            f = open('/proc/%s/stat' % entry)
+            try:
+                stat = f.read()
+            finally:
+                f.close()
+        except IOError:
+            # The process ended while we were looking.
+            continue
+        # The command name may contain spaces, so split after it.
+        fields = stat[stat.rindex(')') + 2:].split()
+        if fields[0] != 'Z' and int(fields[2]) == pgid:
+            pids.append(int(entry))
+    return pids
+
+def kill_group(pgid, signum):
+    """Signals every process in a group.  Returns False if none exist."""
+    try:
+        os.killpg(pgid, signum)
+    except OSError, e:
+        if e.errno == errno.ESRCH:
+            return False
+        raise
+    return True
+
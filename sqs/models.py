@@ -45,6 +45,17 @@ class SQSQueue(Queue):
         message = self.queue.new_message(pickle.dumps(body))
         self.queue.write(message)
     
+    def push_many(self, items):
+        """Adds items in batches of 10, the most SQS takes at once."""
+        messages = []
+        for i, item in enumerate(items):
+            content_type = ContentType.objects.get_for_model(item)
+            body = (content_type.pk, item.pk)
+            message = self.queue.new_message(pickle.dumps(body))
+            messages.append((str(i), message.get_body_encoded(), 0))
+        for i in range(0, len(messages), 10):
+            self.queue.write_batch(messages[i:i + 10])
+    
     def count(self):
         return self.queue.count()
     